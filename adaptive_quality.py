@@ -0,0 +1,181 @@
+"""
+Closed-loop JPEG quality / resolution control.
+
+The servers used to encode every frame at quality 80 and the full preview
+size whatever the link could carry, so on a degraded Wi-Fi link the TCP
+send buffers filled up and viewers fell seconds behind. QualityController
+steps down a ladder of (scale, quality) levels when the link shows
+congestion and creeps back up once it has been clean for a while, so the
+stream gets softer instead of later.
+
+Congestion signals (any one of them steps down):
+  - send time:  a viewer's sender blocked in send for more than SEND_BUSY of
+                the wall-clock time (the link can't drain a frame per interval)
+  - queue:      a viewer's send queue full / frames being dropped
+  - latency:    acked capture -> viewer -> server latency above target_latency
+  - bitrate:    encoded output above target_bitrate, if one is set
+
+target_bitrate is an opt-in cap for links with a known budget. The other
+signals measure what the link actually drains, so leave it at None unless
+the stream has to stay under a fixed rate: a cap below the link's capacity
+steps a stream down on an idle LAN just for being sharp.
+
+Usage with a FrameHub (viewers connect with FrameReceiver(sock, ack=True)):
+
+    controller = QualityController(target_latency=0.15)
+    while True:
+        frame = picam2.capture_array()
+        observe_hub(controller, hub)
+        ret, buffer = controller.encode(frame)
+        hub.publish(...)
+
+and from an HTTP MJPEG generator, timing how long each yield was blocked
+writing to the client:
+
+    start = time.perf_counter()
+    yield part
+    controller.record_send(time.perf_counter() - start, client=client_id)
+"""
+import threading
+import time
+
+import cv2
+
+# (scale, JPEG quality) from best to most degraded. Quality goes down first:
+# it is cheaper to lose than resolution, and scaling down also saves encode time.
+DEFAULT_LEVELS = (
+    (1.0, 80), (1.0, 70), (1.0, 60),
+    (0.75, 70), (0.75, 60),
+    (0.5, 70), (0.5, 60), (0.5, 50),
+    (0.35, 50), (0.25, 40),
+)
+UPDATE_INTERVAL = 0.5  # seconds between control decisions
+SEND_BUSY = 0.6        # fraction of time blocked in send that counts as congestion
+UP_HOLD = 3.0          # seconds without congestion before stepping back up
+UP_HEADROOM = 0.8      # only step up if the bitrate is below this fraction of the target
+
+
+class QualityController(object):
+    def __init__(self, target_bitrate=None, target_latency=None, levels=DEFAULT_LEVELS,
+                 interval=UPDATE_INTERVAL):
+        self.target_bitrate = target_bitrate  # bits per second
+        self.target_latency = target_latency  # seconds
+        self.levels = levels
+        self.interval = interval
+        self.level = 0
+        self.lock = threading.Lock()
+        self.level_changes = 0
+        self.bitrate = 0.0  # measured over the last interval
+        self.reason = None  # why the last step down happened
+        self._hub_seen = {}  # observe_hub(): last counters per subscriber
+        self._reset(time.perf_counter())
+        self._clean_since = self._period_start
+
+    def _reset(self, now):
+        self._period_start = now
+        self._bytes = 0
+        self._busy = {}
+        self._latency = None
+        self._queue_full = False
+
+    @property
+    def scale(self):
+        return self.levels[self.level][0]
+
+    @property
+    def quality(self):
+        return self.levels[self.level][1]
+
+    # -------------------------------
+    # Inputs
+    # -------------------------------
+    def record_frame(self, nbytes):
+        with self.lock:
+            self._bytes += nbytes
+
+    def record_send(self, seconds, client=None):
+        """Time one client spent blocked sending (summed per client over the interval)."""
+        with self.lock:
+            self._busy[client] = self._busy.get(client, 0.0) + seconds
+
+    def record_queue(self, depth, capacity, dropped=0):
+        with self.lock:
+            if dropped or (capacity and depth >= capacity):
+                self._queue_full = True
+
+    def record_latency(self, seconds):
+        with self.lock:
+            self._latency = seconds if self._latency is None else max(self._latency, seconds)
+
+    # -------------------------------
+    # Control
+    # -------------------------------
+    def update(self, now=None):
+        """Re-evaluate the level once per interval. Returns True if it changed."""
+        if now is None:
+            now = time.perf_counter()
+        with self.lock:
+            elapsed = now - self._period_start
+            if elapsed < self.interval:
+                return False
+            self.bitrate = 8.0 * self._bytes / elapsed
+            busy = max(self._busy.values()) / elapsed if self._busy else 0.0
+            reason = severe = None
+            if self.target_latency and self._latency is not None and self._latency > self.target_latency:
+                reason, severe = "latency", self._latency > 2 * self.target_latency
+            elif busy > SEND_BUSY:
+                reason, severe = "send", busy > 0.9
+            elif self._queue_full:
+                reason, severe = "queue", False
+            elif self.target_bitrate and self.bitrate > self.target_bitrate:
+                reason, severe = "bitrate", self.bitrate > 1.5 * self.target_bitrate
+            self._reset(now)
+
+            old_level = self.level
+            if reason is not None:
+                self.reason = reason
+                self._clean_since = now
+                # Down fast (two steps when badly congested), up slowly.
+                self.level = min(len(self.levels) - 1, self.level + (2 if severe else 1))
+            elif now - self._clean_since >= UP_HOLD and self.level > 0:
+                if not self.target_bitrate or self.bitrate < UP_HEADROOM * self.target_bitrate:
+                    self.level -= 1
+                    self._clean_since = now
+            if self.level != old_level:
+                self.level_changes += 1
+                return True
+            return False
+
+    def encode(self, frame):
+        """cv2.imencode at the current scale and quality. Returns (ret, buffer) like imencode."""
+        self.update()
+        scale, quality = self.levels[self.level]
+        if scale != 1.0:
+            h, w = frame.shape[:2]
+            frame = cv2.resize(frame, (max(1, int(w * scale)), max(1, int(h * scale))),
+                               interpolation=cv2.INTER_AREA)
+        ret, buffer = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), quality])
+        if ret:
+            self.record_frame(len(buffer))
+        return ret, buffer
+
+    def status(self):
+        return "q%d %d%% %.2f Mbit/s%s" % (self.quality, int(100 * self.scale), self.bitrate / 1e6,
+                                           (" (down: %s)" % self.reason) if self.level else "")
+
+
+def observe_hub(controller, hub):
+    """Feed a FrameHub's per-viewer queue depth, send time, drops and ack latency to the controller."""
+    seen = controller._hub_seen
+    current = {}
+    for subscriber in hub.subscribers():
+        key = id(subscriber)
+        busy, dropped, acks = subscriber.send_busy, subscriber.frames_dropped, subscriber.acks_received
+        last_busy, last_dropped, last_acks = seen.get(key, (busy, dropped, acks))
+        current[key] = (busy, dropped, acks)
+        if busy > last_busy:
+            controller.record_send(busy - last_busy, client=key)
+        controller.record_queue(len(subscriber.queue), subscriber.queue.maxlen, dropped - last_dropped)
+        if acks > last_acks and subscriber.ack_latency is not None:
+            controller.record_latency(subscriber.ack_latency)
+    controller._hub_seen = current
@@ -1,22 +1,16 @@
-import socket
-import pickle
-import struct
+import time
 import cv2
-from picamera2 import Picamera2
-from picamera2.encoders import H264Encoder
+from frame_hub import FrameHub
+import latency
+from camera_backend import Picamera2, H264Encoder
 
 # Set up the server socket
 SERVER_IP = ''  # Listen on all available interfaces
 SERVER_PORT = 8485
 
-server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-server_socket.bind((SERVER_IP, SERVER_PORT))
-server_socket.listen(0)
-print("Server listening on port", SERVER_PORT)
-
-# Wait for a client to connect
-conn, addr = server_socket.accept()
-print("Connected by:", addr)
+# Viewers can connect and disconnect at any time; each gets every encoded frame.
+hub = FrameHub(SERVER_PORT, host=SERVER_IP)
+hub.start()
 
 # Initialize the Picamera2 instance and start the camera
 picam2 = Picamera2()
@@ -34,9 +28,14 @@ try:
     while True:
         # Capture a frame from the camera as a NumPy array (compatible with OpenCV)
         frame = picam2.capture_array()
+        capture_time = time.time()
         
         # Increment frame index
         frame_index += 1
+
+        # Nobody watching: skip the overlay and JPEG encode (H.264 recording keeps running)
+        if hub.subscriber_count == 0:
+            continue
         
         # Prepare the text to be written
         text = f"Frame {frame_index}"
@@ -59,17 +58,13 @@ try:
         if not ret:
             continue
         
-        # Serialize (pickle) the JPEG buffer
-        data = pickle.dumps(buffer)
-        
-        # Pack the size of the pickled data (header) using an unsigned long
-        message_size = struct.pack("L", len(data))
-        
-        # Send header and data over the socket
-        conn.sendall(message_size + data)
+        meta = latency.stamp({}, "encode")
+
+        # Queue header + JPEG for every connected viewer (encoded once, no copies)
+        latency.stamp(meta, "publish")
+        hub.publish(frame_index, buffer, timestamp=capture_time, meta=meta)
 except Exception as e:
     print("Error:", e)
 finally:
-    conn.close()
-    server_socket.close()
+    hub.close()
     picam2.close()
@@ -0,0 +1,421 @@
+"""
+Asyncio MJPEG streaming front end.
+
+werkzeug's threaded=True server spends one OS thread (and its stack) per
+viewer, each one blocked in a generator. AsyncMJPEGServer serves the
+streaming routes from a single asyncio event loop instead:
+
+  - every stream reads one LatestFrame (latest_frame.py) in a pump task,
+    which hands each new frame to every viewer's bounded asyncio.Queue
+  - a viewer that can't keep up has the oldest frame in its queue dropped,
+    so it always gets the newest frames and never holds up the others
+  - a viewer costs a socket and a small queue, not a thread
+
+Every other route (pages, JSON, POST handlers) is passed to the existing
+Flask app through WSGI on a small thread pool, so a script switches front
+end without touching its routes:
+
+    server = AsyncMJPEGServer(port=8485, wsgi_app=app)
+    server.add_stream('/video', latest_frame)
+    server.run()
+
+Streaming routes must be registered with add_stream(): a streaming Flask
+response reached through the WSGI fallback would tie up a pool thread
+forever. So would a snapshot long poll (/snapshot.jpg?wait=, see
+snapshot.py) for up to its wait: register those with add_snapshot(), which
+waits for the next frame on the event loop. Large static files (recorded segments) can be registered with
+add_files(): they are sent with os.sendfile (loop.sendfile), honouring
+single-range Range requests, without passing through Python buffers.
+"""
+import asyncio
+import concurrent.futures
+import io
+import os
+import re
+import sys
+import time
+from http import HTTPStatus
+from urllib.parse import parse_qsl, unquote
+
+from snapshot import client_version, parse_wait, snapshot_result
+
+QUEUE_SIZE = 2        # frames buffered per viewer before the oldest is dropped
+WSGI_THREADS = 4      # threads for the non-streaming Flask routes
+MAX_BODY = 1 << 20    # largest request body accepted for the WSGI routes
+STREAM_HEADERS = (b"HTTP/1.1 200 OK\r\n"
+                  b"Content-Type: multipart/x-mixed-replace; boundary=frame\r\n"
+                  b"Cache-Control: no-cache, private\r\n"
+                  b"Connection: close\r\n\r\n")
+
+
+_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def parse_range(header, size):
+    """
+    (start, end) byte range (end exclusive) asked for by a Range header, None
+    for the whole file (no header, or one we don't handle such as several
+    ranges) or False if the range can't be satisfied.
+    """
+    match = _RANGE.match((header or "").strip())
+    if match is None:
+        return None
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        end = min(int(last) + 1, size) if last else size
+    elif last:
+        start, end = max(size - int(last), 0), size  # suffix range: the last N bytes
+    else:
+        return None
+    if start >= size or start >= end:
+        return False
+    return start, end
+
+
+def mjpeg_part(jpeg):
+    """Wrap JPEG bytes as one part of a multipart/x-mixed-replace stream."""
+    return (b'--frame\r\n'
+            b'Content-Type: image/jpeg\r\n\r\n' + bytes(jpeg) + b'\r\n')
+
+
+class _Stream(object):
+    """One streaming route: its frame source and the queues of its viewers."""
+
+    def __init__(self, frames, part, subscribe, unsubscribe, on_send, queue_size):
+        self.frames = frames
+        self.part = part
+        self.subscribe = subscribe
+        self.unsubscribe = unsubscribe
+        self.on_send = on_send
+        self.queue_size = queue_size
+        self.viewers = set()
+        self.pump = None
+        self.frames_sent = 0
+        self.frames_dropped = 0
+
+    def add(self):
+        queue = asyncio.Queue(self.queue_size)
+        self.viewers.add(queue)
+        if len(self.viewers) == 1:
+            if self.subscribe is not None:
+                self.subscribe()
+            if self.pump is None or self.pump.done():
+                self.pump = asyncio.ensure_future(self._pump())
+        return queue
+
+    def remove(self, queue):
+        self.viewers.discard(queue)
+        if not self.viewers and self.unsubscribe is not None:
+            self.unsubscribe()
+
+    async def _pump(self):
+        """Wait (on a worker thread) for each new frame and queue it for every viewer."""
+        loop = asyncio.get_running_loop()
+        version = 0
+        while self.viewers:
+            result = await loop.run_in_executor(None, self.frames.wait_newer, version, 1.0)
+            if result is None:
+                if self.frames.closed:
+                    # The source failed (e.g. CameraService): end every viewer's stream.
+                    for queue in self.viewers:
+                        if queue.full():
+                            queue.get_nowait()
+                        queue.put_nowait(None)
+                    return
+                continue
+            version, value = result
+            data = self.part(value) if self.part is not None else value
+            for queue in self.viewers:
+                if queue.full():
+                    queue.get_nowait()
+                    self.frames_dropped += 1
+                queue.put_nowait(data)
+
+
+class _FrameWatcher(object):
+    """
+    Long polls waiting on one LatestFrame. However many polls are waiting,
+    one executor thread blocks in wait_newer() and wakes them all.
+    """
+
+    def __init__(self, frames):
+        self.frames = frames
+        self.waiters = set()
+        self.pump = None
+
+    async def wait_newer(self, version, timeout):
+        """(version, value) once a value newer than `version` exists, the source closed or `timeout` passed."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            current, value = self.frames.get()
+            remaining = deadline - loop.time()
+            if (current > version and value is not None) or self.frames.closed or remaining <= 0:
+                return current, value
+            future = loop.create_future()
+            self.waiters.add(future)
+            if self.pump is None or self.pump.done():
+                self.pump = asyncio.ensure_future(self._pump(current))
+            try:
+                await asyncio.wait((future,), timeout=remaining)
+            finally:
+                self.waiters.discard(future)
+
+    async def _pump(self, version):
+        loop = asyncio.get_running_loop()
+        while self.waiters:
+            result = await loop.run_in_executor(None, self.frames.wait_newer, version, 1.0)
+            if result is None and not self.frames.closed:
+                continue
+            if result is not None:
+                version = result[0]
+            for future in self.waiters:
+                if not future.done():
+                    future.set_result(None)
+
+
+class AsyncMJPEGServer(object):
+    def __init__(self, host='0.0.0.0', port=8485, wsgi_app=None, queue_size=QUEUE_SIZE):
+        self.host = host
+        self.port = port
+        self.wsgi_app = wsgi_app
+        self.queue_size = queue_size
+        self.streams = {}
+        self.file_routes = []
+        self.snapshots = {}
+        self._watchers = {}
+        self._wsgi_pool = concurrent.futures.ThreadPoolExecutor(WSGI_THREADS)
+        self._server = None
+
+    def add_stream(self, path, frames, part=mjpeg_part, subscribe=None, unsubscribe=None, on_send=None):
+        """
+        Serve `frames` (a LatestFrame) as an MJPEG stream at `path`.
+
+        part:        turns a published value into the bytes of one multipart
+                     part (None if the values already are parts)
+        subscribe / unsubscribe: called when the first viewer arrives / the last
+                     leaves, e.g. CameraService.subscribe / unsubscribe
+        on_send:     on_send(seconds, client) after every part written, with the
+                     time spent waiting for the socket to drain (feeds
+                     QualityController.record_send)
+        """
+        self.streams[path] = _Stream(frames, part, subscribe, unsubscribe, on_send, self.queue_size)
+
+    def add_snapshot(self, path, frames):
+        """
+        Serve the latest JPEG of `frames` at `path` like snapshot_response()
+        (ETag, If-None-Match, ?wait= long polls), without a WSGI pool thread.
+        `frames` is a LatestFrame, or a function of the query parameters
+        (a dict) returning one, or None for a 404.
+        """
+        self.snapshots[path] = frames
+
+    def add_files(self, prefix, directory, suffixes, content_types=None):
+        """
+        Serve files in `directory` (no subdirectories) whose names end in one of
+        `suffixes` at `prefix` + name, with sendfile and Range support. Other
+        paths under `prefix` still go to the WSGI app.
+        """
+        self.file_routes.append((prefix, os.path.abspath(directory), tuple(suffixes), content_types or {}))
+
+    def _find_file(self, path):
+        for prefix, directory, suffixes, content_types in self.file_routes:
+            if not path.startswith(prefix):
+                continue
+            name = unquote(path[len(prefix):])
+            if "/" in name or name.startswith(".") or not name.endswith(suffixes):
+                continue
+            file_path = os.path.join(directory, name)
+            if os.path.isfile(file_path):
+                content_type = content_types.get(os.path.splitext(name)[1], "application/octet-stream")
+                return file_path, content_type
+        return None
+
+    @property
+    def viewer_count(self):
+        return sum(len(stream.viewers) for stream in self.streams.values())
+
+    # -------------------------------
+    # Connections
+    # -------------------------------
+    async def _handle(self, reader, writer):
+        try:
+            try:
+                head = await reader.readuntil(b"\r\n\r\n")
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                return
+            lines = head.decode("latin-1").split("\r\n")
+            try:
+                method, target, _ = lines[0].split(" ", 2)
+            except ValueError:
+                writer.write(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                return
+            headers = {}
+            for line in lines[1:]:
+                if ":" in line:
+                    name, value = line.split(":", 1)
+                    headers[name.strip().lower()] = value.strip()
+            path, _, query = target.partition("?")
+
+            stream = self.streams.get(path)
+            snapshot = self.snapshots.get(path) if method in ("GET", "HEAD") else None
+            found = self._find_file(path) if method in ("GET", "HEAD") else None
+            if stream is not None and method == "GET":
+                await self._serve_stream(stream, writer)
+            elif snapshot is not None:
+                await self._serve_snapshot(method, snapshot, query, headers, writer)
+            elif found is not None:
+                await self._serve_file(method, found[0], found[1], headers, writer)
+            elif self.wsgi_app is not None:
+                await self._serve_wsgi(method, path, query, headers, reader, writer)
+            else:
+                writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def _serve_stream(self, stream, writer):
+        writer.write(STREAM_HEADERS)
+        queue = stream.add()
+        try:
+            while True:
+                data = await queue.get()
+                if data is None:
+                    break  # the source closed
+                writer.write(data)
+                start = time.perf_counter()
+                await writer.drain()
+                stream.frames_sent += 1
+                if stream.on_send is not None:
+                    stream.on_send(time.perf_counter() - start, queue)
+        finally:
+            stream.remove(queue)
+
+    async def _serve_snapshot(self, method, source, query, headers, writer):
+        args = dict(parse_qsl(query))
+        frames = source(args) if callable(source) else source
+        if frames is None:
+            writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            return
+        wait = parse_wait(args.get("wait"))
+        known = client_version(headers.get("if-none-match"))
+        version, jpeg = frames.get()
+        if wait > 0 and (jpeg is None or version == known):
+            watcher = self._watchers.get(frames)
+            if watcher is None:
+                watcher = self._watchers[frames] = _FrameWatcher(frames)
+            version, jpeg = await watcher.wait_newer(version, wait)
+        status, response_headers, body = snapshot_result(version, jpeg, known)
+        out = ["HTTP/1.1 %d %s\r\n" % (status, HTTPStatus(status).phrase)]
+        for name, value in response_headers.items():
+            out.append("%s: %s\r\n" % (name, value))
+        out.append("Content-Length: %d\r\nConnection: close\r\n\r\n" % len(body))
+        writer.write("".join(out).encode("latin-1"))
+        if method != "HEAD":
+            writer.write(body)
+
+    async def _serve_file(self, method, path, content_type, headers, writer):
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size  # a segment still being recorded is served as it is now
+            byte_range = parse_range(headers.get("range"), size)
+            if byte_range is False:
+                writer.write(("HTTP/1.1 416 Range Not Satisfiable\r\nContent-Range: bytes */%d\r\n"
+                              "Content-Length: 0\r\nConnection: close\r\n\r\n" % size).encode("latin-1"))
+                return
+            if byte_range is None:
+                start, end = 0, size
+                out = ["HTTP/1.1 200 OK\r\n"]
+            else:
+                start, end = byte_range
+                out = ["HTTP/1.1 206 Partial Content\r\n",
+                       "Content-Range: bytes %d-%d/%d\r\n" % (start, end - 1, size)]
+            out.append("Content-Type: %s\r\nContent-Length: %d\r\nAccept-Ranges: bytes\r\n"
+                       "Connection: close\r\n\r\n" % (content_type, end - start))
+            writer.write("".join(out).encode("latin-1"))
+            if method == "HEAD" or end == start:
+                return
+            await writer.drain()
+            # os.sendfile on a plain socket: the kernel copies page cache -> socket.
+            await asyncio.get_running_loop().sendfile(writer.transport, f, start, end - start)
+
+    async def _serve_wsgi(self, method, path, query, headers, reader, writer):
+        length = int(headers.get("content-length") or 0)
+        if length > MAX_BODY:
+            writer.write(b"HTTP/1.1 413 Payload Too Large\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            return
+        body = await reader.readexactly(length) if length else b""
+        peer = writer.get_extra_info("peername") or ("", 0)
+        loop = asyncio.get_running_loop()
+        status, response_headers, content = await loop.run_in_executor(
+            self._wsgi_pool, self._call_wsgi, method, path, query, headers, body, peer)
+        out = ["HTTP/1.1 %s\r\n" % status]
+        names = set()
+        for name, value in response_headers:
+            if name.lower() in ("connection", "transfer-encoding"):
+                continue
+            names.add(name.lower())
+            out.append("%s: %s\r\n" % (name, value))
+        if "content-length" not in names:
+            out.append("Content-Length: %d\r\n" % len(content))
+        out.append("Connection: close\r\n\r\n")
+        writer.write("".join(out).encode("latin-1"))
+        if method != "HEAD":
+            writer.write(content)
+
+    def _call_wsgi(self, method, path, query, headers, body, peer):
+        """Run one request through the WSGI app (on a pool thread). Returns (status, headers, body)."""
+        environ = {
+            "REQUEST_METHOD": method,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": unquote(path, encoding="latin-1"),
+            "QUERY_STRING": query,
+            "SERVER_NAME": self.host,
+            "SERVER_PORT": str(self.port),
+            "SERVER_PROTOCOL": "HTTP/1.1",
+            "REMOTE_ADDR": peer[0],
+            "CONTENT_TYPE": headers.get("content-type", ""),
+            "CONTENT_LENGTH": str(len(body)),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "http",
+            "wsgi.input": io.BytesIO(body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+        for name, value in headers.items():
+            if name not in ("content-type", "content-length"):
+                environ["HTTP_" + name.upper().replace("-", "_")] = value
+        response = {}
+
+        def start_response(status, response_headers, exc_info=None):
+            response["status"] = status
+            response["headers"] = response_headers
+            return lambda data: None
+
+        result = self.wsgi_app(environ, start_response)
+        try:
+            content = b"".join(result)
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+        return response["status"], response["headers"], content
+
+    # -------------------------------
+    # Running
+    # -------------------------------
+    async def serve_forever(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        print("Async MJPEG server listening on port", self.port)
+        async with self._server:
+            await self._server.serve_forever()
+
+    def run(self):
+        try:
+            asyncio.run(self.serve_forever())
+        except KeyboardInterrupt:
+            pass
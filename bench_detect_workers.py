@@ -0,0 +1,116 @@
+"""
+Benchmark: s7-style contour detection in-process vs on 1, 2 and 4 worker processes.
+
+Synthetic 480-line frames (a few dark blobs on a noisy light background,
+moving from frame to frame) go through the same stages as sockets/s7.py.
+"in-process" runs the Detector on this thread, as the pipeline's detect
+stage does; the other rows submit the frames to a DetectionPool
+(detect_workers.py) from a feeder thread and collect the results in order,
+as s7.py does with DETECT_WORKERS set:
+
+    python bench_detect_workers.py            # in-process, 1, 2, 4 workers
+    python bench_detect_workers.py 1 4        # just these worker counts
+
+Throughput should grow with the worker count up to the number of cores
+(four on a Pi 4), minus the memcpy into shared memory and the result
+round trip.
+"""
+import sys
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from detect_workers import DetectionPool
+from detection import (Detector, Crop, Gray, Blur, AdaptiveThreshold, Morphology, Contours,
+                       FilterByArea)
+
+FRAME_SIZE = (853, 480)   # 1280x720 scaled to 480 lines, as in s7.py
+ROI = (200, 150, 800, 450)
+NUM_FRAMES = 300
+NUM_VARIANTS = 16         # distinct frames cycled through (so no cache effects from one frame)
+WORKER_COUNTS = (1, 2, 4)
+
+
+def make_detector():
+    return Detector([
+        Crop(roi=ROI, height=FRAME_SIZE[1]),
+        Gray(),
+        Blur((5, 5)),
+        AdaptiveThreshold(block_size=11, c=7),
+        Morphology(cv2.MORPH_OPEN, np.ones((3, 3), np.uint8)),
+        Contours(),
+        FilterByArea(1000),
+    ])
+
+
+def make_frames():
+    rng = np.random.default_rng(0)
+    width, height = FRAME_SIZE
+    frames = []
+    for i in range(NUM_VARIANTS):
+        frame = np.full((height, width, 3), 200, np.uint8)
+        for k in range(4):
+            x = 250 + 120 * k + 5 * i
+            cv2.circle(frame, (x, 200 + 40 * (k % 2)), 30 + 5 * k, (30, 30, 30), -1)
+        frame = cv2.add(frame, rng.integers(0, 40, frame.shape, dtype=np.uint8))
+        frames.append(frame)
+    return frames
+
+
+def run_in_process(frames):
+    detector = make_detector()
+    start = time.perf_counter()
+    objects = 0
+    for i in range(NUM_FRAMES):
+        objects += len(detector.run(frames[i % len(frames)]).objects)
+    return NUM_FRAMES / (time.perf_counter() - start), objects
+
+
+def run_pool(frames, workers):
+    pool = DetectionPool(make_detector, workers=workers, slot_bytes=frames[0].nbytes)
+    pool.start()
+    try:
+        # Warm up every worker (first-frame buffer allocation) before timing.
+        for seq in range(2 * workers):
+            pool.submit(seq, frames[0])
+        for seq in range(2 * workers):
+            pool.collect(seq)
+
+        first = 2 * workers
+
+        def feed():
+            for i in range(NUM_FRAMES):
+                pool.submit(first + i, frames[i % len(frames)])
+
+        start = time.perf_counter()
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+        objects = 0
+        for i in range(NUM_FRAMES):
+            result = pool.collect(first + i, timeout=10.0)
+            if result is not None:
+                objects += len(result.objects)
+        elapsed = time.perf_counter() - start
+        feeder.join()
+        return NUM_FRAMES / elapsed, objects
+    finally:
+        pool.close()
+
+
+def main():
+    counts = [int(arg) for arg in sys.argv[1:]] or list(WORKER_COUNTS)
+    frames = make_frames()
+    print("%d frames of %dx%d, ROI %s" % (NUM_FRAMES, FRAME_SIZE[0], FRAME_SIZE[1], ROI))
+    print("%-12s %8s %8s %8s" % ("mode", "fps", "speedup", "objects"))
+    base_fps, objects = run_in_process(frames)
+    print("%-12s %8.1f %8.2f %8d" % ("in-process", base_fps, 1.0, objects))
+    for workers in counts:
+        fps, objects = run_pool(frames, workers)
+        print("%-12s %8.1f %8.2f %8d" % ("%d worker%s" % (workers, "" if workers == 1 else "s"),
+                                         fps, fps / base_fps, objects))
+
+
+if __name__ == "__main__":
+    main()
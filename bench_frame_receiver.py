@@ -0,0 +1,86 @@
+"""
+Benchmark: old `recv(4096); data += packet` client loop vs FrameReceiver.
+
+A sender thread pushes frames over a loopback TCP connection using
+frame_protocol.send_frame(); the receiver side is timed and reports MB/s.
+Runs anywhere (no camera, no OpenCV needed):
+
+    python bench_frame_receiver.py
+"""
+import socket
+import threading
+import time
+
+import frame_protocol
+from frame_receiver import FrameReceiver
+
+# Typical quality-80 JPEG sizes at 320x180, 1280x720 and 1920x1080.
+FRAME_SIZES = [("180p", 15 * 1024), ("720p", 150 * 1024), ("1080p", 400 * 1024)]
+BYTES_PER_RUN = 200 * 1024 * 1024
+
+
+def old_loop(sock, num_frames):
+    """The receive loop the clients used to copy around (adapted to the new header)."""
+    data = b""
+    payload_size = frame_protocol.HEADER_SIZE
+    for _ in range(num_frames):
+        while len(data) < payload_size:
+            packet = sock.recv(4096)
+            if not packet:
+                raise ConnectionError("Socket connection closed")
+            data += packet
+        packed_msg_size = data[:payload_size]
+        data = data[payload_size:]
+        header = frame_protocol.unpack_header(packed_msg_size)
+        msg_size = header.meta_len + header.payload_len
+        while len(data) < msg_size:
+            packet = sock.recv(4096)
+            if not packet:
+                raise ConnectionError("Socket connection closed during frame reception")
+            data += packet
+        frame_data = data[header.meta_len:msg_size]
+        data = data[msg_size:]
+
+
+def frame_receiver_loop(sock, num_frames):
+    receiver = FrameReceiver(sock)
+    for _ in range(num_frames):
+        receiver.recv_frame()
+
+
+def connected_pair():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    client = socket.create_connection(listener.getsockname())
+    server, _ = listener.accept()
+    listener.close()
+    return server, client
+
+
+def run(receive_loop, frame_size, num_frames):
+    sender, receiver = connected_pair()
+    payload = bytes(frame_size)
+
+    def send():
+        for seq in range(num_frames):
+            frame_protocol.send_frame(sender, seq, payload)
+        sender.close()
+
+    thread = threading.Thread(target=send, daemon=True)
+    start = time.perf_counter()
+    thread.start()
+    receive_loop(receiver, num_frames)
+    elapsed = time.perf_counter() - start
+    thread.join()
+    receiver.close()
+    return frame_size * num_frames / elapsed / 1e6
+
+
+if __name__ == '__main__':
+    print(f"{'frame':>8} {'size':>10} {'old loop MB/s':>15} {'FrameReceiver MB/s':>20} {'speedup':>8}")
+    for name, frame_size in FRAME_SIZES:
+        num_frames = max(1, BYTES_PER_RUN // frame_size)
+        old = run(old_loop, frame_size, num_frames)
+        new = run(frame_receiver_loop, frame_size, num_frames)
+        print(f"{name:>8} {frame_size:>10} {old:>15.1f} {new:>20.1f} {new / old:>7.1f}x")
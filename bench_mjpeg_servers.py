@@ -0,0 +1,163 @@
+"""
+Benchmark: werkzeug threaded=True vs AsyncMJPEGServer with many MJPEG viewers.
+
+Each server runs in its own process and streams synthetic JPEG-sized frames
+published to a LatestFrame at FRAME_RATE (the same way the camera scripts
+do). This process opens more and more viewer connections, reads the streams
+and, at every step, records the server's CPU use, resident memory and thread
+count from /proc plus the frame rate each viewer actually gets:
+
+    python bench_mjpeg_servers.py            # both servers
+    python bench_mjpeg_servers.py async      # just one
+
+Linux only (/proc). Needs Flask for the threaded server; no camera or OpenCV.
+"""
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from latest_frame import LatestFrame
+
+FRAME_BYTES = 20 * 1024   # about a 640x480 JPEG
+FRAME_RATE = 10
+VIEWER_COUNTS = (1, 10, 50, 100, 200, 400)
+SETTLE_TIME = 2.0         # seconds after adding viewers before measuring
+MEASURE_TIME = 5.0
+PORT = 8495
+SERVERS = ("threaded", "async")
+
+
+def publish_frames(frames):
+    payload = os.urandom(FRAME_BYTES)
+    while True:
+        frames.publish(payload)
+        time.sleep(1.0 / FRAME_RATE)
+
+
+def serve(kind, port):
+    """Server process: /video streams the synthetic frames."""
+    frames = LatestFrame()
+    threading.Thread(target=publish_frames, args=(frames,), daemon=True).start()
+    if kind == "async":
+        from async_mjpeg import AsyncMJPEGServer
+        server = AsyncMJPEGServer(host='127.0.0.1', port=port)
+        server.add_stream('/video', frames)
+        server.run()
+    else:
+        import logging
+        from flask import Flask, Response
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        app = Flask(__name__)
+
+        def gen_frames():
+            version = 0
+            while True:
+                result = frames.wait_newer(version, timeout=1.0)
+                if result is None:
+                    continue
+                version, frame = result
+                yield (b'--frame\r\n'
+                       b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
+
+        @app.route('/video')
+        def video_feed():
+            return Response(gen_frames(), mimetype='multipart/x-mixed-replace; boundary=frame')
+
+        app.run(host='127.0.0.1', port=port, threaded=True)
+
+
+def process_stats(pid):
+    """(cpu seconds, RSS MB, threads) of a process, from /proc."""
+    with open("/proc/%d/stat" % pid) as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / float(os.sysconf("SC_CLK_TCK"))
+    rss = threads = 0
+    with open("/proc/%d/status" % pid) as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                rss = int(line.split()[1]) / 1024.0
+            elif line.startswith("Threads:"):
+                threads = int(line.split()[1])
+    return cpu, rss, threads
+
+
+class Viewer(object):
+    def __init__(self):
+        self.bytes = 0
+        self.task = None
+
+    async def run(self, port):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b"GET /video HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        await writer.drain()
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                self.bytes += len(data)
+        finally:
+            writer.close()
+
+
+async def ramp(pid, port):
+    viewers = []
+    rows = []
+    part_size = FRAME_BYTES + len(b'--frame\r\nContent-Type: image/jpeg\r\n\r\n\r\n')
+    for count in VIEWER_COUNTS:
+        while len(viewers) < count:
+            viewer = Viewer()
+            viewer.task = asyncio.ensure_future(viewer.run(port))
+            viewers.append(viewer)
+        await asyncio.sleep(SETTLE_TIME)
+        start_bytes = [v.bytes for v in viewers]
+        start_cpu = process_stats(pid)[0]
+        start = time.perf_counter()
+        await asyncio.sleep(MEASURE_TIME)
+        elapsed = time.perf_counter() - start
+        cpu, rss, threads = process_stats(pid)
+        fps = sorted((v.bytes - b) / float(part_size) / elapsed for v, b in zip(viewers, start_bytes))
+        rows.append((count, 100.0 * (cpu - start_cpu) / elapsed, rss, threads, sum(fps) / len(fps), fps[0]))
+        print("  %4d viewers  cpu %6.1f%%  rss %6.1f MB  threads %4d  fps mean %5.1f  min %5.1f" % rows[-1])
+    for viewer in viewers:
+        viewer.task.cancel()
+    await asyncio.gather(*[v.task for v in viewers], return_exceptions=True)
+    return rows
+
+
+def wait_for_port(port, timeout=10.0):
+    end = time.time() + timeout
+    while time.time() < end:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("server did not start on port %d" % port)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "--serve":
+        serve(sys.argv[2], int(sys.argv[3]))
+        sys.exit(0)
+
+    kinds = sys.argv[1:] or SERVERS
+    print("%d byte frames at %d fps" % (FRAME_BYTES, FRAME_RATE))
+    results = {}
+    for kind in kinds:
+        print(kind)
+        server = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", kind, str(PORT)])
+        try:
+            wait_for_port(PORT)
+            results[kind] = asyncio.run(ramp(server.pid, PORT))
+        finally:
+            server.terminate()
+            server.wait()
+    if len(results) == len(SERVERS):
+        print("\nviewers  " + "".join("%-28s" % kind for kind in SERVERS))
+        for i, count in enumerate(VIEWER_COUNTS):
+            print("%7d  " % count + "".join("cpu %5.1f%% rss %6.1f MB    " % results[kind][i][1:3] for kind in SERVERS))
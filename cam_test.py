@@ -1,4 +1,4 @@
-from picamera2 import Picamera2
+from camera_backend import Picamera2
 import cv2
 
 # Initialize Picamera2 and start the camera
@@ -0,0 +1,54 @@
+"""
+Camera backend selection.
+
+The servers import Picamera2 (and H264Encoder) from here instead of from
+picamera2 directly:
+
+    from camera_backend import Picamera2
+
+so the same script runs on the Pi and, with the simulated camera, on any
+Linux box. Chosen with environment variables:
+
+  RPI_CAMERA         "picamera2" (real camera), "sim" (SimulatedCamera) or
+                     "auto" (default: picamera2 if it can be imported, else sim)
+  RPI_CAMERA_SOURCE  sim only: "pattern" (default), a video file, an image
+                     directory or a glob pattern
+  RPI_CAMERA_FPS     sim only: frame rate (default 30)
+
+e.g.  RPI_CAMERA=sim RPI_CAMERA_SOURCE=clip.mp4 python sockets/s7.py
+"""
+import os
+
+CAMERA_BACKEND = os.environ.get("RPI_CAMERA", "auto")
+SIM_SOURCE = os.environ.get("RPI_CAMERA_SOURCE", "pattern")
+SIM_FPS = float(os.environ.get("RPI_CAMERA_FPS", "30"))
+
+if CAMERA_BACKEND not in ("auto", "picamera2", "sim"):
+    raise ValueError("RPI_CAMERA must be 'auto', 'picamera2' or 'sim', not %r" % CAMERA_BACKEND)
+
+_real = None
+if CAMERA_BACKEND != "sim":
+    try:
+        from picamera2 import Picamera2 as _real
+        from picamera2.encoders import H264Encoder
+    except ImportError:
+        if CAMERA_BACKEND == "picamera2":
+            raise
+
+if _real is not None:
+    Picamera2 = _real
+    SIMULATED = False
+else:
+    from sim_camera import SimulatedCamera
+
+    SIMULATED = True
+
+    def Picamera2(camera_num=0):
+        """Drop-in for picamera2.Picamera2() returning a SimulatedCamera."""
+        return SimulatedCamera(source=SIM_SOURCE, fps=SIM_FPS, camera_num=camera_num)
+
+    class H264Encoder(object):
+        """Placeholder so start_recording(H264Encoder(), ...) works with the simulated camera."""
+
+        def __init__(self, *args, **kwargs):
+            pass
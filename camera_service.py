@@ -0,0 +1,111 @@
+"""
+Reference-counted camera capture shared by every viewer of a process.
+
+fast_http_stream.py used to open and start a Picamera2 inside each HTTP
+request's generator: a second viewer failed (or fought the first one for the
+sensor) and every viewer ran its own capture/overlay/encode loop.
+
+CameraService owns the one camera. The first subscriber starts it, the last
+one to leave stops it and releases the sensor. A single capture thread
+captures, renders (overlay + JPEG encode) once per frame and publishes the
+bytes to a LatestFrame, from which every viewer takes the same bytes: a
+viewer costs a socket write, not an encode.
+
+    def open_camera():
+        picam2 = Picamera2()
+        picam2.configure(picam2.create_preview_configuration({"size": (1280, 720)}))
+        picam2.start()
+        return picam2
+
+    def render(frame, frame_index):
+        ret, buffer = cv2.imencode('.jpg', frame)
+        return buffer.tobytes() if ret else None
+
+    camera = CameraService(open_camera, render)
+
+    def gen_frames():
+        with camera.subscription() as frames:
+            version = 0
+            while True:
+                result = frames.wait_newer(version, timeout=1.0)
+                ...
+
+Flask closes a streaming generator when its client disconnects, which runs
+the `with` block's exit and drops the reference.
+
+If the camera fails to open or capturing fails, the service closes the
+LatestFrame: wait_newer() returns None with `frames.closed` set, and the
+viewers' generators should end. The next subscribe() retries the camera.
+Every (re)start clears the LatestFrame, so a new viewer never gets the last
+JPEG of an earlier session as its first frame.
+"""
+import contextlib
+import threading
+
+from latest_frame import LatestFrame
+
+
+class CameraService(object):
+    def __init__(self, open_camera, render):
+        self.open_camera = open_camera  # () -> started camera with capture_array() and close()
+        self.render = render            # (frame, frame_index) -> bytes, or None to skip the frame
+        self.frames = LatestFrame()
+        self.lock = threading.Lock()
+        self.subscribers = 0
+        self.starts = 0
+        self._stop = None
+        self._thread = None
+        self._failed = False  # the capture thread ended on an error; the next subscribe() restarts it
+
+    def subscribe(self):
+        """Add a viewer, starting the camera if it is the first. Returns the LatestFrame to read from."""
+        with self.lock:
+            self.subscribers += 1
+            if self.subscribers == 1 or self._failed:
+                if self._thread is not None:
+                    # The previous capture thread is still shutting down: wait for the sensor.
+                    self._thread.join()
+                    self._thread = None
+                self._failed = False
+                self.frames.reset()
+                self._stop = threading.Event()
+                self._thread = threading.Thread(target=self._run, args=(self._stop,), daemon=True)
+                self._thread.start()
+                self.starts += 1
+        return self.frames
+
+    def unsubscribe(self):
+        """Remove a viewer, stopping the camera when it was the last."""
+        with self.lock:
+            self.subscribers -= 1
+            if self.subscribers == 0:
+                self._stop.set()
+
+    @contextlib.contextmanager
+    def subscription(self):
+        frames = self.subscribe()
+        try:
+            yield frames
+        finally:
+            self.unsubscribe()
+
+    def _run(self, stop):
+        camera = None
+        try:
+            camera = self.open_camera()
+            frame_index = 0
+            while not stop.is_set():
+                frame = camera.capture_array()
+                if frame is None:
+                    continue
+                frame_index += 1
+                data = self.render(frame, frame_index)
+                if data is not None:
+                    self.frames.publish(data)
+        except Exception as e:
+            print("Camera service error:", e)
+            self._failed = True
+            self.frames.close()  # wake the viewers so their streams end
+        finally:
+            if camera is not None:
+                camera.close()
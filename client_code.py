@@ -1,52 +1,52 @@
 import socket
-import pickle
-import struct
 import cv2
+import numpy as np
+import frame_protocol
+import h264_stream
+from frame_receiver import FrameReceiver
+import latency
 
 # Define the server address and port
 SERVER_IP = '192.168.1.184'
 SERVER_PORT = 8485
+H264_DECODER = "pyav"  # Used when the server streams H.264 (see h264_stream.DECODERS)
+LATENCY_REPORT = "latency_report.json"  # Written on exit
 
 # Create a TCP/IP socket
 client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 client_socket.connect((SERVER_IP, SERVER_PORT))
 
-data = b""
-# The header size is based on an unsigned long (8 bytes on many systems)
-# Adjust the format ("L") if your server sends a different type
-payload_size = struct.calcsize("L")
+receiver = FrameReceiver(client_socket, ack=True)  # acks let the server adapt quality
+h264_decoder = None
+tracker = latency.LatencyTracker()
 
 try:
     while True:
-        # Retrieve message size (header)
-        while len(data) < payload_size:
-            packet = client_socket.recv(4096)
-            if not packet:
-                raise ConnectionError("Socket connection closed")
-            data += packet
-
-        packed_msg_size = data[:payload_size]
-        data = data[payload_size:]
-        msg_size = struct.unpack("L", packed_msg_size)[0]
-
-        # Retrieve the full frame based on the message size
-        while len(data) < msg_size:
-            packet = client_socket.recv(4096)
-            if not packet:
-                raise ConnectionError("Socket connection closed during frame reception")
-            data += packet
-
-        frame_data = data[:msg_size]
-        data = data[msg_size:]
-
-        # Unpickle the received frame
-        # On the client side:
-        buffer = pickle.loads(frame_data)
-        frame = cv2.imdecode(buffer, cv2.IMREAD_COLOR)
-        #frame = pickle.loads(frame_data)
+        # Receive the next frame (header + encoded frame) into the reusable buffer
+        header, meta, frame_data = receiver.recv_frame()
+        sample = tracker.received(header, meta)
+
+        if header.codec == frame_protocol.CODEC_H264:
+            # Decode the H.264 access unit (may yield no picture yet)
+            if h264_decoder is None:
+                h264_decoder = h264_stream.create_decoder(H264_DECODER)
+            frames = h264_decoder.decode(frame_data)
+            if not frames:
+                continue
+            frame = frames[-1]
+        else:
+            # Decode the received JPEG
+            buffer = np.frombuffer(frame_data, dtype=np.uint8)
+            frame = cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+        if frame is None:
+            tracker.dropped("decode")
+            continue
+        sample.mark("decode")
 
         # Display the frame using OpenCV
         cv2.imshow("Received Frame", frame)
+        sample.mark("display")
+        tracker.finish(sample)
         if cv2.waitKey(1) & 0xFF == ord('q'):
             break
 except Exception as e:
@@ -54,3 +54,5 @@ except Exception as e:
 finally:
     client_socket.close()
     cv2.destroyAllWindows()
+    print(tracker.format_report())
+    tracker.write_report(LATENCY_REPORT)
@@ -1,7 +1,7 @@
 import socket
-import pickle
-import struct
 import cv2
+import numpy as np
+from frame_receiver import FrameReceiver
 
 SERVER_IP = '192.168.1.184'
 SERVER_PORT = 8485
@@ -9,8 +9,7 @@ SERVER_PORT = 8485
 client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 client_socket.connect((SERVER_IP, SERVER_PORT))
 
-data = b""
-payload_size = struct.calcsize("L")
+receiver = FrameReceiver(client_socket, ack=True)  # acks let the server adapt quality
 
 # Create a named window and set it to full screen
 window_name = "Received Frame"
@@ -19,25 +18,9 @@ cv2.namedWindow(window_name, cv2.WINDOW_NORMAL)
 
 try:
     while True:
-        while len(data) < payload_size:
-            packet = client_socket.recv(4096)
-            if not packet:
-                raise ConnectionError("Socket connection closed")
-            data += packet
-
-        packed_msg_size = data[:payload_size]
-        data = data[payload_size:]
-        msg_size = struct.unpack("L", packed_msg_size)[0]
-
-        while len(data) < msg_size:
-            packet = client_socket.recv(4096)
-            if not packet:
-                raise ConnectionError("Socket connection closed during frame reception")
-            data += packet
-
-        frame_data = data[:msg_size]
-        data = data[msg_size:]
-        frame = pickle.loads(frame_data)
+        header, meta, frame_data = receiver.recv_frame()
+        buffer = np.frombuffer(frame_data, dtype=np.uint8)
+        frame = cv2.imdecode(buffer, cv2.IMREAD_COLOR)
 
         # Optionally, resize frame to match your monitor resolution (if needed)
         monitor_width, monitor_height = 1920, 1080
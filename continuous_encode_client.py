@@ -1,12 +1,16 @@
 import socket
-import pickle
-import struct
 import cv2
+import numpy as np
+import frame_protocol
+import h264_stream
+from frame_receiver import FrameReceiver
+import latency
 import time
 
 SERVER_IP = '192.168.1.184'
 SERVER_PORT = 8485
-payload_size = struct.calcsize("L")
+H264_DECODER = "pyav"  # Used when the server streams H.264 (see h264_stream.DECODERS)
+LATENCY_REPORT = "latency_report.json"  # Written on exit
 
 # Attempt to use Tkinter to get monitor dimensions; default to 1920x1080 if not available.
 try:
@@ -23,6 +27,10 @@ window_name = "Received Frame"
 cv2.namedWindow(window_name, cv2.WINDOW_NORMAL)
 cv2.resizeWindow(window_name, monitor_width, monitor_height)
 
+# Per-hop latency (capture -> ... -> display) and drop counters
+tracker = latency.LatencyTracker()
+latency_p50 = None
+
 while True:
     try:
         #print("Attempting to connect to the server...")
@@ -30,7 +38,9 @@ while True:
         client_socket.connect((SERVER_IP, SERVER_PORT))
         print("Connected to the server.")
 
-        data = b""
+        receiver = FrameReceiver(client_socket, ack=True)  # acks let the server adapt quality
+        h264_decoder = None  # New decoder per connection; the server resyncs us on a keyframe
+        tracker.new_stream()
         # Variables to track FPS
         frame_count = 0
         start_time = time.time()
@@ -38,30 +48,26 @@ while True:
 
         # Main loop to receive frames
         while True:
-            # Retrieve message size (header)
-            while len(data) < payload_size:
-                packet = client_socket.recv(4096)
-                if not packet:
-                    raise ConnectionError("Socket connection closed")
-                data += packet
-
-            packed_msg_size = data[:payload_size]
-            data = data[payload_size:]
-            msg_size = struct.unpack("L", packed_msg_size)[0]
-
-            # Retrieve the full frame based on the message size
-            while len(data) < msg_size:
-                packet = client_socket.recv(4096)
-                if not packet:
-                    raise ConnectionError("Socket connection closed during frame reception")
-                data += packet
-
-            frame_data = data[:msg_size]
-            data = data[msg_size:]
+            # Receive the next frame (header + encoded frame) into the reusable buffer
+            header, meta, frame_data = receiver.recv_frame()
+            sample = tracker.received(header, meta)
 
-            # Unpickle the JPEG buffer and decode the frame
-            buffer = pickle.loads(frame_data)
-            frame = cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+            if header.codec == frame_protocol.CODEC_H264:
+                # Decode the H.264 access unit (may yield no picture yet)
+                if h264_decoder is None:
+                    h264_decoder = h264_stream.create_decoder(H264_DECODER)
+                frames = h264_decoder.decode(frame_data)
+                if not frames:
+                    continue
+                frame = frames[-1]
+            else:
+                # Decode the JPEG payload
+                buffer = np.frombuffer(frame_data, dtype=np.uint8)
+                frame = cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+            if frame is None:
+                tracker.dropped("decode")
+                continue
+            sample.mark("decode")
             # Convert frame from BGR to RGB
             frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
             # Resize the frame to the calculated window size
@@ -74,12 +80,19 @@ while True:
                 fps = frame_count / elapsed_time
                 frame_count = 0
                 start_time = time.time()
+                total = tracker.summary("total")
+                latency_p50 = total["p50_ms"] if total else None
 
-            # Overlay the FPS on the frame
+            # Overlay the FPS and median glass-to-glass latency on the frame
             cv2.putText(frame, f"FPS: {fps:.2f}", (10, 30),
                         cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
+            if latency_p50 is not None:
+                cv2.putText(frame, f"Latency p50: {latency_p50:.0f} ms", (10, 65),
+                            cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
 
             cv2.imshow(window_name, frame)
+            sample.mark("display")
+            tracker.finish(sample)
             if cv2.waitKey(1) & 0xFF == ord('q'):
                 raise KeyboardInterrupt
 
@@ -101,3 +114,5 @@ while True:
             pass
 
 cv2.destroyAllWindows()
+print(tracker.format_report())
+tracker.write_report(LATENCY_REPORT)
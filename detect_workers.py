@@ -0,0 +1,266 @@
+"""
+Detection on a pool of worker processes fed through shared memory.
+
+The threshold / morphology / contour pass runs on one core: OpenCV releases
+the GIL inside each call, but the pipeline still has one detect thread, and
+more threads would fight over the GIL between calls. DetectionPool runs a
+Detector (detection.py) in each of several worker processes instead.
+
+Frames never go through pickle. The pool owns one
+multiprocessing.shared_memory block split into fixed-size slots; submit()
+copies the frame into a free slot (one memcpy) and sends the workers only
+(seq, slot, shape, dtype), each worker over its own pipe. A worker runs its
+detector on an ndarray view of the slot and sends back the small result
+(ROI, contours, objects, circles), which frees the slot. collect(seq) returns results in the order
+they were submitted, however the workers finish.
+
+    pool = DetectionPool(make_detector, workers=4, slot_bytes=480 * 853 * 4)
+    pool.start()                        # before any other threads exist (fork)
+    ...
+    if pool.submit(seq, frame, timeout=0.5):   # False: no slot came free in time
+        result = pool.collect(seq)      # None if it failed or timed out
+        result.objects
+
+make_detector() is called once in each worker to build its Detector, so the
+stages' preallocated buffers live in the worker. Workers are forked: start
+the pool early, before the camera and the other threads are running.
+
+A worker can die (OOM killer, a crash inside OpenCV). Its frames would
+keep their slots forever, and with every slot gone submit() would block
+for good; a worker killed inside a shared multiprocessing.Queue can even
+leave the queue's lock held for all the others. So every worker has its
+own pipe and the pool knows which slots it holds: when the result reader
+sees a worker's pipe close (or the process gone), its frames are failed
+(collect() returns None for them), their slots are freed and a new
+worker is forked in its place.
+"""
+import collections
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from multiprocessing import connection, shared_memory
+
+import cv2
+import numpy as np
+
+DEFAULT_TIMEOUT = 2.0  # seconds collect() waits for a result
+
+
+class WorkerResult(object):
+    """What a worker sends back for one frame (no pixels)."""
+
+    __slots__ = ("seq", "roi", "origin", "contours", "objects", "circles", "seconds")
+
+    def __init__(self, seq, detection, seconds):
+        self.seq = seq
+        self.roi = detection.roi
+        self.origin = detection.origin
+        self.contours = detection.contours
+        self.objects = detection.objects
+        self.circles = detection.circles
+        self.seconds = seconds  # detection time in the worker
+
+    def apply(self, detection):
+        """Copy the results into a local Detection (e.g. to run an Annotate stage on it)."""
+        detection.roi = self.roi
+        detection.origin = self.origin
+        detection.contours = self.contours
+        detection.objects = self.objects
+        detection.circles = self.circles
+        return detection
+
+
+def _worker_main(make_detector, shm, slot_bytes, conn):
+    # `shm` is the parent's block, inherited through fork (attaching by name
+    # would register it with the resource tracker a second time).
+    cv2.setNumThreads(1)  # one core per worker; the pool is the parallelism
+    try:
+        detector = make_detector()
+        while True:
+            task = conn.recv()
+            if task is None:
+                break
+            seq, slot, shape, dtype = task
+            frame = np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=slot * slot_bytes)
+            start = time.perf_counter()
+            try:
+                result = WorkerResult(seq, detector.run(frame), time.perf_counter() - start)
+            except Exception as e:
+                print("Detection worker", os.getpid(), "failed on frame", seq, ":", e)
+                result = None
+            # Release the view before the slot is reused (the Detector keeps only
+            # results across frames, see Detection.results()).
+            del frame
+            conn.send((slot, seq, result))
+    except (KeyboardInterrupt, EOFError):
+        pass
+
+
+class _Worker(object):
+    def __init__(self, process, conn):
+        self.process = process
+        self.conn = conn            # parent end of the worker's pipe
+        self.in_flight = {}         # slot -> seq sent to this worker
+
+
+class DetectionPool(object):
+    def __init__(self, make_detector, workers=4, slot_bytes=480 * 853 * 4, slots=None):
+        self.make_detector = make_detector
+        self.num_workers = workers
+        self.slot_bytes = slot_bytes
+        self.num_slots = slots or 2 * workers  # frames in flight
+        self._ctx = multiprocessing.get_context("fork")
+        self._shm = None
+        self._free = queue.Queue()
+        self._workers = []
+        self._reader = None
+        self._cond = threading.Condition()
+        self._done = {}                         # seq -> WorkerResult (None: failed)
+        self._pending = collections.deque()     # seqs submitted, in order
+        self._collected = None                  # last seq collect() returned for
+        self._closing = False
+        self.frames_submitted = 0
+        self.frames_collected = 0
+        self.frames_dropped = 0                 # results nobody collected
+        self.worker_time = 0.0
+        self.workers_restarted = 0
+
+    def _spawn(self):
+        conn, child_conn = self._ctx.Pipe()
+        process = self._ctx.Process(target=_worker_main, daemon=True,
+                                    args=(self.make_detector, self._shm, self.slot_bytes, child_conn))
+        process.start()
+        child_conn.close()  # so the parent end sees EOF when the worker dies
+        return _Worker(process, conn)
+
+    def start(self):
+        self._shm = shared_memory.SharedMemory(create=True, size=self.slot_bytes * self.num_slots)
+        for slot in range(self.num_slots):
+            self._free.put(slot)
+        for _ in range(self.num_workers):
+            self._workers.append(self._spawn())
+        self._reader = threading.Thread(target=self._read_results, daemon=True)
+        self._reader.start()
+        return self
+
+    def submit(self, seq, frame, timeout=None):
+        """
+        Copy `frame` into a free slot and send it to the least busy worker.
+        seqs must increase. Returns False if no slot freed up within `timeout`.
+        """
+        if frame.nbytes > self.slot_bytes:
+            raise ValueError("Frame of %d bytes does not fit a %d byte slot" % (frame.nbytes, self.slot_bytes))
+        try:
+            slot = self._free.get(timeout=timeout)
+        except queue.Empty:
+            return False
+        view = np.ndarray(frame.shape, dtype=frame.dtype, buffer=self._shm.buf, offset=slot * self.slot_bytes)
+        np.copyto(view, frame)
+        del view
+        with self._cond:
+            worker = min(self._workers, key=lambda w: len(w.in_flight))
+            worker.in_flight[slot] = seq
+            self._pending.append(seq)
+            try:
+                worker.conn.send((seq, slot, frame.shape, frame.dtype.str))
+            except (BrokenPipeError, OSError):
+                pass  # the worker just died; the reader fails the frame and frees the slot
+        self.frames_submitted += 1
+        return True
+
+    def _worker_died(self, worker):
+        """Fail a dead worker's frames, free their slots and start a replacement. Call with _cond held."""
+        print("Detection worker", worker.process.pid, "died (exit code %s), starting a new one"
+              % worker.process.exitcode)
+        worker.conn.close()
+        for slot, seq in worker.in_flight.items():
+            if self._collected is None or seq > self._collected:
+                self._done[seq] = None
+            self._free.put(slot)
+        worker.in_flight.clear()
+        self._cond.notify_all()
+        # Forked from a process that already runs threads; the worker only uses numpy and OpenCV.
+        self._workers[self._workers.index(worker)] = self._spawn()
+        self.workers_restarted += 1
+
+    def _read_results(self):
+        while not self._closing:
+            with self._cond:
+                conns = {worker.conn: worker for worker in self._workers}
+            for conn in connection.wait(list(conns), timeout=0.5):
+                worker = conns[conn]
+                try:
+                    slot, seq, result = conn.recv()
+                except (EOFError, OSError):
+                    worker.process.join(timeout=1.0)
+                    with self._cond:
+                        if not self._closing:
+                            self._worker_died(worker)
+                    continue
+                with self._cond:
+                    worker.in_flight.pop(slot, None)
+                    self._free.put(slot)
+                    if result is not None:
+                        self.worker_time += result.seconds
+                    if self._collected is not None and seq <= self._collected:
+                        self.frames_dropped += 1  # too late, collect() gave up on it
+                        continue
+                    self._done[seq] = result
+                    self._cond.notify_all()
+            with self._cond:
+                # A worker that is gone although its pipe stayed open (inherited by a child of its own).
+                for worker in list(self._workers):
+                    if not self._closing and not worker.process.is_alive():
+                        self._worker_died(worker)
+
+    def collect(self, seq, timeout=DEFAULT_TIMEOUT):
+        """
+        The result for `seq` (a WorkerResult, or None if detection failed, its
+        worker died or it didn't finish within `timeout`). Results of older
+        frames that were never collected are discarded, so results always
+        come out in order.
+        """
+        deadline = time.perf_counter() + timeout
+        with self._cond:
+            while seq not in self._done:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            result = self._done.pop(seq, None)
+            while self._pending and self._pending[0] <= seq:
+                old = self._pending.popleft()
+                if old != seq and self._done.pop(old, None) is not None:
+                    self.frames_dropped += 1
+            self._collected = seq
+            self.frames_collected += 1
+            return result
+
+    @property
+    def in_flight(self):
+        with self._cond:
+            return len(self._pending)
+
+    def close(self):
+        with self._cond:
+            self._closing = True
+            workers = list(self._workers)
+        for worker in workers:
+            try:
+                worker.conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        for worker in workers:
+            worker.process.join(timeout=2.0)
+            if worker.process.is_alive():
+                worker.process.terminate()
+        if self._reader is not None:
+            self._reader.join(timeout=2.0)
+        for worker in workers:
+            worker.conn.close()
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
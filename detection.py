@@ -0,0 +1,487 @@
+"""
+Detection as an ordered list of stages, run on the region of interest only.
+
+sockets/server.py and s7.py resized the whole frame to 480 lines, drew the
+ROI rectangle into it (so the blue border ended up inside the ROI they then
+thresholded), cropped, copied the ROI for debug drawing and copied that back
+into the frame. A Detector instead runs a list of stages on a Detection:
+
+    detector = Detector([
+        Crop(roi=(ROI_X1, ROI_Y1, ROI_X2, ROI_Y2), height=480),
+        Gray(),
+        Blur((5, 5)),
+        AdaptiveThreshold(block_size=11, c=7),
+        Morphology(cv2.MORPH_OPEN, np.ones((3, 3), np.uint8)),
+        Contours(),
+        FilterByArea(1000),
+        Annotate(),                 # optional debug drawing
+    ])
+    detection = detector.run(frame, display=small_frame)
+    detection.objects               # [(x, y, w, h), ...] relative to the ROI
+
+Coordinates (the ROI, objects, circles) are in "processing" coordinates:
+the frame scaled to `height` lines, as before. Crop takes the ROI from the
+display frame when that already is at processing size (a free view), and
+otherwise crops the ROI out of the full-resolution frame and resizes only
+that, so detection never scales anything outside the ROI. s7.py and
+server.py still resize the whole frame once, because they stream all of it
+at 480 lines; both skip capture altogether when nothing consumes the
+stream, so that resize is never wasted. Detection then reads its ROI from
+that frame for free. A caller that doesn't stream the frame passes
+display=None and gets the ROI-only resize.
+
+Every stage writes into output buffers it allocated on the first frame and
+reuses through OpenCV's dst= arguments, so steady-state detection allocates
+no images. Annotate draws straight onto the display frame (contours with an
+offset) instead of round-tripping a copy of the ROI. The Detector times
+each stage; report() shows where detection time goes, and
+metrics.observe_detector() puts the same timings on /metrics.
+
+A MotionGate right after Crop skips the expensive stages while the ROI
+hasn't changed since the last full detection and reuses that result, which
+is most frames of a static scene. Stages with `always = True` (Annotate)
+still run on gated frames. tracking.TrackedSearch goes one step further on
+changing scenes: it runs the threshold/contour stages only in windows
+around the objects it is tracking. CoarseToFineHough does the same for
+circles: candidates from a pyramid level, confirmed in small
+full-resolution windows, instead of a HoughCircles over the whole frame.
+
+A stage is any callable taking the Detection; subclass Stage for buffers.
+"""
+import time
+
+import cv2
+import numpy as np
+
+
+class Detection(object):
+    """Per-frame state handed from stage to stage."""
+
+    def __init__(self, frame, display=None):
+        self.frame = frame          # the frame as captured
+        self.display = display      # frame at processing size for annotation, or None
+        self.image = frame          # current working image; each stage replaces it
+        self.scale = 1.0            # processing pixels per captured pixel
+        self.origin = (0, 0)        # ROI top-left in processing coordinates
+        self.roi = None             # (x1, y1, x2, y2) in processing coordinates
+        self.contours = []
+        self.objects = []           # (x, y, w, h) relative to the ROI
+        self.circles = None         # int array of (x, y, r) in processing coordinates, or None
+        self.tracks = []            # tracking.Track list (set by tracking.TrackedSearch)
+        self.windows = None         # (x1, y1, x2, y2) search windows relative to the ROI, or None
+        self.previous = None        # the last fully computed Detection of this Detector
+        self.reused = False         # set by MotionGate: results copied from `previous`
+
+    def results(self):
+        """A copy without the frame, display and working image, to keep across frames."""
+        copy = Detection(None)
+        copy.__dict__.update(self.__dict__)
+        copy.frame = copy.display = copy.image = None
+        return copy
+
+
+class Stage(object):
+    """Base class for stages that keep reusable output buffers."""
+
+    name = "stage"  # for reports and metrics
+    always = False  # True: also runs on frames a MotionGate reuses the previous result for
+
+    def __init__(self):
+        self._buffers = {}
+
+    def buffer(self, name, shape, dtype=np.uint8):
+        """A preallocated array of `shape`, reused from frame to frame."""
+        buf = self._buffers.get(name)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = self._buffers[name] = np.empty(shape, dtype)
+        return buf
+
+    def __call__(self, detection):
+        raise NotImplementedError
+
+
+# -------------------------------
+# Image stages
+# -------------------------------
+class Crop(Stage):
+    """
+    Cut out the ROI at processing size (`height` lines for the whole frame).
+    roi=None keeps the whole frame.
+    """
+
+    name = "crop"
+
+    def __init__(self, roi=None, height=480, interpolation=cv2.INTER_LINEAR):
+        super(Crop, self).__init__()
+        self.roi = roi
+        self.height = height
+        self.interpolation = interpolation
+
+    def __call__(self, detection):
+        frame, display = detection.frame, detection.display
+        scale = self.height / float(frame.shape[0]) if self.height else 1.0
+        width = int(frame.shape[1] * scale)
+        x1, y1, x2, y2 = self.roi if self.roi is not None else (0, 0, width, self.height or frame.shape[0])
+        x1, y1 = max(x1, 0), max(y1, 0)
+        x2, y2 = min(x2, width), min(y2, self.height or frame.shape[0])
+        detection.scale = scale
+        detection.origin = (x1, y1)
+        detection.roi = (x1, y1, x2, y2)
+        if display is not None and display.shape[0] == (self.height or frame.shape[0]):
+            detection.image = display[y1:y2, x1:x2]
+        elif scale == 1.0:
+            detection.image = frame[y1:y2, x1:x2]
+        else:
+            # Only the source pixels under the ROI get resized.
+            sx1, sy1 = int(x1 / scale), int(y1 / scale)
+            sx2, sy2 = int(round(x2 / scale)), int(round(y2 / scale))
+            out = self.buffer("roi", (y2 - y1, x2 - x1) + frame.shape[2:], frame.dtype)
+            detection.image = cv2.resize(frame[sy1:sy2, sx1:sx2], (x2 - x1, y2 - y1), dst=out,
+                                         interpolation=self.interpolation)
+
+
+class Gray(Stage):
+    name = "gray"
+
+    def __call__(self, detection):
+        image = detection.image
+        if image.ndim == 2:
+            return
+        out = self.buffer("gray", image.shape[:2])
+        detection.image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=out)
+
+
+class Blur(Stage):
+    name = "blur"
+
+    def __init__(self, ksize=(5, 5), sigma=0):
+        super(Blur, self).__init__()
+        self.ksize = ksize
+        self.sigma = sigma
+
+    def __call__(self, detection):
+        image = detection.image
+        out = self.buffer("blur", image.shape, image.dtype)
+        detection.image = cv2.GaussianBlur(image, self.ksize, self.sigma, dst=out)
+
+
+class AdaptiveThreshold(Stage):
+    """Adaptive mean threshold; inverse=True makes dark objects on a light background white."""
+
+    name = "threshold"
+
+    def __init__(self, block_size=11, c=2, method=cv2.ADAPTIVE_THRESH_MEAN_C, inverse=True):
+        super(AdaptiveThreshold, self).__init__()
+        self.block_size = block_size
+        self.c = c
+        self.method = method
+        self.threshold_type = cv2.THRESH_BINARY_INV if inverse else cv2.THRESH_BINARY
+
+    def __call__(self, detection):
+        image = detection.image
+        out = self.buffer("thresh", image.shape)
+        detection.image = cv2.adaptiveThreshold(image, 255, self.method, self.threshold_type,
+                                                self.block_size, self.c, dst=out)
+
+
+class Morphology(Stage):
+    name = "morphology"
+
+    def __init__(self, op=cv2.MORPH_OPEN, kernel=None, iterations=1):
+        super(Morphology, self).__init__()
+        self.op = op
+        self.kernel = kernel if kernel is not None else np.ones((3, 3), np.uint8)
+        self.iterations = iterations
+
+    def __call__(self, detection):
+        image = detection.image
+        out = self.buffer("morph", image.shape, image.dtype)
+        detection.image = cv2.morphologyEx(image, self.op, self.kernel, dst=out, iterations=self.iterations)
+
+
+class MotionGate(Stage):
+    """
+    Reuse the previous result while the ROI is unchanged. Compares a
+    downsampled gray copy of the ROI with the one from the last full
+    detection: if fewer than `min_fraction` of its pixels moved by more than
+    `pixel_threshold` grey levels, the frame is marked reused and the later
+    stages (except `always` ones) are skipped. Comparing with the last
+    detected frame, not the previous frame, means slow changes still add up
+    to a redetection. Every `refresh_frames` gated frames a full detection
+    runs anyway.
+    """
+
+    name = "motion_gate"
+
+    def __init__(self, pixel_threshold=20, min_fraction=0.005, downsample=8, refresh_frames=150):
+        super(MotionGate, self).__init__()
+        self.pixel_threshold = pixel_threshold
+        self.min_fraction = min_fraction
+        self.downsample = downsample
+        self.refresh_frames = refresh_frames
+        self._reference = None
+        self._skipped = 0
+        self.frames_gated = 0
+
+    def __call__(self, detection):
+        image = detection.image
+        h, w = image.shape[:2]
+        size = (max(1, w // self.downsample), max(1, h // self.downsample))
+        # INTER_LINEAR point-samples at this scale (INTER_AREA costs more than
+        # the detection it would save); pixel_threshold absorbs the noise.
+        small = cv2.resize(image, size, dst=self.buffer("small", (size[1], size[0]) + image.shape[2:], image.dtype),
+                           interpolation=cv2.INTER_LINEAR)
+        if small.ndim == 3:
+            small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY, dst=self.buffer("small_gray", small.shape[:2]))
+        previous = detection.previous
+        reference = self._reference
+        if (previous is not None and reference is not None and reference.shape == small.shape
+                and self._skipped < self.refresh_frames):
+            diff = cv2.absdiff(small, reference, dst=self.buffer("diff", small.shape))
+            cv2.threshold(diff, self.pixel_threshold, 255, cv2.THRESH_BINARY, dst=diff)
+            if cv2.countNonZero(diff) < self.min_fraction * diff.size:
+                detection.reused = True
+                detection.contours = previous.contours
+                detection.objects = previous.objects
+                detection.circles = previous.circles
+                detection.tracks = previous.tracks
+                self._skipped += 1
+                self.frames_gated += 1
+                return
+        # Changed (or nothing to compare with): this frame becomes the reference.
+        if reference is None or reference.shape != small.shape:
+            reference = self._reference = np.empty_like(small)
+        np.copyto(reference, small)
+        self._skipped = 0
+
+
+# -------------------------------
+# Feature stages
+# -------------------------------
+class Contours(Stage):
+    name = "contours"
+
+    def __init__(self, mode=cv2.RETR_EXTERNAL, method=cv2.CHAIN_APPROX_SIMPLE):
+        super(Contours, self).__init__()
+        self.mode = mode
+        self.method = method
+
+    def __call__(self, detection):
+        # OpenCV 4 leaves the input image alone, no defensive copy needed.
+        detection.contours, _ = cv2.findContours(detection.image, self.mode, self.method)
+
+
+class FilterByArea(Stage):
+    """Bounding boxes of the contours larger than `min_area` pixels."""
+
+    name = "filter"
+
+    def __init__(self, min_area=1000):
+        super(FilterByArea, self).__init__()
+        self.min_area = min_area
+
+    def __call__(self, detection):
+        detection.objects = [cv2.boundingRect(cnt) for cnt in detection.contours
+                             if cv2.contourArea(cnt) > self.min_area]
+
+
+class HoughCircles(Stage):
+    """cv2.HoughCircles on the working image (gray, usually blurred); circles in processing coordinates."""
+
+    name = "hough"
+
+    def __init__(self, dp=1.2, min_dist=50, param1=100, param2=30, min_radius=10, max_radius=0):
+        super(HoughCircles, self).__init__()
+        self.dp = dp
+        self.min_dist = min_dist
+        self.param1 = param1
+        self.param2 = param2
+        self.min_radius = min_radius
+        self.max_radius = max_radius  # 0: no upper limit (slowest)
+
+    def __call__(self, detection):
+        circles = cv2.HoughCircles(detection.image, cv2.HOUGH_GRADIENT, dp=self.dp, minDist=self.min_dist,
+                                   param1=self.param1, param2=self.param2,
+                                   minRadius=self.min_radius, maxRadius=self.max_radius)
+        if circles is None:
+            detection.circles = None
+            return
+        circles = np.round(circles[0, :]).astype("int")
+        circles[:, 0] += detection.origin[0]
+        circles[:, 1] += detection.origin[1]
+        detection.circles = circles
+
+
+class CoarseToFineHough(HoughCircles):
+    """
+    HoughCircles in two passes. The coarse pass runs on the image
+    pyrDown'ed up to `levels` times (fewer if the smallest radius searched
+    would drop below `min_coarse_radius` pixels there), with the lower
+    `coarse_param2` so faint circles still become candidates. Each
+    candidate is then confirmed and refined at full resolution in a window
+    just around it, with the radius limited to the candidate's +-
+    `refine_margin` pixels; candidates that don't confirm are dropped.
+
+    The radius range comes from the previous frame's circles (+- `radius_slack`)
+    while there are any; the configured min_radius..max_radius range is
+    searched again every `prior_frames` frames and as soon as nothing is
+    found, so circles of a new size are picked up within that many frames.
+    """
+
+    name = "hough"
+
+    def __init__(self, dp=1.2, min_dist=50, param1=100, param2=30, min_radius=10, max_radius=0,
+                 levels=2, min_coarse_radius=5, coarse_param2=15, refine_margin=6, radius_slack=0.25,
+                 prior_frames=30):
+        super(CoarseToFineHough, self).__init__(dp, min_dist, param1, param2, min_radius, max_radius)
+        self.levels = levels
+        self.min_coarse_radius = min_coarse_radius
+        self.coarse_param2 = coarse_param2
+        self.refine_margin = refine_margin
+        self.radius_slack = radius_slack
+        self.prior_frames = prior_frames
+        self._prior = None          # (min, max) radius found on the previous frame
+        self._since_full = 0
+        self.candidates = 0         # coarse circles, for tuning coarse_param2
+        self.confirmed = 0
+
+    def _radius_range(self, image):
+        full_max = self.max_radius or min(image.shape[:2]) // 2
+        if self._prior is None or self._since_full >= self.prior_frames:
+            self._since_full = 0
+            return self.min_radius, full_max
+        self._since_full += 1
+        lo, hi = self._prior
+        return (max(self.min_radius, int(lo * (1 - self.radius_slack))),
+                min(full_max, int(np.ceil(hi * (1 + self.radius_slack)))))
+
+    def __call__(self, detection):
+        image = detection.image
+        min_r, max_r = self._radius_range(image)
+        coarse, levels = image, 0
+        while levels < self.levels and min_r >> (levels + 1) >= self.min_coarse_radius:
+            shape = ((coarse.shape[0] + 1) // 2, (coarse.shape[1] + 1) // 2)
+            coarse = cv2.pyrDown(coarse, dst=self.buffer("level%d" % levels, shape, image.dtype))
+            levels += 1
+        factor = 1 << levels
+        found = cv2.HoughCircles(coarse, cv2.HOUGH_GRADIENT, dp=1, minDist=max(1, self.min_dist / factor),
+                                 param1=self.param1, param2=self.coarse_param2,
+                                 minRadius=max(1, min_r // factor), maxRadius=max_r // factor + 1)
+        circles = []
+        if found is not None:
+            height, width = image.shape[:2]
+            for cx, cy, cr in found[0]:
+                self.candidates += 1
+                x, y, r = int(round(cx * factor)), int(round(cy * factor)), int(round(cr * factor))
+                margin = self.refine_margin + factor  # plus the coarse pass's quantisation
+                reach = r + 2 * margin
+                x1, y1 = max(x - reach, 0), max(y - reach, 0)
+                x2, y2 = min(x + reach + 1, width), min(y + reach + 1, height)
+                refined = cv2.HoughCircles(image[y1:y2, x1:x2], cv2.HOUGH_GRADIENT, dp=1, minDist=reach,
+                                           param1=self.param1, param2=self.param2,
+                                           minRadius=max(1, r - margin), maxRadius=r + margin)
+                if refined is None:
+                    continue
+                fx, fy, fr = refined[0, 0]
+                fx, fy = fx + x1, fy + y1
+                if all((fx - ox) ** 2 + (fy - oy) ** 2 >= self.min_dist ** 2 for ox, oy, _ in circles):
+                    circles.append((fx, fy, fr))
+        self.confirmed += len(circles)
+        if not circles:
+            self._prior = None
+            detection.circles = None
+            return
+        circles = np.round(np.array(circles)).astype("int")
+        self._prior = (circles[:, 2].min(), circles[:, 2].max())
+        circles[:, 0] += detection.origin[0]
+        circles[:, 1] += detection.origin[1]
+        detection.circles = circles
+
+
+# -------------------------------
+# Debug annotation
+# -------------------------------
+class Annotate(Stage):
+    """
+    Draw the ROI, contours, object boxes and circles onto the display frame
+    (if there is one), and TrackedSearch's windows and track ids.
+    """
+
+    name = "annotate"
+    always = True
+
+    def __init__(self, roi=True, contours=True, tracks=True):
+        super(Annotate, self).__init__()
+        self.draw_roi = roi
+        self.draw_contours = contours
+        self.draw_tracks = tracks
+
+    def __call__(self, detection):
+        display = detection.display
+        if display is None:
+            return
+        ox, oy = detection.origin
+        if self.draw_roi and detection.roi is not None:
+            x1, y1, x2, y2 = detection.roi
+            cv2.rectangle(display, (x1, y1), (x2, y2), (255, 0, 0), 2)
+        if self.draw_contours and len(detection.contours):
+            cv2.drawContours(display, detection.contours, -1, (0, 255, 0), 2, offset=(ox, oy))
+        for (x, y, w, h) in detection.objects:
+            cv2.rectangle(display, (ox + x, oy + y), (ox + x + w, oy + y + h), (0, 0, 255), 2)
+        if detection.circles is not None:
+            for (x, y, r) in detection.circles:
+                cv2.circle(display, (x, y), r, (0, 255, 0), 2)
+                cv2.circle(display, (x, y), 3, (0, 0, 255), -1)
+        if self.draw_tracks:
+            for (x1, y1, x2, y2) in detection.windows or ():
+                cv2.rectangle(display, (ox + x1, oy + y1), (ox + x2, oy + y2), (0, 255, 255), 1)
+            for track in detection.tracks:
+                x, y = track.box[:2]
+                cv2.putText(display, str(track.id), (ox + x, oy + y - 4), cv2.FONT_HERSHEY_SIMPLEX,
+                            0.5, (0, 0, 255), 1)
+
+
+class Detector(object):
+    def __init__(self, stages):
+        self.stages = list(stages)
+        self.frames = 0
+        self.stage_time = [0.0] * len(self.stages)
+        self.histograms = None  # one metrics.Histogram per stage, set by metrics.observe_detector()
+        self.frames_reused = 0
+        self._last = None       # results of the last Detection that ran every stage
+
+    def run(self, frame, display=None):
+        """Run every stage on `frame`; annotations go onto `display`. Returns the Detection."""
+        detection = Detection(frame, display)
+        detection.previous = self._last
+        stage_time = self.stage_time
+        histograms = self.histograms
+        t0 = time.perf_counter()
+        for i, stage in enumerate(self.stages):
+            if detection.reused and not getattr(stage, "always", False):
+                continue
+            stage(detection)
+            t1 = time.perf_counter()
+            stage_time[i] += t1 - t0
+            if histograms is not None:
+                histograms[i].observe(t1 - t0)
+            t0 = t1
+        self.frames += 1
+        detection.previous = None  # don't chain every Detection ever made
+        if detection.reused:
+            self.frames_reused += 1
+        else:
+            # Only the results: the frame may be a view of a buffer the caller reuses
+            # (a detect_workers shared-memory slot).
+            self._last = detection.results()
+        return detection
+
+    def stage_names(self):
+        return [getattr(stage, "name", type(stage).__name__.lower()) for stage in self.stages]
+
+    def report(self):
+        """Average time per frame of each stage, one line each."""
+        if not self.frames:
+            return ""
+        return "\n".join("%-18s %7.2f ms" % (name, 1000.0 * total / self.frames)
+                         for name, total in zip(self.stage_names(), self.stage_time))
@@ -1,7 +1,7 @@
 import socket
-import pickle
-import struct
 import cv2
+import numpy as np
+from frame_receiver import FrameReceiver
 import time
 
 SERVER_IP = '192.168.1.184'
@@ -11,8 +11,7 @@ SERVER_PORT = 8485
 client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 client_socket.connect((SERVER_IP, SERVER_PORT))
 
-data = b""
-payload_size = struct.calcsize("L")
+receiver = FrameReceiver(client_socket, ack=True)  # acks let the server adapt quality
 
 # Set up the full screen window
 window_name = "Received Frame"
@@ -26,29 +25,11 @@ fps = 0
 
 try:
     while True:
-        # Retrieve message size (header)
-        while len(data) < payload_size:
-            packet = client_socket.recv(4096)
-            if not packet:
-                raise ConnectionError("Socket connection closed")
-            data += packet
+        # Receive the next frame (header + JPEG) into the reusable buffer
+        header, meta, frame_data = receiver.recv_frame()
 
-        packed_msg_size = data[:payload_size]
-        data = data[payload_size:]
-        msg_size = struct.unpack("L", packed_msg_size)[0]
-
-        # Retrieve the full frame based on the message size
-        while len(data) < msg_size:
-            packet = client_socket.recv(4096)
-            if not packet:
-                raise ConnectionError("Socket connection closed during frame reception")
-            data += packet
-
-        frame_data = data[:msg_size]
-        data = data[msg_size:]
-
-        # Unpickle the JPEG buffer and decode the frame
-        buffer = pickle.loads(frame_data)
+        # Decode the JPEG payload
+        buffer = np.frombuffer(frame_data, dtype=np.uint8)
         frame = cv2.imdecode(buffer, cv2.IMREAD_COLOR)
         #convert frame from BGR to RGB
         frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
@@ -0,0 +1,202 @@
+"""
+Pre-event ring buffer with triggered clip export.
+
+Continuous recording is too slow for the Pi's SD card and wears it out, but
+an event is only useful with the seconds leading up to it. ClipRecorder
+keeps the most recent encoded frames (JPEG buffers plus their detection
+metadata) in RAM, capped both by a byte budget and by duration. trigger()
+turns that pre-roll, plus `post_seconds` of frames after the last trigger,
+into a clip on disk.
+
+All disk I/O happens on a background writer thread: add() and trigger()
+only touch in-memory structures, so the capture loop never waits for the SD
+card. If the writer falls behind by more than max_backlog_bytes, frames are
+dropped from the clip (counted in frames_dropped) rather than piling up.
+
+Each clip is two files in clip_dir:
+  clip_<date>_<time>_<seq>.mjpeg  the JPEGs back to back (ffplay -f mjpeg,
+                                  VLC, or split on the offsets below)
+  clip_<date>_<time>_<seq>.json   per-frame seq, capture time, byte offset,
+                                  size and metadata, plus the trigger times
+<date>_<time> is when the clip was triggered and <seq> the sequence number
+of its first (oldest pre-event) frame.
+
+    clips = ClipRecorder("clips", pre_seconds=5, post_seconds=5)
+    ...
+    clips.add(capture_time, jpeg, seq=seq, meta=meta)
+    if large_objects:
+        clips.trigger("large_objects")
+"""
+import collections
+import json
+import os
+import queue
+import threading
+import time
+
+DEFAULT_PRE_SECONDS = 5.0
+DEFAULT_POST_SECONDS = 5.0
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024       # pre-event ring budget
+DEFAULT_MAX_CLIP_SECONDS = 60.0            # retriggers extend a clip up to this long
+DEFAULT_MAX_BACKLOG_BYTES = 64 * 1024 * 1024
+
+
+class _Frame(object):
+    __slots__ = ("seq", "capture_time", "jpeg", "meta", "size")
+
+    def __init__(self, seq, capture_time, jpeg, meta):
+        self.seq = seq
+        self.capture_time = capture_time
+        self.jpeg = jpeg
+        self.meta = meta
+        self.size = len(jpeg)
+
+
+class Clip(object):
+    """One clip being recorded (the writer thread owns its files)."""
+
+    def __init__(self, name, start_time, end_time, reason):
+        self.name = name
+        self.start_time = start_time
+        self.end_time = end_time        # post-roll ends after this capture time
+        self.triggers = [(start_time, reason)]
+        self.frames = 0
+        self.bytes = 0
+        # Writer-thread state.
+        self.file = None
+        self.index = []
+
+
+class ClipRecorder(object):
+    def __init__(self, clip_dir, pre_seconds=DEFAULT_PRE_SECONDS, post_seconds=DEFAULT_POST_SECONDS,
+                 max_bytes=DEFAULT_MAX_BYTES, max_clip_seconds=DEFAULT_MAX_CLIP_SECONDS,
+                 max_backlog_bytes=DEFAULT_MAX_BACKLOG_BYTES):
+        self.clip_dir = clip_dir
+        self.pre_seconds = pre_seconds
+        self.post_seconds = post_seconds
+        self.max_bytes = max_bytes
+        self.max_clip_seconds = max_clip_seconds
+        self.max_backlog_bytes = max_backlog_bytes
+        self.lock = threading.Lock()
+        self.ring = collections.deque()
+        self.ring_bytes = 0
+        self.clip = None                # clip currently taking post-roll frames
+        self._last_clip_end = 0.0       # frames up to here are already in a clip
+        self.clips_written = 0
+        self.frames_dropped = 0
+        self._backlog_bytes = 0
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    # -------------------------------
+    # Capture side (never blocks on disk)
+    # -------------------------------
+    def add(self, capture_time, jpeg, seq=None, meta=None):
+        """
+        Add an encoded frame. `jpeg` is kept by reference (cv2.imencode returns a
+        fresh buffer per frame), so don't modify it afterwards.
+        """
+        frame = _Frame(seq, capture_time, jpeg, meta)
+        with self.lock:
+            self.ring.append(frame)
+            self.ring_bytes += frame.size
+            while self.ring and (self.ring_bytes > self.max_bytes or
+                                 capture_time - self.ring[0].capture_time > self.pre_seconds):
+                self.ring_bytes -= self.ring.popleft().size
+            clip = self.clip
+            if clip is not None:
+                if capture_time > clip.end_time:
+                    self.clip = None
+                    self._last_clip_end = clip.end_time
+                    self._queue.put(("end", clip, None))
+                else:
+                    self._enqueue(clip, frame)
+
+    def trigger(self, reason=None, now=None):
+        """
+        Start a clip with the pre-event frames, or extend the post-roll of the
+        one being recorded. Returns the clip.
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            clip = self.clip
+            if clip is not None:
+                clip.end_time = min(max(clip.end_time, now + self.post_seconds),
+                                    clip.start_time + self.max_clip_seconds)
+                clip.triggers.append((now, reason))
+                return clip
+            # Don't repeat the previous clip's tail.
+            pre_frames = [frame for frame in self.ring if frame.capture_time > self._last_clip_end]
+            first_seq = pre_frames[0].seq if pre_frames else 0
+            name = "clip_%s_%s" % (time.strftime("%Y%m%d_%H%M%S", time.localtime(now)), first_seq)
+            clip = self.clip = Clip(name, now, now + self.post_seconds, reason)
+            for frame in pre_frames:
+                self._enqueue(clip, frame)
+            return clip
+
+    def _enqueue(self, clip, frame):
+        """Hand a frame to the writer (lock held)."""
+        if self._backlog_bytes + frame.size > self.max_backlog_bytes:
+            self.frames_dropped += 1
+            return
+        self._backlog_bytes += frame.size
+        self._queue.put(("frame", clip, frame))
+
+    def close(self):
+        """Finish the clip being recorded and wait for the writer to flush everything."""
+        with self.lock:
+            clip, self.clip = self.clip, None
+            if clip is not None:
+                self._queue.put(("end", clip, None))
+        self._queue.put(None)
+        self._writer.join()
+
+    # -------------------------------
+    # Writer thread
+    # -------------------------------
+    def _write_loop(self):
+        while True:
+            entry = self._queue.get()
+            if entry is None:
+                break
+            kind, clip, frame = entry
+            try:
+                if kind == "frame":
+                    self._write_frame(clip, frame)
+                else:
+                    self._finish(clip)
+            except OSError as e:
+                print("Clip writer error:", e)
+            finally:
+                if frame is not None:
+                    with self.lock:
+                        self._backlog_bytes -= frame.size
+
+    def _write_frame(self, clip, frame):
+        if clip.file is None:
+            os.makedirs(self.clip_dir, exist_ok=True)
+            clip.file = open(os.path.join(self.clip_dir, clip.name + ".mjpeg"), "wb")
+        offset = clip.file.tell()
+        clip.file.write(memoryview(frame.jpeg).cast("B"))
+        clip.index.append({"seq": frame.seq, "t": frame.capture_time, "offset": offset,
+                           "size": frame.size, "meta": frame.meta})
+        clip.frames += 1
+        clip.bytes += frame.size
+
+    def _finish(self, clip):
+        if clip.file is None:
+            return  # no frames at all
+        clip.file.close()
+        index = {
+            "name": clip.name,
+            "triggers": [{"t": t, "reason": reason} for t, reason in clip.triggers],
+            "frames": clip.index,
+        }
+        path = os.path.join(self.clip_dir, clip.name + ".json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(index, f)
+        os.replace(path + ".tmp", path)
+        self.clips_written += 1
+        print("Clip written: %s (%d frames, %.1f MB)" % (clip.name, clip.frames, clip.bytes / 1e6))
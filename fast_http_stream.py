@@ -1,49 +1,83 @@
 from flask import Flask, Response
 import cv2
-from picamera2 import Picamera2
+import time
+from camera_backend import Picamera2
+from adaptive_quality import QualityController
+from camera_service import CameraService
+from async_mjpeg import AsyncMJPEGServer
 
 app = Flask(__name__)
 
-def gen_frames():
+# Serve the streams from one asyncio loop (async_mjpeg.py) instead of werkzeug's
+# thread-per-viewer server; the other routes still go to the Flask app.
+ASYNC_SERVER = False
+
+# The shared stream gets softer (lower JPEG quality, then smaller) when a
+# viewer's connection can't keep up, instead of falling behind (see adaptive_quality.py)
+ADAPTIVE_QUALITY = True
+# Optional bitrate cap in bits/s, e.g. 8000000 to keep the stream under a metered
+# or shared link's budget. None: step down only when viewers fall behind, since a
+# fixed cap also degrades a stream the link could carry in full.
+TARGET_BITRATE = None
+
+# One camera for the whole process: started by the first viewer, stopped by the
+# last, and each frame is overlaid and encoded once for all viewers.
+controller = QualityController(target_bitrate=TARGET_BITRATE)
+
+def open_camera():
     # Initialize the camera and configure the preview resolution.
     picam2 = Picamera2()
     config = picam2.create_preview_configuration({"size": (1280, 720)})
     picam2.configure(config)
     picam2.start()  # Start camera capture for preview
-    frame_index = 0
-
-    while True:
-        # Capture a frame as a NumPy array
-        frame = picam2.capture_array()
-        if frame is None:
-            continue
-
-        frame_index += 1
-
-        # Overlay frame index text
-        text = f"Frame {frame_index}"
-        font = cv2.FONT_HERSHEY_SIMPLEX
-        font_scale = 1
-        thickness = 2
-        color = (0, 255, 0)  # Green in BGR
-
-        (text_width, text_height), baseline = cv2.getTextSize(text, font, font_scale, thickness)
-        h, w = frame.shape[:2]
-        x = (w - text_width) // 2
-        y = h - baseline  # slightly above the bottom
-
-        cv2.putText(frame, text, (x, y), font, font_scale, color, thickness)
-
-        # Encode the frame as JPEG with quality 80
+    return picam2
+
+def render_frame(frame, frame_index):
+    # Overlay frame index text
+    text = f"Frame {frame_index}"
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    font_scale = 1
+    thickness = 2
+    color = (0, 255, 0)  # Green in BGR
+
+    (text_width, text_height), baseline = cv2.getTextSize(text, font, font_scale, thickness)
+    h, w = frame.shape[:2]
+    x = (w - text_width) // 2
+    y = h - baseline  # slightly above the bottom
+
+    cv2.putText(frame, text, (x, y), font, font_scale, color, thickness)
+
+    # Encode the frame as JPEG (quality 80, or whatever the links currently allow)
+    if ADAPTIVE_QUALITY:
+        ret, buffer = controller.encode(frame)
+    else:
         ret, buffer = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), 80])
-        if not ret:
-            continue
+    if not ret:
+        return None
+
+    # Wrap it as an MJPEG part once, so viewers only write it out
+    return (b'--frame\r\n'
+            b'Content-Type: image/jpeg\r\n\r\n' + buffer.tobytes() + b'\r\n')
 
-        frame_bytes = buffer.tobytes()
+camera = CameraService(open_camera, render_frame)
 
-        # Yield the frame in MJPEG format
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
+def gen_frames():
+    client = object()  # identifies this viewer to the quality controller
+    with camera.subscription() as frames:
+        version = 0
+        while True:
+            result = frames.wait_newer(version, timeout=1.0)
+            if result is None:
+                if frames.closed:
+                    return  # the camera failed; end the stream
+                continue
+            version, part = result
+
+            # Yield the frame in MJPEG format; the generator is resumed once the
+            # server has written it, so the time spent here is time blocked sending
+            send_start = time.perf_counter()
+            yield part
+            controller.record_send(time.perf_counter() - send_start, client=client)
 
 @app.route('/video')
 def video_feed():
@@ -52,7 +86,14 @@ def video_feed():
 
 if __name__ == '__main__':
     # The server listens on all interfaces. Replace '8485' with any port you prefer.
-    app.run(host='0.0.0.0', port=8485, threaded=True)
+    if ASYNC_SERVER:
+        server = AsyncMJPEGServer(host='0.0.0.0', port=8485, wsgi_app=app)
+        # The camera service already publishes finished MJPEG parts.
+        server.add_stream('/video', camera.frames, part=None, subscribe=camera.subscribe,
+                          unsubscribe=camera.unsubscribe, on_send=controller.record_send)
+        server.run()
+    else:
+        app.run(host='0.0.0.0', port=8485, threaded=True)
 
 
 
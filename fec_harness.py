@@ -0,0 +1,131 @@
+"""
+Loss-injection harness for the UDP fragmentation/FEC path.
+
+Pushes frames through FragmentSender -> lossy channel -> Reassembler in
+memory (no sockets, so it runs anywhere) for a range of FEC overheads and
+loss rates, and plots the delivered-frame rate against the overhead:
+
+    python fec_harness.py
+    -> prints a table and writes fec_delivery.png (if matplotlib is installed)
+
+Two loss models:
+  - "random": every datagram is lost independently with probability p
+  - "burst":  Gilbert-Elliott; losses come in runs of BURST_LENGTH datagrams
+              on average, with the same long-run loss rate p (closer to Wi-Fi
+              interference than independent losses)
+"""
+import random
+import sys
+
+from udp_fragments import FragmentSender, Reassembler
+
+FRAME_BYTES = 40000    # about a 640x480 JPEG at quality 80
+NUM_FRAMES = 500
+OVERHEADS = (0.0, 0.05, 0.1, 0.2, 0.25, 0.33, 0.5, 1.0)
+LOSS_RATES = (0.01, 0.02, 0.05)
+BURST_LENGTH = 3       # mean run of consecutive losses in the "burst" model
+SEED = 1
+PLOT_PATH = "fec_delivery.png"
+
+
+class _Capture(object):
+    """Socket stand-in that keeps the datagrams instead of sending them."""
+
+    def __init__(self):
+        self.datagrams = []
+
+    def sendmsg(self, buffers, ancdata=(), flags=0, address=None):
+        self.datagrams.append(b"".join(bytes(b) for b in buffers))
+
+
+def random_loss(rng, p):
+    while True:
+        yield rng.random() < p
+
+
+def burst_loss(rng, p, burst_length=BURST_LENGTH):
+    # Two-state Markov chain: leave the bad state with probability 1/burst_length,
+    # enter it so that the stationary loss rate is p.
+    leave_bad = 1.0 / burst_length
+    enter_bad = p * leave_bad / (1.0 - p)
+    bad = False
+    while True:
+        bad = rng.random() < (1.0 - leave_bad if bad else enter_bad)
+        yield bad
+
+
+LOSS_MODELS = {
+    "random": random_loss,
+    "burst": burst_loss,
+}
+
+
+def run(overhead, loss_rate, model="random", num_frames=NUM_FRAMES, frame_bytes=FRAME_BYTES, seed=SEED):
+    """Send num_frames through the lossy channel; returns a dict of results."""
+    rng = random.Random(seed)
+    capture = _Capture()
+    sender = FragmentSender(capture, None, fec_overhead=overhead)
+    reassembler = Reassembler()
+    losses = LOSS_MODELS[model](rng, loss_rate)
+    delivered = corrupt = 0
+    for _ in range(num_frames):
+        payload = rng.randbytes(frame_bytes)
+        del capture.datagrams[:]
+        sender.send_frame(payload)
+        for datagram in capture.datagrams:
+            if next(losses):
+                continue
+            result = reassembler.feed(datagram)
+            if result is not None:
+                delivered += 1
+                if result[3] != payload:
+                    corrupt += 1
+    return {
+        "overhead": overhead,
+        "actual_overhead": sender.parity_sent / float(sender.datagrams_sent - sender.parity_sent),
+        "loss_rate": loss_rate,
+        "model": model,
+        "delivered": delivered / float(num_frames),
+        "recovered": reassembler.stats["fragments_recovered"],
+        "corrupt": corrupt,
+    }
+
+
+def plot(results, path):
+    try:
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+    except ImportError:
+        print("matplotlib not installed; skipping", path)
+        return
+    fig, axes = plt.subplots(1, len(LOSS_MODELS), figsize=(6 * len(LOSS_MODELS), 4.5), sharey=True)
+    for ax, model in zip(axes, LOSS_MODELS):
+        for loss_rate in LOSS_RATES:
+            rows = [r for r in results if r["model"] == model and r["loss_rate"] == loss_rate]
+            ax.plot([100 * r["actual_overhead"] for r in rows], [100 * r["delivered"] for r in rows],
+                    marker="o", label="%g%% loss" % (100 * loss_rate))
+        ax.set_title("%s loss, %d byte frames" % (model, FRAME_BYTES))
+        ax.set_xlabel("FEC overhead (%)")
+        ax.grid(True, alpha=0.3)
+        ax.legend()
+    axes[0].set_ylabel("frames delivered (%)")
+    fig.tight_layout()
+    fig.savefig(path)
+    print("Plot written to", path)
+
+
+if __name__ == '__main__':
+    results = []
+    print("%-7s %6s %9s %10s %10s" % ("model", "loss", "overhead", "delivered", "recovered"))
+    for model in LOSS_MODELS:
+        for loss_rate in LOSS_RATES:
+            for overhead in OVERHEADS:
+                r = run(overhead, loss_rate, model)
+                results.append(r)
+                print("%-7s %5.1f%% %8.1f%% %9.1f%% %10d"
+                      % (model, 100 * loss_rate, 100 * r["actual_overhead"], 100 * r["delivered"], r["recovered"]))
+                if r["corrupt"]:
+                    print("  %d frames reassembled with wrong contents!" % r["corrupt"])
+                    sys.exit(1)
+    plot(results, PLOT_PATH)
@@ -0,0 +1,243 @@
+"""
+Multi-subscriber fan-out hub for the TCP camera servers.
+
+The servers used to accept() a single client, stream to it, and exit when it
+disconnected. FrameHub instead keeps a listening socket open in a background
+thread; any number of viewers can connect and leave at any time while the
+camera keeps running.
+
+Each frame is encoded once by the capture loop and handed to publish(). The
+header and metadata are packed once and the same buffers are queued for
+every subscriber. Each subscriber has its own sender thread and a small
+bounded queue: if a viewer falls behind, its oldest queued frames are dropped
+so it stays live and never slows down the camera or the other viewers.
+
+For inter-coded streams (H.264) a dropped frame would corrupt every frame
+up to the next keyframe, so a subscriber that joins mid-stream or overflows
+its queue skips ahead to the next keyframe instead.
+
+Each subscriber also keeps the congestion signals adaptive_quality.py
+uses: its queue depth, the time its sender thread has spent blocked in
+sendmsg(), and the delivery latency reported by the viewer's acks
+(FrameReceiver(sock, ack=True)), in the server's own clock.
+
+Serialize (header + metadata packing), fan-out (queueing for every
+subscriber) and per-subscriber send times, bytes sent and queue drops are
+recorded in the process-wide metrics (metrics.py, component "hub").
+
+Usage:
+
+    hub = FrameHub(SERVER_PORT)
+    hub.start()
+    while True:
+        ...
+        ret, buffer = cv2.imencode(".jpg", frame)
+        hub.publish(seq, buffer, timestamp=capture_time, meta={...})
+"""
+import collections
+import socket
+import threading
+import time
+
+import frame_protocol
+import metrics
+
+DEFAULT_QUEUE_SIZE = 2  # frames buffered per subscriber before the oldest is dropped
+
+_SERIALIZE_SECONDS = metrics.STAGE_SECONDS.labels("hub", "serialize")
+_FANOUT_SECONDS = metrics.STAGE_SECONDS.labels("hub", "fanout")
+# Written by every subscriber's sender thread.
+_SEND_SECONDS = metrics.STAGE_SECONDS.labels("hub", "send", shared=True)
+_FRAMES_PUBLISHED = metrics.FRAMES.labels("hub", "publish")
+_FRAMES_SENT = metrics.FRAMES.labels("hub", "send", shared=True)
+_FRAMES_DROPPED = metrics.DROPS.labels("hub", "subscriber_queue")
+_BYTES_SENT = metrics.BYTES.labels("hub", "sent", shared=True)
+
+
+class Subscriber(object):
+    """One connected viewer: a socket, a bounded frame queue and a sender thread."""
+
+    def __init__(self, hub, conn, addr, queue_size):
+        self.hub = hub
+        self.conn = conn
+        self.addr = addr
+        self.queue = collections.deque(maxlen=queue_size)
+        self.cond = threading.Condition()
+        self.closed = False
+        self.synced = False  # inter-coded streams only: seen a keyframe since joining or dropping
+        self.frames_sent = 0
+        self.frames_dropped = 0
+        self.bytes_sent = 0
+        self.send_busy = 0.0      # seconds spent blocked sending
+        self.ack_latency = None   # capture -> viewer -> ack back, seconds (latest ack)
+        self.acks_received = 0
+        self._ack_buf = b""
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def put(self, parts, inter_coded=False, keyframe=True):
+        """
+        Queue a frame; drops the oldest queued frame if the queue is full.
+
+        For inter-coded frames, a full queue is flushed instead and nothing is
+        queued again until the next keyframe.
+        """
+        with self.cond:
+            if inter_coded:
+                if len(self.queue) == self.queue.maxlen:
+                    self.frames_dropped += len(self.queue)
+                    _FRAMES_DROPPED.inc(len(self.queue))
+                    self.queue.clear()
+                    self.synced = False
+                if not self.synced:
+                    if not keyframe:
+                        self.frames_dropped += 1
+                        _FRAMES_DROPPED.inc()
+                        return
+                    self.synced = True
+            elif len(self.queue) == self.queue.maxlen:
+                self.frames_dropped += 1
+                _FRAMES_DROPPED.inc()
+            self.queue.append(parts)
+            self.cond.notify()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+
+    def _read_acks(self):
+        """Consume whatever acks the viewer has sent so far, without blocking."""
+        try:
+            data = self.conn.recv(4096, socket.MSG_DONTWAIT)
+        except (BlockingIOError, InterruptedError):
+            return
+        if not data:
+            return  # viewer closed its side; the next send will fail
+        data = self._ack_buf + data
+        usable = len(data) - len(data) % frame_protocol.ACK_SIZE
+        for offset in range(0, usable, frame_protocol.ACK_SIZE):
+            try:
+                seq, timestamp = frame_protocol.unpack_ack(data[offset:offset + frame_protocol.ACK_SIZE])
+            except ValueError:
+                usable = len(data)  # not an ack stream; ignore it from here on
+                break
+            self.ack_latency = time.time() - timestamp
+            self.acks_received += 1
+        self._ack_buf = data[usable:]
+
+    def _run(self):
+        try:
+            while True:
+                with self.cond:
+                    while not self.queue and not self.closed:
+                        self.cond.wait()
+                    if self.closed:
+                        break
+                    parts = self.queue.popleft()
+                start = time.perf_counter()
+                sent = frame_protocol.send_parts(self.conn, parts)
+                elapsed = time.perf_counter() - start
+                self.bytes_sent += sent
+                self.send_busy += elapsed
+                self.frames_sent += 1
+                _SEND_SECONDS.observe(elapsed)
+                _BYTES_SENT.inc(sent)
+                _FRAMES_SENT.inc()
+                if hasattr(socket, "MSG_DONTWAIT"):
+                    self._read_acks()
+        except OSError as e:
+            print("Subscriber", self.addr, "disconnected:", e)
+        finally:
+            try:
+                self.conn.close()
+            except OSError:
+                pass
+            self.hub._remove(self)
+
+
+class FrameHub(object):
+    def __init__(self, port, host='', queue_size=DEFAULT_QUEUE_SIZE):
+        self.host = host
+        self.port = port
+        self.queue_size = queue_size
+        self.server_socket = None
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self._accept_thread = None
+        self.frames_published = 0
+
+    def start(self):
+        """Open the listening socket and start accepting subscribers in the background."""
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.bind((self.host, self.port))
+        self.server_socket.listen(8)
+        self.port = self.server_socket.getsockname()[1]
+        print("Server listening on port", self.port)
+        self._accept_thread = threading.Thread(target=self._accept_loop, daemon=True)
+        self._accept_thread.start()
+        return self
+
+    def _accept_loop(self):
+        while True:
+            try:
+                conn, addr = self.server_socket.accept()
+            except OSError:
+                break  # listening socket closed
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            subscriber = Subscriber(self, conn, addr, self.queue_size)
+            with self._lock:
+                self._subscribers.append(subscriber)
+            subscriber.thread.start()
+            print("Connected by:", addr)
+
+    def _remove(self, subscriber):
+        with self._lock:
+            if subscriber in self._subscribers:
+                self._subscribers.remove(subscriber)
+
+    @property
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def subscribers(self):
+        with self._lock:
+            return list(self._subscribers)
+
+    def publish(self, seq, payload, codec=frame_protocol.CODEC_JPEG, timestamp=None, flags=0, meta=None):
+        """
+        Broadcast one encoded frame to every subscriber.
+
+        The payload buffer is shared between subscribers, not copied, so the
+        caller must not modify it afterwards (cv2.imencode returns a fresh
+        buffer for every frame, so this is the normal case).
+        Returns the number of subscribers the frame was queued for.
+        """
+        subscribers = self.subscribers()
+        if not subscribers:
+            return 0
+        t0 = time.perf_counter()
+        parts = frame_protocol.frame_parts(seq, payload, codec=codec, timestamp=timestamp,
+                                           flags=flags, meta=meta)
+        t1 = time.perf_counter()
+        inter_coded = codec == frame_protocol.CODEC_H264
+        keyframe = bool(flags & frame_protocol.FLAG_KEYFRAME)
+        for subscriber in subscribers:
+            subscriber.put(parts, inter_coded=inter_coded, keyframe=keyframe)
+        _FANOUT_SECONDS.observe(time.perf_counter() - t1)
+        _SERIALIZE_SECONDS.observe(t1 - t0)
+        _FRAMES_PUBLISHED.inc()
+        self.frames_published += 1
+        return len(subscribers)
+
+    def close(self):
+        if self.server_socket is not None:
+            try:
+                # shutdown() is what wakes the accept() thread on Linux.
+                self.server_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.server_socket.close()
+        for subscriber in self.subscribers():
+            subscriber.close()
@@ -0,0 +1,193 @@
+"""
+Binary wire protocol shared by the TCP camera servers and clients.
+
+Every frame on the wire is:
+
+    [28-byte header][meta_len bytes of JSON metadata][payload_len bytes of payload]
+
+The header is packed in network byte order with fixed-size fields, so it is the
+same 28 bytes on the 32-bit Pi OS and on a 64-bit desktop (unlike
+struct.pack("L", ...), which is 4 bytes on one and 8 on the other).
+
+Header fields:
+  - magic        b"RPIF", lets a receiver detect a desynchronised stream
+  - version      protocol version (PROTOCOL_VERSION)
+  - codec        what the payload is (CODEC_JPEG, CODEC_H264, ...)
+  - flags        bit flags (FLAG_KEYFRAME, ...)
+  - seq          frame sequence number (wraps at 2**32)
+  - timestamp    capture time in seconds since the epoch (time.time())
+  - meta_len     length of the optional JSON metadata block
+  - payload_len  length of the encoded frame
+
+Frames are sent with socket.sendmsg([header, meta, memoryview(payload)]), so the
+encoded JPEG is handed to the kernel straight from the cv2.imencode buffer:
+no pickle and no header + data concatenation copy.
+
+In the other direction a client may acknowledge each frame it has received
+with a 16-byte ACK (magic b"RPIA", seq, the frame's capture timestamp echoed
+back). The server sees how long frames take to reach the viewer, in its own
+clock, and adapts the stream (see adaptive_quality.py).
+"""
+import json
+import socket
+import struct
+import time
+
+MAGIC = b"RPIF"
+PROTOCOL_VERSION = 1
+
+# magic, version, codec, flags, seq, timestamp, meta_len, payload_len
+HEADER = struct.Struct("!4sBBHIdII")
+HEADER_SIZE = HEADER.size
+
+# Codec ids.
+CODEC_RAW = 0
+CODEC_JPEG = 1
+CODEC_H264 = 2
+
+# Flag bits.
+FLAG_KEYFRAME = 0x0001
+
+# Client -> server acknowledgement: magic, seq, echoed capture timestamp
+ACK_MAGIC = b"RPIA"
+ACK = struct.Struct("!4sId")
+ACK_SIZE = ACK.size
+
+
+class FrameHeader(object):
+    """Decoded frame header."""
+    __slots__ = ("version", "codec", "flags", "seq", "timestamp", "meta_len", "payload_len")
+
+    def __init__(self, version, codec, flags, seq, timestamp, meta_len, payload_len):
+        self.version = version
+        self.codec = codec
+        self.flags = flags
+        self.seq = seq
+        self.timestamp = timestamp
+        self.meta_len = meta_len
+        self.payload_len = payload_len
+
+    @property
+    def keyframe(self):
+        return bool(self.flags & FLAG_KEYFRAME)
+
+    def __repr__(self):
+        return ("FrameHeader(seq=%d, codec=%d, flags=0x%04x, timestamp=%.6f, meta_len=%d, payload_len=%d)"
+                % (self.seq, self.codec, self.flags, self.timestamp, self.meta_len, self.payload_len))
+
+
+def pack_header(seq, payload_len, codec=CODEC_JPEG, timestamp=None, flags=0, meta_len=0):
+    """Pack a frame header into HEADER_SIZE bytes."""
+    if timestamp is None:
+        timestamp = time.time()
+    return HEADER.pack(MAGIC, PROTOCOL_VERSION, codec, flags,
+                       seq & 0xFFFFFFFF, timestamp, meta_len, payload_len)
+
+
+def unpack_header(buf):
+    """
+    Unpack HEADER_SIZE bytes into a FrameHeader.
+
+    Raises ValueError if the magic or version don't match, which means the
+    stream is out of sync or the peer speaks a different protocol.
+    """
+    magic, version, codec, flags, seq, timestamp, meta_len, payload_len = HEADER.unpack(buf)
+    if magic != MAGIC:
+        raise ValueError("Bad frame magic: %r" % (bytes(magic),))
+    if version != PROTOCOL_VERSION:
+        raise ValueError("Unsupported protocol version: %d" % version)
+    return FrameHeader(version, codec, flags, seq, timestamp, meta_len, payload_len)
+
+
+def encode_meta(meta):
+    """Serialize the metadata dict (detections, ROI, ...) as compact JSON."""
+    if not meta:
+        return b""
+    return json.dumps(meta, separators=(",", ":")).encode("utf-8")
+
+
+def decode_meta(buf):
+    """Inverse of encode_meta()."""
+    if not buf:
+        return {}
+    return json.loads(bytes(buf).decode("utf-8"))
+
+
+def _sendmsg_all(sock, buffers):
+    """
+    Scatter-gather send of every buffer in `buffers`.
+
+    sendmsg() may send less than everything (e.g. when interrupted), so keep
+    going from wherever it stopped. Slicing memoryviews doesn't copy.
+    """
+    views = [memoryview(b).cast("B") for b in buffers if len(b)]
+    while views:
+        sent = sock.sendmsg(views)
+        while sent:
+            if sent >= len(views[0]):
+                sent -= len(views[0])
+                views.pop(0)
+            else:
+                views[0] = views[0][sent:]
+                sent = 0
+
+
+def frame_parts(seq, payload, codec=CODEC_JPEG, timestamp=None, flags=0, meta=None):
+    """
+    Build the (header, meta, payload) buffers for one frame without sending them.
+
+    Used when the same frame goes to several sockets: the header and
+    metadata are packed once and the payload is shared, not copied.
+    """
+    meta_bytes = encode_meta(meta)
+    payload = memoryview(payload).cast("B")
+    header = pack_header(seq, len(payload), codec=codec, timestamp=timestamp,
+                         flags=flags, meta_len=len(meta_bytes))
+    return header, meta_bytes, payload
+
+
+def send_parts(sock, parts):
+    """Send buffers built by frame_parts(). Returns the number of bytes sent."""
+    if hasattr(sock, "sendmsg"):
+        _sendmsg_all(sock, parts)
+    else:
+        # Windows sockets have no sendmsg(); fall back to separate sends.
+        for part in parts:
+            if len(part):
+                sock.sendall(part)
+    return sum(len(part) for part in parts)
+
+
+def send_frame(sock, seq, payload, codec=CODEC_JPEG, timestamp=None, flags=0, meta=None):
+    """
+    Send one frame (header, optional metadata, payload) on a connected TCP socket.
+
+    `payload` can be anything exposing the buffer protocol, e.g. the numpy
+    array returned by cv2.imencode; it is not copied.
+    Returns the number of bytes put on the wire.
+    """
+    return send_parts(sock, frame_parts(seq, payload, codec=codec, timestamp=timestamp,
+                                        flags=flags, meta=meta))
+
+
+def pack_ack(seq, timestamp):
+    return ACK.pack(ACK_MAGIC, seq & 0xFFFFFFFF, timestamp)
+
+
+def unpack_ack(buf):
+    """Unpack ACK_SIZE bytes into (seq, timestamp). Raises ValueError on a bad magic."""
+    magic, seq, timestamp = ACK.unpack(buf)
+    if magic != ACK_MAGIC:
+        raise ValueError("Bad ack magic: %r" % (bytes(magic),))
+    return seq, timestamp
+
+
+def send_ack(sock, seq, timestamp):
+    """
+    Acknowledge a received frame. Best effort: never blocks, and an ack that
+    doesn't fit in the socket buffer is simply dropped.
+    """
+    try:
+        sock.send(pack_ack(seq, timestamp), getattr(socket, "MSG_DONTWAIT", 0))
+    except (BlockingIOError, InterruptedError):
+        pass
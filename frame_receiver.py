@@ -0,0 +1,122 @@
+"""
+Zero-copy frame receiver shared by every TCP client.
+
+The old client loops did `packet = sock.recv(4096); data += packet`, which
+reallocates and copies the whole accumulated buffer for every 4 KB packet
+(quadratic in frame size), then slices the frame out (another copy).
+
+FrameReceiver instead reads with recv_into() straight into one reusable
+bytearray, as many bytes as the kernel has ready, and hands out frames as
+memoryviews into that buffer. The buffer only grows when a frame bigger
+than anything seen so far arrives.
+
+Usage:
+
+    receiver = FrameReceiver(sock)
+    for header, meta, payload in receiver:
+        frame = cv2.imdecode(np.frombuffer(payload, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+`payload` is only valid until the next frame is received: copy it with
+bytes(payload) if it has to outlive the loop iteration (e.g. when handing it
+to another thread).
+
+With ack=True every received frame is acknowledged back to the server
+(frame_protocol.send_ack), which lets it measure delivery latency and adapt
+the stream quality.
+
+Receive time (from a frame's header to its last byte), frames and bytes are
+recorded in the process-wide metrics (metrics.py, component "receiver").
+"""
+import time
+
+import frame_protocol
+import metrics
+
+DEFAULT_BUFFER_SIZE = 1 << 20  # 1 MB, enough for a 1080p JPEG
+
+# Shared by every FrameReceiver of the process (c2.py runs one per camera thread).
+_RECEIVE_SECONDS = metrics.STAGE_SECONDS.labels("receiver", "receive", shared=True)
+_FRAMES_RECEIVED = metrics.FRAMES.labels("receiver", "receive", shared=True)
+_BYTES_RECEIVED = metrics.BYTES.labels("receiver", "received", shared=True)
+
+
+class FrameReceiver(object):
+    def __init__(self, sock, buffer_size=DEFAULT_BUFFER_SIZE, ack=False):
+        self.sock = sock
+        self.ack = ack
+        self._buf = bytearray(buffer_size)
+        self._view = memoryview(self._buf)
+        self._start = 0  # first unconsumed byte
+        self._end = 0    # one past the last received byte
+        self.frames_received = 0
+        self.bytes_received = 0
+
+    def _reserve(self, needed):
+        """Make sure there is room for `needed` bytes starting at self._start."""
+        available = self._end - self._start
+        if self._start + needed <= len(self._buf):
+            return
+        if needed <= len(self._buf):
+            # Enough room overall: move the partial frame to the front.
+            self._view[:available] = self._view[self._start:self._end]
+        else:
+            # Frame bigger than the buffer: grow (at least double) and copy the partial frame over.
+            new_buf = bytearray(max(needed, 2 * len(self._buf)))
+            new_buf[:available] = self._view[self._start:self._end]
+            self._buf = new_buf
+            self._view = memoryview(new_buf)
+        self._start = 0
+        self._end = available
+
+    def _fill(self, needed):
+        """Receive until at least `needed` unconsumed bytes are buffered."""
+        self._reserve(needed)
+        while self._end - self._start < needed:
+            n = self.sock.recv_into(self._view[self._end:])
+            if not n:
+                raise ConnectionError("Socket connection closed")
+            self._end += n
+            self.bytes_received += n
+            _BYTES_RECEIVED.inc(n)
+
+    def recv_frame(self):
+        """
+        Block until one complete frame has arrived.
+
+        Returns (header, meta, payload) where header is a
+        frame_protocol.FrameHeader, meta the decoded metadata dict and payload a
+        memoryview of the encoded frame. Raises ConnectionError when the peer
+        closes the connection.
+        """
+        self._fill(frame_protocol.HEADER_SIZE)
+        # Waiting for the header is idle time; the clock starts once it is here.
+        start = time.perf_counter()
+        header = frame_protocol.unpack_header(
+            self._view[self._start:self._start + frame_protocol.HEADER_SIZE])
+        self._start += frame_protocol.HEADER_SIZE
+
+        self._fill(header.meta_len + header.payload_len)
+        meta_end = self._start + header.meta_len
+        meta = frame_protocol.decode_meta(self._view[self._start:meta_end])
+        payload = self._view[meta_end:meta_end + header.payload_len]
+        self._start = meta_end + header.payload_len
+
+        self.frames_received += 1
+        _RECEIVE_SECONDS.observe(time.perf_counter() - start)
+        _FRAMES_RECEIVED.inc()
+        if self.ack:
+            frame_protocol.send_ack(self.sock, header.seq, header.timestamp)
+        return header, meta, payload
+
+    def __iter__(self):
+        """Yield frames until the connection is closed (ConnectionError propagates)."""
+        while True:
+            yield self.recv_frame()
+
+    def run(self, callback):
+        """Call callback(header, meta, payload) for every frame until the connection closes."""
+        try:
+            for header, meta, payload in self:
+                callback(header, meta, payload)
+        except ConnectionError:
+            pass
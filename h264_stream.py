@@ -0,0 +1,221 @@
+"""
+H.264 network streaming, as an alternative to sending one JPEG per frame.
+
+The server side pushes H.264 access units (one encoded frame each) through the
+usual frame_protocol header with codec=CODEC_H264 and FLAG_KEYFRAME set on IDR
+frames. Keyframes carry SPS/PPS in-band, so a viewer that connects late can
+start decoding at the next keyframe (FrameHub holds new or lagging viewers
+back until one arrives).
+
+Encoders and decoders are pluggable and looked up by name:
+
+  ENCODERS
+    "hardware"  the Pi's V4L2 encoder via picamera2's H264Encoder; the camera
+                feeds it directly, no per-frame Python work.
+    "software"  libx264 through PyAV (pip install av); fed from a
+                capture_array() loop, runs on any Linux box.
+
+  DECODERS
+    "pyav"      libavcodec through PyAV, returns BGR numpy frames.
+
+Every encoder calls sink(data, keyframe, timestamp) once per access unit,
+with the time.time() the frame was captured: what the caller passed to the
+software encoder's encode(), or the hardware encoder's sensor timestamp
+converted to wall-clock time. hub_sink() builds a sink that publishes to a
+FrameHub with that capture time in the header and the "encode" / "publish"
+hops stamped for latency.py, tee_sink() combines sinks (e.g. the hub and a
+segment_recorder.SegmentRecorder).
+"""
+import time
+from fractions import Fraction
+
+import frame_protocol
+import latency
+
+try:
+    import av
+except ImportError:
+    av = None
+
+try:
+    from picamera2.encoders import H264Encoder as _PicameraH264Encoder
+    from picamera2.outputs import FileOutput, Output
+except ImportError:
+    _PicameraH264Encoder = None
+    FileOutput = None
+    Output = object
+
+DEFAULT_BITRATE = 2000000  # bits per second
+DEFAULT_GOP = 30           # frames between keyframes (1 s at 30 fps)
+
+
+def hub_sink(hub):
+    """Return a sink(data, keyframe, timestamp) that publishes access units to a FrameHub."""
+    state = {"seq": 0}
+
+    def sink(data, keyframe, timestamp=None):
+        meta = latency.stamp({}, "encode")  # the encoder has just delivered it
+        state["seq"] += 1
+        latency.stamp(meta, "publish")
+        hub.publish(state["seq"], data, codec=frame_protocol.CODEC_H264,
+                    timestamp=timestamp if timestamp is not None else meta["t"]["encode"],
+                    flags=frame_protocol.FLAG_KEYFRAME if keyframe else 0, meta=meta)
+    return sink
+
+
+def tee_sink(*sinks):
+    """Return a sink that passes every access unit to each of `sinks` (None entries are skipped)."""
+    sinks = [sink for sink in sinks if sink is not None]
+
+    def sink(data, keyframe, timestamp=None):
+        for s in sinks:
+            s(data, keyframe, timestamp)
+    return sink
+
+
+# -------------------------------
+# Encoders
+# -------------------------------
+MAX_CAPTURE_AGE = 5.0  # seconds; an older converted sensor timestamp is taken as bogus
+
+
+class _SinkOutput(Output):
+    """picamera2 Output that forwards every encoded frame to a sink, with its capture time."""
+
+    def __init__(self, sink, encoder):
+        super(_SinkOutput, self).__init__()
+        self.sink = sink
+        self.encoder = encoder
+
+    def _capture_time(self, timestamp):
+        # picamera2 passes the sensor timestamp (CLOCK_MONOTONIC, us) minus the
+        # encoder's first one; move it onto the time.time() clock.
+        first = getattr(self.encoder, "firsttimestamp", None)
+        now = time.time()
+        if timestamp is None or first is None:
+            return now
+        age = time.monotonic() - (first + timestamp) / 1e6
+        return now - age if 0 <= age < MAX_CAPTURE_AGE else now
+
+    def outputframe(self, frame, keyframe=True, timestamp=None, *args, **kwargs):
+        self.sink(frame, keyframe, self._capture_time(timestamp))
+
+
+class HardwareH264Encoder(object):
+    """Pi hardware encoder. The camera feeds it; encode() is a no-op."""
+
+    def __init__(self, picam2, sink, bitrate=DEFAULT_BITRATE, gop=DEFAULT_GOP, file_name=None, **kwargs):
+        if _PicameraH264Encoder is None:
+            raise RuntimeError("picamera2 is not available; use the 'software' encoder")
+        self.picam2 = picam2
+        # repeat=True puts SPS/PPS in front of every keyframe for late joiners.
+        self.encoder = _PicameraH264Encoder(bitrate=bitrate, repeat=True, iperiod=gop)
+        outputs = [_SinkOutput(sink, self.encoder)]
+        if file_name is not None:
+            outputs.append(FileOutput(file_name))
+        self.encoder.output = outputs
+
+    def start(self):
+        self.picam2.start_recording(self.encoder, self.encoder.output)
+
+    def encode(self, frame, timestamp=None):
+        pass
+
+    def stop(self):
+        self.picam2.stop_recording()
+
+
+class SoftwareH264Encoder(object):
+    """libx264 through PyAV, tuned for low latency. Call encode() for every captured frame."""
+
+    def __init__(self, picam2, sink, width, height, fps=30, bitrate=DEFAULT_BITRATE, gop=DEFAULT_GOP,
+                 file_name=None, **kwargs):
+        if av is None:
+            raise RuntimeError("PyAV is not installed (pip install av)")
+        self.picam2 = picam2
+        self.sink = sink
+        self.codec = av.CodecContext.create("libx264", "w")
+        self.codec.width = width
+        self.codec.height = height
+        self.codec.pix_fmt = "yuv420p"
+        self.codec.time_base = Fraction(1, fps)
+        self.codec.framerate = Fraction(fps, 1)
+        self.codec.bit_rate = bitrate
+        self.codec.gop_size = gop
+        # No B-frames and no lookahead: every frame comes out as soon as it goes in.
+        self.codec.options = {"preset": "ultrafast", "tune": "zerolatency"}
+        self.file = open(file_name, "wb") if file_name is not None else None
+        self.pts = 0
+        self.capture_times = {}  # pts -> capture time of the frames inside the encoder
+
+    def start(self):
+        self.picam2.start()
+
+    def encode(self, frame, timestamp=None):
+        """Encode a captured frame; `timestamp` is its capture time (time.time(), default now)."""
+        fmt = "bgra" if frame.ndim == 3 and frame.shape[2] == 4 else "bgr24"
+        video_frame = av.VideoFrame.from_ndarray(frame, format=fmt)
+        video_frame.pts = self.pts
+        self.capture_times[self.pts] = time.time() if timestamp is None else timestamp
+        self.pts += 1
+        for packet in self.codec.encode(video_frame):
+            self._output(packet)
+
+    def _output(self, packet):
+        data = bytes(packet)
+        if self.file is not None:
+            self.file.write(data)
+        self.sink(data, packet.is_keyframe, self.capture_times.pop(packet.pts, None))
+
+    def stop(self):
+        for packet in self.codec.encode(None):
+            self._output(packet)
+        if self.file is not None:
+            self.file.close()
+        self.picam2.stop()
+
+
+ENCODERS = {
+    "hardware": HardwareH264Encoder,
+    "software": SoftwareH264Encoder,
+}
+
+
+def create_encoder(name, picam2, sink, **kwargs):
+    """Create an encoder from ENCODERS by name (kwargs: width, height, fps, bitrate, gop, file_name)."""
+    try:
+        cls = ENCODERS[name]
+    except KeyError:
+        raise ValueError("Unknown H.264 encoder %r (choose from %s)" % (name, ", ".join(ENCODERS)))
+    return cls(picam2, sink, **kwargs)
+
+
+# -------------------------------
+# Decoders
+# -------------------------------
+class PyAVDecoder(object):
+    """Decode H.264 access units with libavcodec. decode() returns a list of BGR frames."""
+
+    def __init__(self):
+        if av is None:
+            raise RuntimeError("PyAV is not installed (pip install av)")
+        self.codec = av.CodecContext.create("h264", "r")
+
+    def decode(self, data):
+        frames = []
+        for frame in self.codec.decode(av.Packet(bytes(data))):
+            frames.append(frame.to_ndarray(format="bgr24"))
+        return frames
+
+
+DECODERS = {
+    "pyav": PyAVDecoder,
+}
+
+
+def create_decoder(name="pyav"):
+    try:
+        cls = DECODERS[name]
+    except KeyError:
+        raise ValueError("Unknown H.264 decoder %r (choose from %s)" % (name, ", ".join(DECODERS)))
+    return cls()
@@ -1,13 +1,30 @@
 from flask import Flask, Response, request, jsonify, send_from_directory
 import cv2
-from picamera2 import Picamera2
 import threading
 import time
+import os
+import sys
+
+# Shared modules (camera_backend, ...) live one directory up.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from camera_backend import Picamera2
+from latest_frame import LatestFrame
+from async_mjpeg import AsyncMJPEGServer
+from stream_variants import StreamVariants
+from snapshot import snapshot_response
+import metrics
 
 app = Flask(__name__)
 
+# Serve the streams from one asyncio loop (async_mjpeg.py) instead of werkzeug's
+# thread-per-viewer server; the other routes still go to the Flask app.
+ASYNC_SERVER = False
+
 # Global variables for the latest frame, click coordinates, box color, video mode, ROI, and Gaussian blur.
-global_frame = None
+latest_frame = LatestFrame()  # newest JPEG, versioned so viewers can wait for the next one
+# Resized / re-encoded variants for viewers that ask for them, each encoded once per frame
+variants = StreamVariants(max_width=1280, max_fps=30)
 click_coords = None  # (x, y) for the center of the box
 box_color = (0, 0, 255)  # Default to red (BGR format)
 video_mode = "color"  # "color" for full-color, "bw" for black & white
@@ -24,8 +41,16 @@ gaussian_sigma = 0.0
 
 frame_lock = threading.Lock()
 
+# Per-stage timings for /metrics (see metrics.py).
+CAPTURE_SECONDS = metrics.STAGE_SECONDS.labels("app", "capture")
+ENCODE_SECONDS = metrics.STAGE_SECONDS.labels("app", "encode")
+FANOUT_SECONDS = metrics.STAGE_SECONDS.labels("app", "fanout")
+FRAMES_CAPTURED = metrics.FRAMES.labels("app", "capture")
+FRAMES_ENCODED = metrics.FRAMES.labels("app", "encode")
+BYTES_ENCODED = metrics.BYTES.labels("app", "encoded")
+
 def capture_frames():
-    global global_frame, click_coords, box_color, video_mode, roi_x1, roi_x2, roi_y1, roi_y2, gaussian_kernel_size, gaussian_sigma
+    global click_coords, box_color, video_mode, roi_x1, roi_x2, roi_y1, roi_y2, gaussian_kernel_size, gaussian_sigma
     picam2 = Picamera2()
     config = picam2.create_preview_configuration({"size": (1280, 720)})
     picam2.configure(config)
@@ -33,9 +58,12 @@ def capture_frames():
     frame_index = 0
 
     while True:
+        t0 = time.perf_counter()
         frame = picam2.capture_array()
         if frame is None:
             continue
+        CAPTURE_SECONDS.observe(time.perf_counter() - t0)
+        FRAMES_CAPTURED.inc()
 
         frame_index += 1
 
@@ -92,12 +120,19 @@ def capture_frames():
         frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
 
         # Encode the frame as JPEG with quality 80.
+        t0 = time.perf_counter()
         ret, buffer = cv2.imencode('.jpg', frame_rgb, [int(cv2.IMWRITE_JPEG_QUALITY), 80])
         if not ret:
             continue
+        t1 = time.perf_counter()
+        ENCODE_SECONDS.observe(t1 - t0)
+        FRAMES_ENCODED.inc()
+        BYTES_ENCODED.inc(len(buffer))
 
-        with frame_lock:
-            global_frame = buffer.tobytes()
+        # Fan-out: the shared frame for the viewers plus any variants they asked for.
+        latest_frame.publish(buffer.tobytes())
+        variants.publish(frame_rgb)
+        FANOUT_SECONDS.observe(time.perf_counter() - t1)
 
         time.sleep(0.03)  # Adjust delay for desired frame rate
 
@@ -108,24 +143,54 @@ thread.start()
 
 def gen_frames():
     """Generator function that yields MJPEG frames."""
-    global global_frame
+    version = 0
     while True:
-        with frame_lock:
-            if global_frame is None:
-                continue
-            frame = global_frame
+        # Sleep until the capture thread publishes a frame this viewer hasn't had yet
+        result = latest_frame.wait_newer(version, timeout=1.0)
+        if result is None:
+            continue
+        version, frame = result
         yield (b'--frame\r\n'
                b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
 
+def gen_variant_frames(key):
+    """MJPEG generator for one stream variant (see stream_variants.py)."""
+    with variants.subscription(key) as frames:
+        version = 0
+        while True:
+            result = frames.wait_newer(version, timeout=1.0)
+            if result is None:
+                continue
+            version, frame = result
+            yield (b'--frame\r\n'
+                   b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
+
 @app.route('/')
 def index():
     return send_from_directory('.', 'index.html')
 
 @app.route('/video')
 def video_feed():
+    # /video?width=&quality=&fps= picks a smaller/cheaper shared variant of the stream
+    width = request.args.get('width', type=int)
+    quality = request.args.get('quality', type=int)
+    fps = request.args.get('fps', type=int)
+    if width is not None or quality is not None or fps is not None:
+        return Response(gen_variant_frames(variants.select(width, quality, fps)),
+                        mimetype='multipart/x-mixed-replace; boundary=frame')
     return Response(gen_frames(),
                     mimetype='multipart/x-mixed-replace; boundary=frame')
 
+@app.route('/metrics')
+def metrics_endpoint():
+    # Prometheus text format: per-stage histograms and frame/byte counters.
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route('/snapshot.jpg')
+def snapshot():
+    # Latest JPEG from memory; ETag/If-None-Match, and ?wait=<s> long-polls for the next frame
+    return snapshot_response(latest_frame, request)
+
 @app.route('/click', methods=['POST'])
 def click_handler():
     """
@@ -220,4 +285,10 @@ def set_gaussian():
     return jsonify({"status": "Gaussian parameters updated", "kernel": gaussian_kernel_size, "sigma": gaussian_sigma})
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8485, threaded=True)
+    if ASYNC_SERVER:
+        server = AsyncMJPEGServer(host='0.0.0.0', port=8485, wsgi_app=app)
+        server.add_stream('/video', latest_frame)
+        server.add_snapshot('/snapshot.jpg', latest_frame)  # long polls wait on the event loop
+        server.run()
+    else:
+        app.run(host='0.0.0.0', port=8485, threaded=True)
@@ -1,20 +1,26 @@
 from flask import Flask, Response, request, jsonify, send_from_directory
 import cv2
-from picamera2 import Picamera2
 import threading
 import time
 import sys
+import os
+
+# Shared modules (camera_backend, ...) live one directory up.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from camera_backend import Picamera2
+from latest_frame import LatestFrame
 
 app = Flask(__name__)
 
 # Global variables for the latest frame, click coordinates, and box color.
-global_frame = None
+latest_frame = LatestFrame()  # newest JPEG, versioned so viewers can wait for the next one
 click_coords = None  # (x, y) for the center of the box
 box_color = (0, 0, 255)  # Default to red (BGR)
 frame_lock = threading.Lock()
 
 def capture_frames(arg):
-    global global_frame, click_coords, box_color
+    global click_coords, box_color
     picam2 = Picamera2()
     config = picam2.create_preview_configuration({"size": (1280, 720)})
     picam2.configure(config)
@@ -60,8 +66,7 @@ def capture_frames(arg):
         if not ret:
             continue
 
-        with frame_lock:
-            global_frame = buffer.tobytes()
+        latest_frame.publish(buffer.tobytes())
 
         time.sleep(0.03)  # Adjust delay for desired frame rate
 
@@ -73,12 +78,13 @@ thread.start()
 
 def gen_frames():
     """Generator function that yields MJPEG frames."""
-    global global_frame
+    version = 0
     while True:
-        with frame_lock:
-            if global_frame is None:
-                continue
-            frame = global_frame
+        # Sleep until the capture thread publishes a frame this viewer hasn't had yet
+        result = latest_frame.wait_newer(version, timeout=1.0)
+        if result is None:
+            continue
+        version, frame = result
         yield (b'--frame\r\n'
                b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
 
@@ -0,0 +1,169 @@
+"""
+Glass-to-glass latency measurement.
+
+Every frame already carries its sequence number and capture timestamp in the
+frame_protocol header. Servers add the time of each later server-side hop to
+the frame metadata with stamp():
+
+    meta = {}
+    ...encode...
+    latency.stamp(meta, "encode")
+    latency.stamp(meta, "publish")
+    hub.publish(seq, buffer, timestamp=capture_time, meta=meta)
+
+and clients mark the client-side hops with a LatencyTracker:
+
+    tracker = LatencyTracker()
+    header, meta, payload = receiver.recv_frame()
+    sample = tracker.received(header, meta)
+    frame = cv2.imdecode(...)
+    sample.mark("decode")
+    cv2.imshow(...)
+    sample.mark("display")
+    tracker.finish(sample)
+    ...
+    tracker.write_report("latency_report.json")
+
+The tracker keeps per-hop latency samples (capture->encode, encode->publish,
+publish->receive, receive->decode, decode->display and capture->display
+"total") and reports p50/p95/p99. It also counts dropped frames per hop:
+  - "transport": sequence numbers that never arrived (dropped on the server
+    or in the hub's per-viewer queue)
+  - "decode":    frames that arrived but failed to decode
+
+Timestamps are time.time() on each machine: across two machines the clocks
+must be synchronised (NTP/chrony) for the network hop to mean anything.
+Over loopback (see latency_suite.py) there is no offset.
+"""
+import collections
+import json
+import math
+import time
+
+# Hop order through the pipeline. Server side stamps "encode" and "publish";
+# the client stamps "receive" (automatically), "decode" and "display".
+HOPS = ("capture", "encode", "publish", "receive", "decode", "display")
+DROP_HOPS = ("transport", "decode")
+MAX_SAMPLES = 100000  # per hop, oldest dropped first
+
+
+def stamp(meta, hop, t=None):
+    """Record when `hop` finished in the frame metadata (server side)."""
+    meta.setdefault("t", {})[hop] = time.time() if t is None else t
+    return meta
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(math.ceil(p / 100.0 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+class Sample(object):
+    """Timestamps of one frame as it moves through the hops."""
+    __slots__ = ("seq", "times")
+
+    def __init__(self, seq, times):
+        self.seq = seq
+        self.times = times
+
+    def mark(self, hop, t=None):
+        self.times[hop] = time.time() if t is None else t
+
+
+class LatencyTracker(object):
+    def __init__(self):
+        self.samples = collections.defaultdict(lambda: collections.deque(maxlen=MAX_SAMPLES))
+        self.drops = dict((hop, 0) for hop in DROP_HOPS)
+        self.frames = 0
+        self.last_seq = None
+        self.start_time = time.time()
+
+    def new_stream(self):
+        """Call after (re)connecting: the server's sequence numbers start over."""
+        self.last_seq = None
+
+    def received(self, header, meta):
+        """Start a sample for a frame that just came off the socket; tracks sequence gaps."""
+        now = time.time()
+        if self.last_seq is not None:
+            gap = (header.seq - self.last_seq - 1) & 0xFFFFFFFF
+            if gap < 0x80000000:  # ignore reordering/restarts showing up as a huge gap
+                self.drops["transport"] += gap
+        self.last_seq = header.seq
+        times = {"capture": header.timestamp}
+        times.update(meta.get("t", {}) if meta else {})
+        times["receive"] = now
+        return Sample(header.seq, times)
+
+    def dropped(self, hop, count=1):
+        """Count frames lost at `hop` ("decode" failures, "display" skips, ...)."""
+        self.drops[hop] = self.drops.get(hop, 0) + count
+
+    def finish(self, sample):
+        """Record the hop-to-hop latencies of a sample that has been displayed (or otherwise consumed)."""
+        self.frames += 1
+        previous = None
+        for hop in HOPS:
+            t = sample.times.get(hop)
+            if t is None:
+                continue
+            if previous is not None:
+                self.samples[previous[0] + "->" + hop].append(t - previous[1])
+            previous = (hop, t)
+        if previous is not None and "capture" in sample.times:
+            self.samples["total"].append(previous[1] - sample.times["capture"])
+
+    @staticmethod
+    def _hop_order(name):
+        """Sort "a->b" hop names in pipeline order, "total" last."""
+        first = name.split("->")[0]
+        return HOPS.index(first) if first in HOPS else len(HOPS)
+
+    def summary(self, name):
+        values = sorted(self.samples.get(name, ()))
+        if not values:
+            return None
+        return {
+            "count": len(values),
+            "mean_ms": 1000.0 * sum(values) / len(values),
+            "p50_ms": 1000.0 * percentile(values, 50),
+            "p95_ms": 1000.0 * percentile(values, 95),
+            "p99_ms": 1000.0 * percentile(values, 99),
+            "max_ms": 1000.0 * values[-1],
+        }
+
+    def report(self):
+        """Machine-readable report (a dict, ready for json.dump)."""
+        elapsed = time.time() - self.start_time
+        hops = collections.OrderedDict()
+        for name in sorted(self.samples, key=self._hop_order):
+            hops[name] = self.summary(name)
+        return {
+            "frames": self.frames,
+            "duration_s": elapsed,
+            "fps": self.frames / elapsed if elapsed else 0.0,
+            "latency": hops,
+            "dropped": dict(self.drops),
+        }
+
+    def write_report(self, path, extra=None):
+        """Write report() as JSON, with any `extra` keys (run configuration, ...) merged in."""
+        report = self.report()
+        if extra:
+            report.update(extra)
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    def format_report(self):
+        """Human-readable version of report()."""
+        report = self.report()
+        lines = ["%d frames in %.1f s (%.1f fps)" % (report["frames"], report["duration_s"], report["fps"])]
+        for name, s in report["latency"].items():
+            if s is not None:
+                lines.append("  %-20s p50 %7.2f ms  p95 %7.2f ms  p99 %7.2f ms  (n=%d)"
+                             % (name, s["p50_ms"], s["p95_ms"], s["p99_ms"], s["count"]))
+        lines.append("  dropped: " + ", ".join("%s=%d" % kv for kv in sorted(report["dropped"].items())))
+        return "\n".join(lines)
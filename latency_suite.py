@@ -0,0 +1,96 @@
+"""
+Scripted glass-to-glass latency run against the simulated camera over loopback.
+
+Runs a JPEG server (SimulatedCamera -> imencode -> FrameHub) and a client
+(FrameReceiver -> imdecode -> "display") in one process on 127.0.0.1, so both
+ends share a clock, then writes a machine-readable report:
+
+    python latency_suite.py
+    cat latency_report.json
+
+Set SHOW_WINDOW = True to really cv2.imshow() every frame (needs a display);
+otherwise "display" is the moment the decoded frame is ready to be shown.
+"""
+import socket
+import threading
+import time
+
+import cv2
+import numpy as np
+
+import latency
+from frame_hub import FrameHub
+from frame_receiver import FrameReceiver
+from sim_camera import SimulatedCamera
+
+FRAME_SIZE = (1280, 720)
+FRAME_RATE = 30
+JPEG_QUALITY = 80
+DURATION = 10          # seconds
+CAMERA_SOURCE = "pattern"
+SHOW_WINDOW = False
+REPORT_PATH = "latency_report.json"
+
+
+def run_server(picam2, hub, stop):
+    seq = 0
+    while not stop.is_set():
+        frame = picam2.capture_array()
+        capture_time = time.time()
+        ret, buffer = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), JPEG_QUALITY])
+        if not ret:
+            continue
+        meta = latency.stamp({}, "encode")
+        seq += 1
+        latency.stamp(meta, "publish")
+        hub.publish(seq, buffer, timestamp=capture_time, meta=meta)
+
+
+def run_client(port, duration):
+    tracker = latency.LatencyTracker()
+    client_socket = socket.create_connection(("127.0.0.1", port))
+    receiver = FrameReceiver(client_socket)
+    end_time = time.time() + duration
+    try:
+        while time.time() < end_time:
+            header, meta, payload = receiver.recv_frame()
+            sample = tracker.received(header, meta)
+            frame = cv2.imdecode(np.frombuffer(payload, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if frame is None:
+                tracker.dropped("decode")
+                continue
+            sample.mark("decode")
+            if SHOW_WINDOW:
+                cv2.imshow("Latency suite", frame)
+                cv2.waitKey(1)
+            sample.mark("display")
+            tracker.finish(sample)
+    finally:
+        client_socket.close()
+    return tracker
+
+
+if __name__ == '__main__':
+    picam2 = SimulatedCamera(source=CAMERA_SOURCE, fps=FRAME_RATE)
+    picam2.configure(picam2.create_preview_configuration({"size": FRAME_SIZE}))
+    picam2.start()
+
+    hub = FrameHub(0, host="127.0.0.1").start()
+    stop = threading.Event()
+    server_thread = threading.Thread(target=run_server, args=(picam2, hub, stop), daemon=True)
+    server_thread.start()
+
+    tracker = run_client(hub.port, DURATION)
+
+    stop.set()
+    server_thread.join()
+    hub.close()
+    picam2.close()
+    if SHOW_WINDOW:
+        cv2.destroyAllWindows()
+
+    config = {"frame_size": FRAME_SIZE, "frame_rate": FRAME_RATE,
+              "jpeg_quality": JPEG_QUALITY, "source": CAMERA_SOURCE}
+    tracker.write_report(REPORT_PATH, extra={"config": config})
+    print(tracker.format_report())
+    print("Report written to", REPORT_PATH)
@@ -0,0 +1,83 @@
+"""
+Versioned latest-value store shared by a capture thread and its viewers.
+
+The MJPEG servers kept the newest JPEG in a global guarded by a lock, and
+every viewer's generator spun on that lock (`continue` while it was still
+None) and re-sent the same frame as fast as the socket took it: a core per
+viewer and mostly duplicate frames on the wire.
+
+LatestFrame instead numbers every published value. A viewer remembers the
+version it sent last and sleeps on a Condition until a newer one exists, so
+each frame goes out exactly once per viewer and an idle viewer costs nothing:
+
+    latest_frame = LatestFrame()
+
+    # capture thread
+    latest_frame.publish(buffer.tobytes())
+
+    # each viewer
+    version = 0
+    while True:
+        result = latest_frame.wait_newer(version, timeout=1.0)
+        if result is None:
+            continue  # timed out, nothing new
+        version, frame = result
+        yield frame
+
+Slow viewers simply skip versions; they always get the newest frame.
+close() wakes every viewer (wait_newer() returns None and `closed` is set)
+when the source has failed; reset() drops the last value and reopens the
+store for a new capture session.
+"""
+import threading
+
+
+class LatestFrame(object):
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.value = None
+        self.version = 0  # 0 = nothing published yet
+        self.closed = False
+
+    def publish(self, value):
+        """Replace the latest value and wake every waiting viewer. Returns its version."""
+        with self.cond:
+            self.value = value
+            self.version += 1
+            self.cond.notify_all()
+            return self.version
+
+    def get(self):
+        """(version, value) of the latest value, without waiting. value is None before the first publish()."""
+        with self.cond:
+            return self.version, self.value
+
+    def wait_newer(self, version, timeout=None):
+        """
+        Block until a value newer than `version` is published.
+
+        Returns (version, value) of the latest value, or None if `timeout`
+        seconds passed first or the store was closed.
+        """
+        with self.cond:
+            if not self.cond.wait_for(lambda: (self.version > version and self.value is not None)
+                                      or self.closed, timeout):
+                return None
+            if self.version <= version or self.value is None:
+                return None  # closed
+            return self.version, self.value
+
+    def reset(self):
+        """
+        Forget the latest value (so nobody is handed a stale frame from an
+        earlier session) and reopen a closed store. Versions keep counting up.
+        """
+        with self.cond:
+            self.value = None
+            self.closed = False
+
+    def close(self):
+        """Wake every waiting viewer; from now on wait_newer() returns None instead of blocking."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
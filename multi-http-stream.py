@@ -1,17 +1,35 @@
-from flask import Flask, Response
+from flask import Flask, Response, request
 import cv2
-from picamera2 import Picamera2
+from camera_backend import Picamera2
+from latest_frame import LatestFrame
+from adaptive_quality import QualityController
+from stream_variants import StreamVariants
+from snapshot import snapshot_response
+from async_mjpeg import AsyncMJPEGServer
 import threading
 import time
 
 app = Flask(__name__)
 
-# Global variables to hold the latest frame and a lock for thread safety.
-global_frame = None
-frame_lock = threading.Lock()
+# Serve the streams from one asyncio loop (async_mjpeg.py) instead of werkzeug's
+# thread-per-viewer server; the other routes still go to the Flask app.
+ASYNC_SERVER = False
+
+# The shared JPEG gets softer (lower quality, then smaller) when a viewer's
+# connection can't keep up, instead of falling behind (see adaptive_quality.py)
+ADAPTIVE_QUALITY = True
+# Optional bitrate cap in bits/s, e.g. 8000000 to keep the stream under a metered
+# or shared link's budget. None: step down only when viewers fall behind, since a
+# fixed cap also degrades a stream the link could carry in full.
+TARGET_BITRATE = None
+controller = QualityController(target_bitrate=TARGET_BITRATE)
+
+# The latest frame, shared by the capture thread and every viewer.
+latest_frame = LatestFrame()  # newest JPEG, versioned so viewers can wait for the next one
+# Resized / re-encoded variants for viewers that ask for them, each encoded once per frame
+variants = StreamVariants(max_width=1280, max_fps=30)
 
 def capture_frames():
-    global global_frame
     picam2 = Picamera2()
     config = picam2.create_preview_configuration({"size": (1280, 720)})
     picam2.configure(config)
@@ -39,13 +57,16 @@ def capture_frames():
         cv2.putText(frame, text, (x, y), font, font_scale, color, thickness)
 
         # Encode the frame as JPEG
-        ret, buffer = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), 80])
+        if ADAPTIVE_QUALITY:
+            ret, buffer = controller.encode(frame)
+        else:
+            ret, buffer = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), 80])
         if not ret:
             continue
 
-        # Update the global frame in a thread-safe way
-        with frame_lock:
-            global_frame = buffer.tobytes()
+        # Publish the new frame; wakes every waiting viewer
+        latest_frame.publish(buffer.tobytes())
+        variants.publish(frame)
 
         # Adjust delay as needed (e.g., for ~30 fps, use about 0.03 seconds)
         time.sleep(0.03)
@@ -57,20 +78,55 @@ thread.start()
 
 def gen_frames():
     """Generator function that yields the latest JPEG frame in MJPEG format."""
-    global global_frame
+    client = object()  # identifies this viewer to the quality controller
+    version = 0
     while True:
-        with frame_lock:
-            if global_frame is None:
-                continue
-            frame = global_frame
+        # Sleep until the capture thread publishes a frame this viewer hasn't had yet
+        result = latest_frame.wait_newer(version, timeout=1.0)
+        if result is None:
+            continue
+        version, frame = result
+        # Resumed once the server has written the part: time blocked sending to this viewer
+        send_start = time.perf_counter()
         yield (b'--frame\r\n'
                b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
+        controller.record_send(time.perf_counter() - send_start, client=client)
+
+def gen_variant_frames(key):
+    """MJPEG generator for one stream variant (see stream_variants.py)."""
+    with variants.subscription(key) as frames:
+        version = 0
+        while True:
+            result = frames.wait_newer(version, timeout=1.0)
+            if result is None:
+                continue
+            version, frame = result
+            yield (b'--frame\r\n'
+                   b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
 
 @app.route('/video')
 def video_feed():
+    # /video?width=&quality=&fps= picks a smaller/cheaper shared variant of the stream
+    width = request.args.get('width', type=int)
+    quality = request.args.get('quality', type=int)
+    fps = request.args.get('fps', type=int)
+    if width is not None or quality is not None or fps is not None:
+        return Response(gen_variant_frames(variants.select(width, quality, fps)),
+                        mimetype='multipart/x-mixed-replace; boundary=frame')
     return Response(gen_frames(),
                     mimetype='multipart/x-mixed-replace; boundary=frame')
 
+@app.route('/snapshot.jpg')
+def snapshot():
+    # Latest JPEG from memory; ETag/If-None-Match, and ?wait=<s> long-polls for the next frame
+    return snapshot_response(latest_frame, request)
+
 if __name__ == '__main__':
     # Run the Flask app on all interfaces.
-    app.run(host='0.0.0.0', port=8485, threaded=True)
+    if ASYNC_SERVER:
+        server = AsyncMJPEGServer(host='0.0.0.0', port=8485, wsgi_app=app)
+        server.add_stream('/video', latest_frame, on_send=controller.record_send)
+        server.add_snapshot('/snapshot.jpg', latest_frame)  # long polls wait on the event loop
+        server.run()
+    else:
+        app.run(host='0.0.0.0', port=8485, threaded=True)
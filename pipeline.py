@@ -0,0 +1,183 @@
+"""
+Threaded stage pipeline for the Pi servers.
+
+Running capture, processing, encoding and sending one after another on one
+thread caps the frame rate at 1 / (sum of all stage times). Here every stage
+gets its own thread and stages are connected by small bounded ring buffers,
+so the stages overlap on the Pi's four cores (OpenCV and socket calls release
+the GIL) and the frame rate is limited by the slowest stage only.
+
+Each ring buffer has a drop policy for when the next stage can't keep up:
+  - DROP_OLDEST: discard the oldest queued item (lowest latency, default)
+  - DROP_NEWEST: discard the incoming item
+  - BLOCK:       wait for space (no drops, back-pressure to the previous stage)
+
+Every stage counts items and busy time, and report() shows which stage is the
+bottleneck: the one with the highest time per item, i.e. the lowest ceiling on
+the frame rate. metrics.observe_pipeline() also records each stage's time
+per item in a histogram for /metrics.
+
+Usage:
+
+    pipeline = Pipeline(queue_size=2, drop_policy=DROP_OLDEST)
+    pipeline.add_stage("capture", capture)   # source: called with no argument
+    pipeline.add_stage("process", process)   # called with the previous stage's output
+    pipeline.add_stage("send", send)         # sink
+    pipeline.start()
+
+A stage function returns the item to pass on, or None to drop it.
+"""
+import collections
+import threading
+import time
+
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+BLOCK = "block"
+
+
+class Closed(Exception):
+    """Raised by RingBuffer.get() once the buffer is closed and empty."""
+
+
+class RingBuffer(object):
+    def __init__(self, capacity, drop_policy=DROP_OLDEST):
+        if drop_policy not in (DROP_OLDEST, DROP_NEWEST, BLOCK):
+            raise ValueError("Unknown drop policy: %r" % (drop_policy,))
+        self.capacity = capacity
+        self.drop_policy = drop_policy
+        self._items = collections.deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self.dropped = 0
+
+    def __len__(self):
+        with self._cond:
+            return len(self._items)
+
+    def put(self, item):
+        """Add an item. Returns False if an item was dropped to make it fit."""
+        with self._cond:
+            if len(self._items) >= self.capacity:
+                if self.drop_policy == DROP_OLDEST:
+                    self._items.popleft()
+                    self.dropped += 1
+                    self._items.append(item)
+                    self._cond.notify_all()
+                    return False
+                if self.drop_policy == DROP_NEWEST:
+                    self.dropped += 1
+                    return False
+                while len(self._items) >= self.capacity and not self._closed:
+                    self._cond.wait()
+            self._items.append(item)
+            self._cond.notify_all()
+            return True
+
+    def get(self):
+        """Block until an item is available. Raises Closed once closed and drained."""
+        with self._cond:
+            while not self._items:
+                if self._closed:
+                    raise Closed()
+                self._cond.wait()
+            item = self._items.popleft()
+            self._cond.notify_all()
+            return item
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class Stage(threading.Thread):
+    def __init__(self, name, func, inbox=None, outbox=None):
+        super(Stage, self).__init__(name=name, daemon=True)
+        self.func = func
+        self.inbox = inbox
+        self.outbox = outbox
+        self.running = True
+        self.items = 0
+        self.busy_time = 0.0
+        self.start_time = None
+        self.histogram = None  # metrics.Histogram, set by metrics.observe_pipeline()
+
+    def run(self):
+        self.start_time = time.perf_counter()
+        while self.running:
+            if self.inbox is None:
+                item = None
+            else:
+                try:
+                    item = self.inbox.get()
+                except Closed:
+                    break
+            t0 = time.perf_counter()
+            result = self.func() if self.inbox is None else self.func(item)
+            elapsed = time.perf_counter() - t0
+            self.busy_time += elapsed
+            if self.histogram is not None:
+                self.histogram.observe(elapsed)
+            if result is None:
+                continue
+            self.items += 1
+            if self.outbox is not None:
+                self.outbox.put(result)
+        if self.outbox is not None:
+            self.outbox.close()
+
+    def stats(self):
+        elapsed = time.perf_counter() - self.start_time if self.start_time else 0.0
+        return {
+            "stage": self.name,
+            "items": self.items,
+            "fps": self.items / elapsed if elapsed else 0.0,
+            "ms_per_item": 1000.0 * self.busy_time / self.items if self.items else 0.0,
+            "utilization": self.busy_time / elapsed if elapsed else 0.0,
+            "dropped_in": self.inbox.dropped if self.inbox is not None else 0,
+        }
+
+
+class Pipeline(object):
+    def __init__(self, queue_size=2, drop_policy=DROP_OLDEST):
+        self.queue_size = queue_size
+        self.drop_policy = drop_policy
+        self.stages = []
+
+    def add_stage(self, name, func, queue_size=None):
+        """Append a stage fed by the previous stage's output (queue_size overrides the pipeline's)."""
+        inbox = None
+        if self.stages:
+            inbox = RingBuffer(queue_size or self.queue_size, self.drop_policy)
+            self.stages[-1].outbox = inbox
+        self.stages.append(Stage(name, func, inbox=inbox))
+        return self
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+        return self
+
+    def stop(self):
+        """Stop the source stage; the rest drain their queues and exit."""
+        if self.stages:
+            self.stages[0].running = False
+        for stage in self.stages:
+            stage.join()
+
+    def stats(self):
+        return [stage.stats() for stage in self.stages]
+
+    def report(self):
+        """One line per stage; the bottleneck stage is marked with '<-'."""
+        stats = self.stats()
+        if not stats:
+            return ""
+        bottleneck = max(stats, key=lambda s: s["ms_per_item"])["stage"]
+        lines = []
+        for s in stats:
+            lines.append("%-10s %6.1f fps %7.2f ms/item %5.0f%% busy %6d dropped%s" % (
+                s["stage"], s["fps"], s["ms_per_item"], 100 * s["utilization"], s["dropped_in"],
+                "  <- bottleneck" if s["stage"] == bottleneck else ""))
+        return "\n".join(lines)
@@ -0,0 +1,85 @@
+"""
+Playback of recorded footage (segment_recorder.py) over HTTP.
+
+Reviewing footage used to mean pulling whole files off the Pi with
+scp_from_rpi.sh. playback_blueprint() adds these routes to a Flask app:
+
+  GET /recordings?start=&end=     JSON list of the segments overlapping a
+                                  capture-time range (Unix seconds, both
+                                  optional)
+  GET /recordings/find?t=         the segment and byte offset of the keyframe
+                                  to start decoding from to show time t
+  GET /recordings/<segment file>  a segment's .h264 or .idx file, with HTTP
+                                  range requests, so a player can seek
+                                  without downloading the whole segment
+
+The segment files are sent by Flask (send_from_directory, which honours
+Range) on the threaded server. Served through AsyncMJPEGServer, register
+them with add_files() as well, and they are streamed with os.sendfile
+straight from the page cache to the socket instead:
+
+    app.register_blueprint(playback_blueprint(RECORD_DIR))
+    server.add_files('/recordings/', RECORD_DIR, PLAYBACK_SUFFIXES)
+
+e.g. ffplay http://<pi>:8486/recordings/rec_20250101_120000_00000000.h264
+"""
+import os
+
+from flask import Blueprint, abort, jsonify, request, send_from_directory
+
+from segment_recorder import INDEX_SUFFIX, VIDEO_SUFFIX, RecordingIndex
+
+PLAYBACK_SUFFIXES = (VIDEO_SUFFIX, INDEX_SUFFIX)
+MIMETYPES = {VIDEO_SUFFIX: "video/h264", INDEX_SUFFIX: "application/octet-stream"}
+
+
+def _segment_json(segment, url_prefix):
+    return {
+        "name": segment.name,
+        "start": segment.start_time,
+        "end": segment.end_time,
+        "frames": segment.frames,
+        "bytes": segment.bytes,
+        "url": url_prefix + "/" + segment.name + VIDEO_SUFFIX,
+        "index_url": url_prefix + "/" + segment.name + INDEX_SUFFIX,
+    }
+
+
+def playback_blueprint(directory, prefix="rec", url_prefix="/recordings"):
+    """Flask blueprint serving the recording in `directory` under `url_prefix`."""
+    directory = os.path.abspath(directory)
+    recording = RecordingIndex(directory, prefix=prefix)
+    blueprint = Blueprint("playback", __name__)
+
+    @blueprint.route(url_prefix)
+    def list_recordings():
+        start = request.args.get('start', type=float)
+        end = request.args.get('end', type=float)
+        if not os.path.isdir(directory):
+            return jsonify(segments=[])
+        segments = recording.segments(start=start, end=end)
+        return jsonify(segments=[_segment_json(segment, url_prefix) for segment in segments])
+
+    @blueprint.route(url_prefix + '/find')
+    def find_recording():
+        t = request.args.get('t', type=float)
+        if t is None:
+            abort(400)
+        found = recording.keyframe_at(t) if os.path.isdir(directory) else None
+        if found is None or found[1] is None:
+            abort(404)
+        segment, entry = found
+        result = _segment_json(segment, url_prefix)
+        result.update(frame=entry.frame, timestamp=entry.timestamp, offset=entry.offset,
+                      size=entry.size, keyframe=entry.keyframe)
+        return jsonify(result)
+
+    @blueprint.route(url_prefix + '/<name>')
+    def segment_file(name):
+        suffix = os.path.splitext(name)[1]
+        if suffix not in PLAYBACK_SUFFIXES:
+            abort(404)
+        # send_from_directory refuses paths outside `directory` and answers Range requests.
+        return send_from_directory(directory, name, mimetype=MIMETYPES[suffix], conditional=True)
+
+    return blueprint
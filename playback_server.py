@@ -0,0 +1,24 @@
+from flask import Flask
+
+from async_mjpeg import AsyncMJPEGServer
+from playback import MIMETYPES, PLAYBACK_SUFFIXES, playback_blueprint
+
+# -------------------------------
+# Playback of the segments server_side.py records (see playback.py).
+# -------------------------------
+RECORD_DIR = "recordings"   # Same directory as RECORD_DIR in server_side.py.
+PORT = 8486                 # The live streams use 8485.
+# Send the segment files with os.sendfile from the asyncio front end
+# (async_mjpeg.py); False uses Flask's threaded server for everything.
+ASYNC_SERVER = True
+
+app = Flask(__name__)
+app.register_blueprint(playback_blueprint(RECORD_DIR))
+
+if __name__ == '__main__':
+    if ASYNC_SERVER:
+        server = AsyncMJPEGServer(port=PORT, wsgi_app=app)
+        server.add_files('/recordings/', RECORD_DIR, PLAYBACK_SUFFIXES, MIMETYPES)
+        server.run()
+    else:
+        app.run(host='0.0.0.0', port=PORT, threaded=True)
@@ -0,0 +1,271 @@
+"""
+Segmented H.264 recording with a binary frame index.
+
+server_side.py used to record into one unbounded testvideo.h264: nothing
+ever deleted it, and finding the frame at a given time meant parsing the
+whole file. SegmentRecorder writes the encoder output as rolling segments
+instead, each with a compact index next to it:
+
+  <prefix>_<date>_<time>_<first frame>.h264   raw Annex B access units
+  <prefix>_<date>_<time>_<first frame>.idx    one INDEX_RECORD per frame
+
+A segment is closed after `segment_seconds`, at the next keyframe, so every
+segment starts on a keyframe and plays on its own. When a segment closes
+the oldest ones are deleted until the recording fits in `max_bytes` and
+nothing is older than `max_age` seconds.
+
+Index records have a fixed size, so RecordingIndex finds the frame at a
+time with a binary search over the segment start times and then one over
+the segment's index (memory-mapped), and reads the frame with one pread:
+
+    recorder = SegmentRecorder("recordings", segment_seconds=60, max_bytes=2 << 30)
+    encoder = h264_stream.create_encoder(..., sink=recorder.write)
+    ...
+    recording = RecordingIndex("recordings")
+    segment, entry = recording.keyframe_at(time.time() - 30)
+    data = recording.read_frame(segment, entry)
+"""
+import collections
+import mmap
+import os
+import struct
+import time
+
+# frame number, capture time, byte offset, size, flags
+INDEX_RECORD = struct.Struct("!QdQIB")
+FLAG_KEYFRAME = 0x01
+
+DEFAULT_SEGMENT_SECONDS = 60.0
+VIDEO_SUFFIX = ".h264"
+INDEX_SUFFIX = ".idx"
+
+IndexEntry = collections.namedtuple("IndexEntry", "frame timestamp offset size keyframe")
+
+
+def _unpack_entry(buf, i):
+    frame, timestamp, offset, size, flags = INDEX_RECORD.unpack_from(buf, i * INDEX_RECORD.size)
+    return IndexEntry(frame, timestamp, offset, size, bool(flags & FLAG_KEYFRAME))
+
+
+class SegmentRecorder(object):
+    def __init__(self, directory, segment_seconds=DEFAULT_SEGMENT_SECONDS, max_bytes=None, max_age=None,
+                 prefix="rec"):
+        self.directory = directory
+        self.segment_seconds = segment_seconds
+        self.max_bytes = max_bytes    # None: no size limit
+        self.max_age = max_age        # seconds, None: no age limit
+        self.prefix = prefix
+        self.frame = 0                # number of the next frame, continuous across segments
+        self.segments_written = 0
+        self.segments_deleted = 0
+        self._video = None
+        self._index = None
+        self._segment_start = None
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, data, keyframe, timestamp=None):
+        """
+        Record one access unit. Has the sink(data, keyframe, timestamp)
+        signature of h264_stream, so it can be handed straight to an encoder.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        if keyframe and (self._video is None or timestamp - self._segment_start >= self.segment_seconds):
+            self._roll(timestamp)
+        if self._video is None:
+            return  # Nothing decodable before the first keyframe.
+        offset = self._video.tell()
+        self._video.write(data)
+        self._index.write(INDEX_RECORD.pack(self.frame, timestamp, offset, len(data),
+                                            FLAG_KEYFRAME if keyframe else 0))
+        self.frame += 1
+        if keyframe:
+            # Once per GOP, so playback can follow the open segment closely.
+            self._video.flush()
+            self._index.flush()
+
+    def _roll(self, timestamp):
+        self._close_segment()
+        name = "%s_%s_%08d" % (self.prefix, time.strftime("%Y%m%d_%H%M%S", time.localtime(timestamp)), self.frame)
+        base = os.path.join(self.directory, name)
+        self._video = open(base + VIDEO_SUFFIX, "wb")
+        self._index = open(base + INDEX_SUFFIX, "wb")
+        self._segment_start = timestamp
+        self.enforce_retention(now=timestamp)
+
+    def _close_segment(self):
+        if self._video is None:
+            return
+        self._video.close()
+        self._index.close()
+        self._video = self._index = None
+        self.segments_written += 1
+
+    def enforce_retention(self, now=None):
+        """Delete the oldest closed segments until the size and age limits hold."""
+        if self.max_bytes is None and self.max_age is None:
+            return
+        if now is None:
+            now = time.time()
+        index = RecordingIndex(self.directory, prefix=self.prefix)
+        segments = index.segments()
+        total = sum(segment.bytes for segment in segments)
+        open_name = os.path.basename(self._video.name) if self._video is not None else None
+        for segment in segments:
+            if segment.name + VIDEO_SUFFIX == open_name:
+                break  # never delete the segment being written
+            too_big = self.max_bytes is not None and total > self.max_bytes
+            too_old = self.max_age is not None and now - segment.end_time > self.max_age
+            if not (too_big or too_old):
+                break
+            total -= segment.bytes
+            for path in (segment.video_path, segment.index_path):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            self.segments_deleted += 1
+
+    def close(self):
+        self._close_segment()
+
+
+class Segment(object):
+    """One recorded segment: its files and the capture times it covers."""
+
+    def __init__(self, directory, name):
+        self.name = name
+        self.video_path = os.path.join(directory, name + VIDEO_SUFFIX)
+        self.index_path = os.path.join(directory, name + INDEX_SUFFIX)
+        self.frames = 0
+        self.start_time = self.end_time = None
+        self.bytes = 0
+        self._load()
+
+    def _load(self):
+        """Read the first and last index records (the segment may still be growing)."""
+        with open(self.index_path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            self.frames = size // INDEX_RECORD.size
+            if self.frames == 0:
+                return
+            first = INDEX_RECORD.unpack(f.read(INDEX_RECORD.size))
+            f.seek((self.frames - 1) * INDEX_RECORD.size)
+            last = INDEX_RECORD.unpack(f.read(INDEX_RECORD.size))
+        self.start_time, self.end_time = first[1], last[1]
+        self.bytes = last[2] + last[3] + size
+
+    def entries(self):
+        """The index memory-mapped: (mmap, count). Caller closes the mmap."""
+        with open(self.index_path, "rb") as f:
+            count = os.fstat(f.fileno()).st_size // INDEX_RECORD.size
+            if count == 0:
+                return None, 0
+            return mmap.mmap(f.fileno(), count * INDEX_RECORD.size, access=mmap.ACCESS_READ), count
+
+    def find(self, timestamp, keyframe=False):
+        """
+        Index entry of the last frame captured at or before `timestamp` (the
+        first frame if it's earlier). keyframe=True returns the last keyframe
+        at or before it instead, where a decoder can start.
+        """
+        buf, count = self.entries()
+        if buf is None:
+            return None
+        try:
+            lo, hi = 0, count
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if INDEX_RECORD.unpack_from(buf, mid * INDEX_RECORD.size)[1] <= timestamp:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            i = max(lo - 1, 0)
+            if keyframe:
+                # A GOP back at most; segments always start on a keyframe.
+                while i > 0 and not _unpack_entry(buf, i).keyframe:
+                    i -= 1
+            return _unpack_entry(buf, i)
+        finally:
+            buf.close()
+
+
+class RecordingIndex(object):
+    """Looks up recorded segments and frames by capture time."""
+
+    def __init__(self, directory, prefix="rec"):
+        self.directory = directory
+        self.prefix = prefix
+
+    def names(self):
+        """Segment names, oldest first (the names sort by start time)."""
+        return sorted(f[:-len(INDEX_SUFFIX)] for f in os.listdir(self.directory)
+                      if f.startswith(self.prefix + "_") and f.endswith(INDEX_SUFFIX))
+
+    def segments(self, start=None, end=None):
+        """Segments (oldest first) that overlap the capture-time range [start, end]."""
+        segments = []
+        for name in self.names():
+            try:
+                segment = Segment(self.directory, name)
+            except FileNotFoundError:
+                continue  # deleted by retention meanwhile
+            if segment.frames == 0:
+                continue
+            if start is not None and segment.end_time < start:
+                continue
+            if end is not None and segment.start_time > end:
+                continue
+            segments.append(segment)
+        return segments
+
+    def _locate(self, timestamp):
+        """The segment that would hold `timestamp`, loading only O(log n) of them."""
+        names = self.names()
+        loaded = {}
+
+        def start_time(i):
+            if i not in loaded:
+                try:
+                    loaded[i] = Segment(self.directory, names[i])
+                except FileNotFoundError:
+                    loaded[i] = None
+            segment = loaded[i]
+            # Empty or vanished segments sort as "before", they hold nothing anyway.
+            return segment.start_time if segment is not None and segment.frames else float("-inf")
+
+        lo, hi = 0, len(names)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if start_time(mid) <= timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        # The last segment starting at or before `timestamp`, else the first one with frames.
+        for i in list(range(lo - 1, -1, -1)) + list(range(lo, len(names))):
+            start_time(i)
+            if loaded[i] is not None and loaded[i].frames:
+                return loaded[i]
+        return None
+
+    def find(self, timestamp):
+        """(segment, IndexEntry) of the frame captured at or just before `timestamp`, or None."""
+        segment = self._locate(timestamp)
+        if segment is None:
+            return None
+        return segment, segment.find(timestamp)
+
+    def keyframe_at(self, timestamp):
+        """(segment, IndexEntry) of the keyframe to start decoding from to show `timestamp`."""
+        segment = self._locate(timestamp)
+        if segment is None:
+            return None
+        return segment, segment.find(timestamp, keyframe=True)
+
+    def read_frame(self, segment, entry):
+        """The access unit bytes of `entry`, in one read."""
+        fd = os.open(segment.video_path, os.O_RDONLY)
+        try:
+            return os.pread(fd, entry.size, entry.offset)
+        finally:
+            os.close(fd)
@@ -1,56 +1,152 @@
-import socket
-import pickle
-import struct
+import time
 import cv2
-from picamera2 import Picamera2
-from picamera2.encoders import H264Encoder
+from frame_hub import FrameHub
+from adaptive_quality import QualityController, observe_hub
+import h264_stream
+import latency
+import metrics
+from segment_recorder import SegmentRecorder
+import camera_backend
+from camera_backend import Picamera2
 
 # Set up the server socket
 SERVER_IP = ''  # Listen on all available interfaces
 SERVER_PORT = 8485
 
-server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-server_socket.bind((SERVER_IP, SERVER_PORT))
-server_socket.listen(0)
-print("Server listening on port", SERVER_PORT)
+# Viewers can connect and disconnect at any time; each gets every encoded frame.
+hub = FrameHub(SERVER_PORT, host=SERVER_IP)
+hub.start()
 
-# Wait for a client to connect
-conn, addr = server_socket.accept()
-print("Connected by:", addr)
+# Stream mode: "jpeg" sends one JPEG per frame, "h264" sends H.264 access units
+# (several times less bandwidth at the same resolution).
+STREAM_MODE = "jpeg"
+# "hardware" (Pi V4L2 encoder) or "software" (libx264 via PyAV, any Linux box)
+H264_ENCODER = "software" if camera_backend.SIMULATED else "hardware"
+H264_BITRATE = 2000000
+FRAME_SIZE = (320, 180)
+FRAME_RATE = 30
+# JPEG mode: lower quality / resolution when the link is congested (see adaptive_quality.py)
+ADAPTIVE_QUALITY = True
+TARGET_LATENCY = 0.15     # seconds capture -> viewer (acked), None for no latency target
+# Optional bitrate cap in bits/s, e.g. 4000000 for a metered or shared link. None:
+# step down only on latency, send time and queue drops, which track the real link.
+TARGET_BITRATE = None
+# H.264 recording: rolling segments with a frame index (see segment_recorder.py)
+RECORD = True
+RECORD_DIR = "recordings"
+SEGMENT_SECONDS = 60
+RECORD_MAX_BYTES = 4 * 1024 ** 3   # oldest segments are deleted beyond this, None for no limit
+RECORD_MAX_AGE = 7 * 24 * 3600     # seconds, None for no limit
+METRICS_PORT = 9108  # Prometheus /metrics (per-stage histograms, see metrics.py); None to disable.
+
+CAPTURE_SECONDS = metrics.STAGE_SECONDS.labels("server_side", "capture")
+RECORD_SECONDS = metrics.STAGE_SECONDS.labels("server_side", "record")
+ENCODE_SECONDS = metrics.STAGE_SECONDS.labels("server_side", "encode")
+FRAMES_CAPTURED = metrics.FRAMES.labels("server_side", "capture")
+FRAMES_ENCODED = metrics.FRAMES.labels("server_side", "encode")
+if METRICS_PORT is not None:
+    metrics.start_http_server(METRICS_PORT)
 
 # Initialize the Picamera2 instance and start the camera
 picam2 = Picamera2()
 #config = picam2.create_preview_configuration({"size": (1280, 720)})
-config = picam2.create_preview_configuration({"size": (320, 180)})
+config = picam2.create_preview_configuration({"size": FRAME_SIZE})
 picam2.configure(config)
-encoder = H264Encoder()
-picam2.start_recording(encoder,"testvideo.h264")
-#picam2.start()
+
+recorder = SegmentRecorder(RECORD_DIR, segment_seconds=SEGMENT_SECONDS, max_bytes=RECORD_MAX_BYTES,
+                           max_age=RECORD_MAX_AGE) if RECORD else None
+
+def stream_jpeg():
+    encoder = None
+    if recorder is not None:
+        try:
+            encoder = h264_stream.create_encoder(H264_ENCODER, picam2, recorder.write,
+                                                 width=FRAME_SIZE[0], height=FRAME_SIZE[1], fps=FRAME_RATE,
+                                                 bitrate=H264_BITRATE)
+        except RuntimeError as e:
+            print("Recording disabled:", e)
+    if encoder is not None:
+        encoder.start()
+    else:
+        picam2.start()
+
+    controller = QualityController(target_bitrate=TARGET_BITRATE, target_latency=TARGET_LATENCY)
+    seq = 0
+    try:
+        while True:
+            # Capture a frame from the camera as a NumPy array (compatible with OpenCV)
+            t0 = time.perf_counter()
+            frame = picam2.capture_array()
+            capture_time = time.time()
+            t1 = time.perf_counter()
+            CAPTURE_SECONDS.observe(t1 - t0)
+            FRAMES_CAPTURED.inc()
+            if encoder is not None:
+                encoder.encode(frame, capture_time)  # no-op for the hardware encoder, the camera feeds it
+                RECORD_SECONDS.observe(time.perf_counter() - t1)
+
+            # Nobody watching: skip the JPEG encode (H.264 recording keeps running)
+            if hub.subscriber_count == 0:
+                continue
+
+            # Optionally, you can add overlay text (uncomment the next lines if desired)
+            # text = "Live Stream"
+            # position = (10, 30)
+            # cv2.putText(frame, text, position, cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2)
+
+            # Encode the frame as JPEG
+            t0 = time.perf_counter()
+            if ADAPTIVE_QUALITY:
+                observe_hub(controller, hub)
+                level = controller.level
+                ret, buffer = controller.encode(frame)
+                if controller.level != level:
+                    print("Stream quality:", controller.status())
+            else:
+                ret, buffer = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), 80])
+            if not ret:
+                continue
+            ENCODE_SECONDS.observe(time.perf_counter() - t0)
+            FRAMES_ENCODED.inc()
+
+            meta = latency.stamp({}, "encode")
+
+            # Queue header + JPEG for every connected viewer (encoded once, no copies)
+            seq += 1
+            latency.stamp(meta, "publish")
+            hub.publish(seq, buffer, timestamp=capture_time, meta=meta)
+    finally:
+        # Stop (and flush) the recording encoder before the recorder is closed.
+        if encoder is not None:
+            encoder.stop()
+
+def stream_h264():
+    # The same encoder records the segments and feeds the viewers.
+    sink = h264_stream.tee_sink(h264_stream.hub_sink(hub), recorder.write if recorder is not None else None)
+    encoder = h264_stream.create_encoder(H264_ENCODER, picam2, sink,
+                                         width=FRAME_SIZE[0], height=FRAME_SIZE[1], fps=FRAME_RATE,
+                                         bitrate=H264_BITRATE)
+    encoder.start()
+    try:
+        while True:
+            if H264_ENCODER == "hardware":
+                # The camera feeds the hardware encoder directly; nothing to do here.
+                time.sleep(1)
+            else:
+                frame = picam2.capture_array()
+                encoder.encode(frame, time.time())
+    finally:
+        encoder.stop()
 
 try:
-    while True:
-        # Capture a frame from the camera as a NumPy array (compatible with OpenCV)
-        frame = picam2.capture_array()
-
-        # Optionally, you can add overlay text (uncomment the next lines if desired)
-        # text = "Live Stream"
-        # position = (10, 30)
-        # cv2.putText(frame, text, position, cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2)
-
-        # Serialize (pickle) the frame
-        # On the server side:
-        ret, buffer = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), 80])
-        data = pickle.dumps(buffer)
-        #data = pickle.dumps(frame)
-        
-        # Pack the size of the pickled data (header) using an unsigned long
-        message_size = struct.pack("L", len(data))
-        
-        # Send header and data over the socket
-        conn.sendall(message_size + data)
+    if STREAM_MODE == "h264":
+        stream_h264()
+    else:
+        stream_jpeg()
 except Exception as e:
     print("Error:", e)
 finally:
-    conn.close()
-    server_socket.close()
+    if recorder is not None:
+        recorder.close()
+    hub.close()
     picam2.close()
@@ -0,0 +1,202 @@
+"""
+Simulated Picamera2 for running and benchmarking the servers without a Pi.
+
+SimulatedCamera implements the part of the Picamera2 API the servers use
+(create_preview_configuration / create_video_configuration, configure, start,
+capture_array, start_recording, stop, close) and produces frames from:
+
+  - "pattern"         synthetic scene: dark balls bouncing over a light,
+                      slightly noisy background (good for the contour and
+                      Hough detectors)
+  - a video file      anything cv2.VideoCapture can open; loops at the end
+  - an image sequence a directory or glob pattern ("frames/*.png"), cycled
+
+at the configured resolution and frame rate. capture_array() blocks until the
+next frame is due, like the real sensor, and returns a new array every call.
+Frames are XBGR8888 (4 channels) by default, matching Picamera2's default
+format and byte order; ask for "RGB888"/"BGR888" in the configuration to get
+3 channels.
+
+Normally picked through camera_backend.py (RPI_CAMERA=sim).
+"""
+import glob
+import os
+import time
+
+import cv2
+import numpy as np
+
+DEFAULT_SIZE = (640, 480)
+DEFAULT_FPS = 30
+DEFAULT_FORMAT = "XBGR8888"
+NUM_BALLS = 2
+
+
+class SimulatedCamera(object):
+    def __init__(self, source="pattern", fps=DEFAULT_FPS, camera_num=0):
+        self.source = source
+        self.fps = fps
+        self.camera_num = camera_num
+        self.size = DEFAULT_SIZE
+        self.format = DEFAULT_FORMAT
+        self.started = False
+        self.frame_index = 0
+        self._next_frame_time = None
+        self._capture = None
+        self._images = None
+        self._image_cache = {}
+        self._balls = None
+        self._background = None
+        self._rng = np.random.default_rng(camera_num)
+
+    # -------------------------------
+    # Configuration (same shape as Picamera2's dicts)
+    # -------------------------------
+    def _configuration(self, main, default_size, **kwargs):
+        main = dict(main or {})
+        main.setdefault("size", default_size)
+        main.setdefault("format", DEFAULT_FORMAT)
+        config = {"main": main, "controls": dict(kwargs.get("controls") or {})}
+        if "FrameRate" in config["controls"]:
+            config["fps"] = config["controls"]["FrameRate"]
+        return config
+
+    def create_preview_configuration(self, main=None, **kwargs):
+        return self._configuration(main, (640, 480), **kwargs)
+
+    def create_video_configuration(self, main=None, **kwargs):
+        return self._configuration(main, (1280, 720), **kwargs)
+
+    def create_still_configuration(self, main=None, **kwargs):
+        return self._configuration(main, (1920, 1080), **kwargs)
+
+    def configure(self, config):
+        main = config.get("main", {}) if config else {}
+        self.size = tuple(main.get("size", DEFAULT_SIZE))
+        self.format = main.get("format", DEFAULT_FORMAT)
+        self.fps = config.get("fps", self.fps) if config else self.fps
+        self._balls = None
+        self._background = None
+        self._image_cache = {}
+
+    # -------------------------------
+    # Start / stop
+    # -------------------------------
+    def start(self, config=None, show_preview=False):
+        if config is not None:
+            self.configure(config)
+        if self.source != "pattern" and self._capture is None and self._images is None:
+            self._open_source()
+        self.started = True
+        self._next_frame_time = time.perf_counter()
+
+    def start_recording(self, encoder, output, *args, **kwargs):
+        # There is no hardware encoder to simulate; just run the camera.
+        # (Use the "software" encoder in h264_stream.py for an H.264 stream.)
+        print("SimulatedCamera: recording to %r is not simulated" % (output,))
+        self.start()
+
+    def stop_recording(self):
+        self.stop()
+
+    def stop(self):
+        self.started = False
+
+    def close(self):
+        self.stop()
+        if self._capture is not None:
+            self._capture.release()
+            self._capture = None
+
+    # -------------------------------
+    # Frames
+    # -------------------------------
+    def _open_source(self):
+        if os.path.isdir(self.source):
+            self._images = sorted(glob.glob(os.path.join(self.source, "*")))
+        elif any(ch in self.source for ch in "*?["):
+            self._images = sorted(glob.glob(self.source))
+        else:
+            self._capture = cv2.VideoCapture(self.source)
+            if not self._capture.isOpened():
+                raise RuntimeError("SimulatedCamera: cannot open video source %r" % self.source)
+            return
+        if not self._images:
+            raise RuntimeError("SimulatedCamera: no images found for %r" % self.source)
+
+    def _pattern_frame(self):
+        w, h = self.size
+        if self._background is None:
+            # Light vertical gradient with a little fixed noise so thresholds have texture.
+            gradient = np.linspace(170, 230, h, dtype=np.float32)[:, None]
+            noise = self._rng.normal(0, 4, (h, w)).astype(np.float32)
+            gray = np.clip(gradient + noise, 0, 255).astype(np.uint8)
+            self._background = cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
+        if self._balls is None:
+            self._balls = []
+            for _ in range(NUM_BALLS):
+                radius = max(4, int(min(w, h) * self._rng.uniform(0.04, 0.08)))
+                self._balls.append({
+                    "pos": np.array([self._rng.uniform(radius, w - radius), self._rng.uniform(radius, h - radius)]),
+                    "vel": self._rng.uniform(-1, 1, 2) * min(w, h) / 60.0,
+                    "radius": radius,
+                })
+        frame = self._background.copy()
+        for ball in self._balls:
+            ball["pos"] += ball["vel"]
+            for axis, limit in ((0, w), (1, h)):
+                if not ball["radius"] <= ball["pos"][axis] <= limit - ball["radius"]:
+                    ball["vel"][axis] = -ball["vel"][axis]
+                    ball["pos"][axis] = np.clip(ball["pos"][axis], ball["radius"], limit - ball["radius"])
+            center = (int(ball["pos"][0]), int(ball["pos"][1]))
+            cv2.circle(frame, center, ball["radius"], (40, 40, 40), -1)
+        return frame
+
+    def _video_frame(self):
+        ret, frame = self._capture.read()
+        if not ret:
+            # Loop the file.
+            self._capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ret, frame = self._capture.read()
+            if not ret:
+                raise RuntimeError("SimulatedCamera: cannot read from %r" % self.source)
+        return cv2.resize(frame, self.size)
+
+    def _image_frame(self):
+        index = self.frame_index % len(self._images)
+        frame = self._image_cache.get(index)
+        if frame is None:
+            frame = cv2.resize(cv2.imread(self._images[index], cv2.IMREAD_COLOR), self.size)
+            self._image_cache[index] = frame
+        return frame.copy()
+
+    def capture_array(self, name="main"):
+        if not self.started:
+            raise RuntimeError("Camera must be started before capture_array()")
+
+        # Pace like a sensor: block until the next frame is due.
+        now = time.perf_counter()
+        if self._next_frame_time > now:
+            time.sleep(self._next_frame_time - now)
+        else:
+            # Running late: don't try to catch up with a burst of frames.
+            self._next_frame_time = now
+        self._next_frame_time += 1.0 / self.fps
+
+        if self._capture is not None:
+            frame = self._video_frame()
+        elif self._images is not None:
+            frame = self._image_frame()
+        else:
+            frame = self._pattern_frame()
+        self.frame_index += 1
+
+        # Same in-memory byte order as Picamera2 (its format names are little-endian):
+        # XBGR8888 -> [R, G, B, 255], XRGB8888 -> [B, G, R, 255], RGB888 -> [B, G, R], BGR888 -> [R, G, B].
+        if self.format == "XBGR8888":
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGBA)
+        elif self.format == "XRGB8888":
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2BGRA)
+        elif self.format == "BGR888":
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        return frame
@@ -0,0 +1,87 @@
+"""
+/snapshot.jpg for the Flask apps: the latest already-encoded JPEG, cheaply.
+
+Dashboards used to grab stills by opening /video and keeping the first
+frame, a full MJPEG stream setup per poll. snapshot_response() serves the
+current JPEG straight from a LatestFrame (no encode) with the frame version
+as its ETag, so a poller that sends If-None-Match gets a bodyless 304 while
+the frame hasn't changed. Adding ?wait=<seconds> turns that into a long
+poll: the request blocks (up to MAX_WAIT) until a frame newer than the one
+named in If-None-Match exists, so a client can follow the camera at its
+frame rate with plain GETs:
+
+    @app.route('/snapshot.jpg')
+    def snapshot():
+        return snapshot_response(latest_frame, request)
+
+ETags carry a per-process prefix so versions from before a server restart
+never match.
+
+A Flask long poll holds its server thread for the whole wait. Under
+AsyncMJPEGServer, whose WSGI pool has only a few threads, register the route
+with server.add_snapshot('/snapshot.jpg', latest_frame) instead: the poll
+then waits on the event loop, with the same headers from snapshot_result().
+"""
+import time
+
+MAX_WAIT = 10.0  # longest long poll, seconds
+_ETAG_PREFIX = "%x" % int(time.time() * 1000)
+
+
+def etag_for(version):
+    return '"%s-%d"' % (_ETAG_PREFIX, version)
+
+
+def client_version(if_none_match):
+    """The frame version named in an If-None-Match header, or None."""
+    if not if_none_match:
+        return None
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        prefix, _, version = tag.strip('"').rpartition("-")
+        if prefix == _ETAG_PREFIX and version.isdigit():
+            return int(version)
+    return None
+
+
+def parse_wait(value):
+    """?wait= in seconds, at most MAX_WAIT (0 when missing or not a number)."""
+    try:
+        wait = float(value or 0.0)
+    except ValueError:
+        return 0.0
+    return min(max(wait, 0.0), MAX_WAIT)
+
+
+def snapshot_result(version, jpeg, client_version):
+    """(status, headers, body) for frame `version` of a client that already has `client_version`."""
+    if jpeg is None:
+        return 503, {"Retry-After": "1"}, b""
+    headers = {
+        "ETag": etag_for(version),
+        "Cache-Control": "no-cache",  # always revalidate; a 304 is nearly free
+        "X-Frame-Version": str(version),
+    }
+    if version == client_version:
+        return 304, headers, b""
+    headers["Content-Type"] = "image/jpeg"
+    return 200, headers, jpeg
+
+
+def snapshot_response(frames, request):
+    """Flask response for a snapshot of `frames` (a LatestFrame holding JPEG bytes)."""
+    from flask import Response  # AsyncMJPEGServer uses the rest of this module without Flask
+
+    wait = parse_wait(request.args.get('wait'))
+    known = client_version(request.headers.get('If-None-Match'))
+    version, jpeg = frames.get()
+
+    if wait > 0 and (jpeg is None or version == known):
+        result = frames.wait_newer(version, timeout=wait)
+        if result is not None:
+            version, jpeg = result
+
+    status, headers, body = snapshot_result(version, jpeg, known)
+    return Response(body, status=status, headers=headers)
@@ -1,12 +1,20 @@
 import socket
-import pickle
-import struct
 import threading
 import time
 import cv2
 import numpy as np
 import os
-from flask import Flask, Response, render_template_string, jsonify
+import sys
+from flask import Flask, Response, render_template_string, jsonify, request, abort
+
+# Shared modules (frame_protocol, frame_receiver, ...) live one directory up.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from frame_receiver import FrameReceiver
+from latest_frame import LatestFrame
+from async_mjpeg import AsyncMJPEGServer
+from snapshot import snapshot_response
+import metrics
 
 # -------------------------
 # Global variables to store the latest payload for each camera.
@@ -15,6 +23,10 @@ latest_payload1 = None
 latest_payload2 = None
 payload_lock1 = threading.Lock()
 payload_lock2 = threading.Lock()
+# Latest JPEG per camera and of the scene view, versioned so the MJPEG feeds
+# send each frame once and sleep in between.
+latest_frames = {1: LatestFrame(), 2: LatestFrame()}
+scene_frames = LatestFrame()
 
 # -------------------------
 # Settings for the two Pi‑camera servers.
@@ -22,6 +34,17 @@ payload_lock2 = threading.Lock()
 PI1_SERVER_IP = "192.168.1.190"  # CHANGE THIS to the IP address for camera 1
 PI2_SERVER_IP = "192.168.1.184"# CHANGE THIS to the IP address for camera 2
 PI_SERVER_PORT = 8485
+# Serve the feeds from one asyncio loop (async_mjpeg.py) instead of werkzeug's
+# thread-per-viewer server; the other routes still go to the Flask app.
+ASYNC_SERVER = False
+
+# Per-stage timings for /metrics (see metrics.py); receive times and bytes
+# come from FrameReceiver itself.
+# Written by both camera receiver threads.
+FANOUT_SECONDS = metrics.STAGE_SECONDS.labels("c2", "fanout", shared=True)
+SCENE_SECONDS = metrics.STAGE_SECONDS.labels("c2", "scene")
+ENCODE_SECONDS = metrics.STAGE_SECONDS.labels("c2", "encode")
+FRAMES_RECEIVED = {cam_id: metrics.FRAMES.labels("c2", "receive_cam%d" % cam_id) for cam_id in (1, 2)}
 
 def socket_receiver(ip, port, lock, cam_id):
     global latest_payload1, latest_payload2
@@ -32,35 +55,29 @@ def socket_receiver(ip, port, lock, cam_id):
     except Exception as e:
         print("Error connecting to Pi server at", ip, e)
         return
-    data = b""
-    payload_size = struct.calcsize(">L")
+    receiver = FrameReceiver(s)
     while True:
         try:
-            while len(data) < payload_size:
-                packet = s.recv(4096)
-                if not packet:
-                    print("Connection closed by server at", ip)
-                    return
-                data += packet
-            packed_msg_size = data[:payload_size]
-            data = data[payload_size:]
-            msg_size = struct.unpack(">L", packed_msg_size)[0]
-            while len(data) < msg_size:
-                packet = s.recv(4096)
-                if not packet:
-                    print("Connection closed by server at", ip)
-                    return
-                data += packet
-            frame_data = data[:msg_size]
-            data = data[msg_size:]
-            payload = pickle.loads(frame_data)
+            header, meta, frame = receiver.recv_frame()
+            t0 = time.perf_counter()
+            # Rebuild the payload dict the rest of the app expects. The frame
+            # is copied out of the receive buffer because other threads keep it.
+            payload = dict(meta)
+            payload["timestamp"] = header.timestamp
+            payload["frame"] = bytes(frame)
             with lock:
                 if cam_id == 1:
                     latest_payload1 = payload
                 else:
                     latest_payload2 = payload
+            latest_frames[cam_id].publish(payload["frame"])
+            FANOUT_SECONDS.observe(time.perf_counter() - t0)
+            FRAMES_RECEIVED[cam_id].inc()
             num_objs = len(payload.get("large_objects", [])) if payload.get("large_objects") is not None else 0
             #print(f"Received payload from cam {cam_id} at {payload.get('timestamp')}, found {num_objs} objects")
+        except ConnectionError:
+            print("Connection closed by server at", ip)
+            return
         except Exception as e:
             print("Error receiving data from", ip, e)
             break
@@ -121,37 +138,42 @@ def index():
         </html>
     ''')
 
-# MJPEG generator for Camera 1 video.
-def gen_frames_cam1():
-    global latest_payload1
+# MJPEG generator for one LatestFrame (a camera's video or the scene view).
+def gen_latest_frames(frames):
+    version = 0
     while True:
-        with payload_lock1:
-            payload = latest_payload1
-        if payload is not None and "frame" in payload:
-            yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' + payload["frame"] + b'\r\n')
-        else:
-            time.sleep(0.03)
+        result = frames.wait_newer(version, timeout=1.0)
+        if result is None:
+            continue
+        version, frame = result
+        yield (b'--frame\r\n'
+               b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
 
 @app.route('/video_feed_cam1')
 def video_feed_cam1():
-    return Response(gen_frames_cam1(), mimetype='multipart/x-mixed-replace; boundary=frame')
-
-# MJPEG generator for Camera 2 video.
-def gen_frames_cam2():
-    global latest_payload2
-    while True:
-        with payload_lock2:
-            payload = latest_payload2
-        if payload is not None and "frame" in payload:
-            yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' + payload["frame"] + b'\r\n')
-        else:
-            time.sleep(0.03)
+    return Response(gen_latest_frames(latest_frames[1]), mimetype='multipart/x-mixed-replace; boundary=frame')
 
 @app.route('/video_feed_cam2')
 def video_feed_cam2():
-    return Response(gen_frames_cam2(), mimetype='multipart/x-mixed-replace; boundary=frame')
+    return Response(gen_latest_frames(latest_frames[2]), mimetype='multipart/x-mixed-replace; boundary=frame')
+
+# Latest JPEG of one camera (?cam=1 or 2) from memory; ETag/If-None-Match, and
+# ?wait=<s> long-polls for the next frame.
+@app.route('/snapshot.jpg')
+def snapshot():
+    frames = snapshot_frames(request.args)
+    if frames is None:
+        abort(404)
+    return snapshot_response(frames, request)
+
+def snapshot_frames(args):
+    cam = args.get('cam', '1')
+    return latest_frames.get(int(cam)) if cam.isdigit() else None
+
+@app.route('/metrics')
+def metrics_endpoint():
+    # Prometheus text format: per-stage histograms and frame/byte counters.
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
 
 # Combined detection info from both cameras.
 @app.route('/detection_info')
@@ -199,8 +221,8 @@ def detection_info():
             info["cam2"]["distance"] = distance_cm
     return jsonify(info)
 
-# Scene view MJPEG generator.
-def gen_scene():
+# Scene view, rendered once for all viewers by a background thread.
+def scene_loop():
     """
     Create a live-updating 2D scene with:
       - Camera1 (red box) at (0,0)
@@ -220,6 +242,7 @@ def gen_scene():
     baseline_y = scene_height // 2  # everything will be drawn at this y position
 
     while True:
+        t0 = time.perf_counter()
         # Create a white background for the scene.
         scene = np.ones((scene_height, scene_width, 3), dtype=np.uint8) * 255
         
@@ -286,16 +309,29 @@ def gen_scene():
                 cv2.putText(scene, f"{dist_cm} cm", (obj2_x_px, baseline_y - obj_radius - 5),
                             cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 0), 1)
         
+        t1 = time.perf_counter()
         ret, buffer = cv2.imencode(".jpg", scene)
         if ret:
-            yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' + buffer.tobytes() + b'\r\n')
+            scene_frames.publish(buffer.tobytes())
+        SCENE_SECONDS.observe(t1 - t0)
+        ENCODE_SECONDS.observe(time.perf_counter() - t1)
         time.sleep(0.1)  # update about 5 times per second
 
+scene_thread = threading.Thread(target=scene_loop, daemon=True)
+scene_thread.start()
+
 
 @app.route('/scene_feed')
 def scene_feed():
-    return Response(gen_scene(), mimetype='multipart/x-mixed-replace; boundary=frame')
+    return Response(gen_latest_frames(scene_frames), mimetype='multipart/x-mixed-replace; boundary=frame')
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True, use_reloader=False)
+    if ASYNC_SERVER:
+        server = AsyncMJPEGServer(host='0.0.0.0', port=5000, wsgi_app=app)
+        server.add_stream('/video_feed_cam1', latest_frames[1])
+        server.add_stream('/video_feed_cam2', latest_frames[2])
+        server.add_stream('/scene_feed', scene_frames)
+        server.add_snapshot('/snapshot.jpg', snapshot_frames)  # long polls wait on the event loop
+        server.run()
+    else:
+        app.run(host='0.0.0.0', port=5000, debug=True, use_reloader=False)
@@ -1,13 +1,17 @@
 import socket
-import pickle
-import struct
 import threading
 import time
 import cv2
 import numpy as np
 import os
+import sys
 from flask import Flask, Response, render_template_string, jsonify
 
+# Shared modules (frame_protocol, frame_receiver, ...) live one directory up.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from frame_receiver import FrameReceiver
+
 # -------------------------
 # Global variables to store the latest payload.
 # -------------------------
@@ -33,33 +37,23 @@ def socket_receiver():
         print("Error connecting to Pi server:", e)
         return
 
-    data = b""
-    payload_size = struct.calcsize(">L")
+    receiver = FrameReceiver(s)
     while True:
         try:
-            while len(data) < payload_size:
-                packet = s.recv(4096)
-                if not packet:
-                    print("Connection closed by server.")
-                    return
-                data += packet
-            packed_msg_size = data[:payload_size]
-            data = data[payload_size:]
-            msg_size = struct.unpack(">L", packed_msg_size)[0]
-            while len(data) < msg_size:
-                packet = s.recv(4096)
-                if not packet:
-                    print("Connection closed by server.")
-                    return
-                data += packet
-            frame_data = data[:msg_size]
-            data = data[msg_size:]
-            payload = pickle.loads(frame_data)
+            header, meta, frame = receiver.recv_frame()
+            # Rebuild the payload dict the rest of the app expects. The frame
+            # is copied out of the receive buffer because other threads keep it.
+            payload = dict(meta)
+            payload["timestamp"] = header.timestamp
+            payload["frame"] = bytes(frame)
             with payload_lock:
                 latest_payload = payload
             # Debug: print a received timestamp and number of large objects (if any)
             num_objs = len(payload.get("large_objects", [])) if payload.get("large_objects") is not None else 0
             print(f"Received new payload at {payload.get('timestamp')}, found {num_objs} large objects")
+        except ConnectionError:
+            print("Connection closed by server.")
+            return
         except Exception as e:
             print("Error receiving data:", e)
             break
@@ -1,12 +1,17 @@
 import cv2
-import socket
-import pickle
-import struct
 import time
-import numpy as np
+import os
+import sys
+
+# Shared modules (frame_protocol, camera_backend, ...) live one directory up.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from detection import Detector, Crop, Gray, Blur, HoughCircles, CoarseToFineHough, Annotate
+from frame_hub import FrameHub
+import latency
 
 # Import the Picamera2 API.
-from picamera2 import Picamera2
+from camera_backend import Picamera2
 
 # -------------------------------
 # Initialize the Picamera2 instance and start the camera.
@@ -25,78 +30,83 @@ FRAME_RATE = 30  # Target frame rate (Hz)
 # -------------------------------
 SERVER_IP = ''         # Listen on all available interfaces.
 SERVER_PORT = 8485     # Port to listen on.
-server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-server_socket.bind((SERVER_IP, SERVER_PORT))
-server_socket.listen(0)
-print("Server listening on port", SERVER_PORT)
+# Viewers can connect and disconnect at any time; each gets every encoded frame.
+hub = FrameHub(SERVER_PORT, host=SERVER_IP)
+hub.start()
 
-# Wait for a client connection.
-conn, addr = server_socket.accept()
-print("Connected by:", addr)
+# -------------------------------
+# Hough circle detection (see detection.py).
+# -------------------------------
+PROCESSING_HEIGHT = 480  # Circles are in the frame scaled to this height.
+MIN_RADIUS = 10
+MAX_RADIUS = 0           # 0 means no upper limit.
+# Coarse-to-fine: find candidate circles on a 1/2 or 1/4 scale pyramid level,
+# then confirm each one at full resolution in a small window around it, with
+# the radius range taken from the previous frame's circles. False runs one
+# HoughCircles over the whole frame (several times slower).
+COARSE_TO_FINE = True
+PYRAMID_LEVELS = 2       # At most; fewer when MIN_RADIUS would get too small to find.
+RADIUS_PRIOR_FRAMES = 30 # Search the whole MIN_RADIUS..MAX_RADIUS range at least this often.
+DEBUG_PRINT = False      # Print the circles of every frame.
+if COARSE_TO_FINE:
+    hough = CoarseToFineHough(dp=1.2, min_dist=50, param1=100, param2=30,
+                              min_radius=MIN_RADIUS, max_radius=MAX_RADIUS,
+                              levels=PYRAMID_LEVELS, prior_frames=RADIUS_PRIOR_FRAMES)
+else:
+    hough = HoughCircles(dp=1.2, min_dist=50, param1=100, param2=30,
+                         min_radius=MIN_RADIUS, max_radius=MAX_RADIUS)
+detector = Detector([
+    Crop(roi=None, height=PROCESSING_HEIGHT),  # The whole frame.
+    Gray(),
+    Blur((9, 9), 2),  # Gaussian blur to reduce noise.
+    hough,
+    Annotate(roi=False),  # Draw every circle (green) and its center (red).
+])
 
-def process_frame(frame):
+def process_frame(frame, display):
     """
-    Process the frame to detect circles using Hough Circle Transform.
-    Draws ALL detected circles on the frame for debugging and returns the
-    modified frame and an array of detected circles.
-    
-    The function:
-      1. Converts the frame to grayscale.
-      2. Applies Gaussian blur to reduce noise.
-      3. Uses cv2.HoughCircles to detect circles.
-      4. Draws each detected circle and its center on the frame.
-      5. Prints the detected circle parameters for debugging.
-      
+    Detect circles in `frame` with the Hough Circle Transform, drawing ALL
+    detected circles on `display` (the frame at PROCESSING_HEIGHT) for
+    debugging.
+
     Returns:
-      - The processed frame (with drawn circles),
-      - The list of detected circles (or None if none were found),
+      - The processed display frame (with drawn circles),
+      - The array of detected circles [x, y, r] (or None if none were found),
       - (For compatibility, we return None for radius as overall data.)
     """
-    # Convert the frame to grayscale.
-    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-    # Apply Gaussian blur to reduce noise.
-    blurred = cv2.GaussianBlur(gray, (9, 9), 2)
-    
-    # Detect circles using Hough Circle Transform.
-    circles = cv2.HoughCircles(blurred, cv2.HOUGH_GRADIENT,
-                               dp=1.2,
-                               minDist=50,
-                               param1=100,
-                               param2=30,
-                               minRadius=10,
-                               maxRadius=0)  # maxRadius=0 means no upper limit.
-    
-    if circles is not None:
-        circles = np.round(circles[0, :]).astype("int")
-        print("Detected circles:", circles)   # Debug print.
-        # Loop over all detected circles.
-        for (x, y, r) in circles:
-            # Draw the outer circle in green.
-            cv2.circle(frame, (x, y), r, (0, 255, 0), 2)
-            # Draw the center of the circle in red.
-            cv2.circle(frame, (x, y), 3, (0, 0, 255), -1)
-    else:
-        print("No circles detected.")
-    return frame, circles, None
+    circles = detector.run(frame, display=display).circles
+    if DEBUG_PRINT:
+        if circles is not None:
+            print("Detected circles:", circles)
+        else:
+            print("No circles detected.")
+    return display, circles, None
 
 print("Starting video transmission (drawing all circles)...")
 
+seq = 0
+
 while True:
+    # Nobody watching: don't spend CPU on detection and encoding.
+    if hub.subscriber_count == 0:
+        time.sleep(1/FRAME_RATE)
+        continue
+
     # Capture a frame from the camera as a NumPy array.
     frame = picam2.capture_array()
+    capture_time = time.time()
     if frame is None:
         print("Failed to capture frame")
         time.sleep(1/FRAME_RATE)
         continue
 
-    # Optionally resize the frame to a fixed height (e.g., 480 pixels) for consistency.
-    desired_height = 480
-    scale = desired_height / frame.shape[0]
+    # The frame at PROCESSING_HEIGHT lines for the stream; detection reads it directly.
+    scale = PROCESSING_HEIGHT / frame.shape[0]
     new_width = int(frame.shape[1] * scale)
-    frame = cv2.resize(frame, (new_width, desired_height))
-    
+    display = cv2.resize(frame, (new_width, PROCESSING_HEIGHT))
+
     # Process the frame: detect and draw ALL circles.
-    processed_frame, circles, _ = process_frame(frame)
+    processed_frame, circles, _ = process_frame(frame, display)
     
     # Encode the processed frame as JPEG.
     ret, buffer = cv2.imencode(".jpg", processed_frame)
@@ -104,27 +114,20 @@ while True:
         time.sleep(1/FRAME_RATE)
         continue
 
-    # Package the data into a payload dictionary.
-    payload = {
-        "timestamp": time.time(),
+    encode_time = time.time()
+
+    # Detection metadata travels as a small JSON block next to the JPEG.
+    meta = {
         "circles": circles.tolist() if circles is not None else None,  # List of [x, y, r] values.
-        "frame": buffer.tobytes()
     }
+    seq += 1
     
-    # Serialize the payload.
-    data = pickle.dumps(payload)
-    # Prepend the length of the serialized data as a 4-byte header.
-    message = struct.pack(">L", len(data)) + data
-    
-    try:
-        conn.sendall(message)
-    except BrokenPipeError:
-        print("Connection lost.")
-        break
+    latency.stamp(meta, "encode", encode_time)
+    latency.stamp(meta, "publish")
+    hub.publish(seq, buffer, timestamp=capture_time, meta=meta)
     
     time.sleep(1/FRAME_RATE)
 
 # Clean up resources.
-conn.close()
-server_socket.close()
+hub.close()
 picam2.stop()
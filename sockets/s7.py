@@ -1,18 +1,98 @@
 import cv2
-import socket
-import pickle
-import struct
 import time
 import numpy as np
+import os
+import sys
 
-from picamera2 import Picamera2
+# Shared modules (frame_protocol, camera_backend, ...) live one directory up.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from detect_workers import DetectionPool
+from detection import (Detection, Detector, Crop, MotionGate, Gray, Blur, AdaptiveThreshold, Morphology,
+                       Contours, FilterByArea, Annotate)
+from event_clips import ClipRecorder
+from frame_hub import FrameHub
+import latency
+import metrics
+from tracking import CentroidTracker, TrackedSearch
+from pipeline import Pipeline, DROP_OLDEST, DROP_NEWEST, BLOCK
+
+from camera_backend import Picamera2
+
+CAPTURE_SIZE = (1280, 720)  # Camera preview resolution (adjust as needed).
+
+# -------------------------------
+# Define the ROI coordinates.
+# -------------------------------
+# Set the ROI (region-of-interest) by defining its top-left and bottom-right coordinates.
+# For example, here we choose an ROI from (x=200, y=150) to (x=1000, y=600)
+ROI_X1, ROI_Y1 = 200, 150
+ROI_X2, ROI_Y2 = 1000, 600
+PROCESSING_HEIGHT = 480  # ROI and detections are in the frame scaled to this height.
+PROCESSING_WIDTH = int(CAPTURE_SIZE[0] * PROCESSING_HEIGHT / CAPTURE_SIZE[1])
+
+# -------------------------------
+# Detection stages (see detection.py), run on the ROI only.
+# -------------------------------
+DEBUG_ANNOTATE = True  # Draw the ROI, contours and boxes into the streamed frame.
+# Motion gate: while the ROI matches the last fully processed frame, reuse its
+# large_objects instead of thresholding again (most frames of a static scene).
+MOTION_GATE = True
+MOTION_PIXEL_THRESHOLD = 20   # Grey levels a downsampled pixel must change by to count as moved.
+MOTION_MIN_FRACTION = 0.005   # Fraction of moved pixels that triggers a full detection.
+MOTION_REFRESH_FRAMES = 150   # Full detection at least this often anyway.
+# Tracking (see tracking.py): once objects are found, search only windows around
+# their predicted positions, with a full-ROI search every TRACK_FULL_SEARCH_FRAMES
+# frames (new objects) and whenever a track is lost.
+TRACK_OBJECTS = True
+TRACK_MAX_DISTANCE = 80        # Pixels a centroid may move between frames and keep its track.
+TRACK_WINDOW_MARGIN = 24       # Pixels searched around each predicted box (plus its motion).
+TRACK_FULL_SEARCH_FRAMES = 15  # Half a second at 30 fps.
+
+def make_detector(annotate=DEBUG_ANNOTATE, track=TRACK_OBJECTS):
+    stages = [
+        Gray(),
+        Blur((5, 5)),  # Gaussian blur to reduce noise.
+        # THRESH_BINARY_INV makes a dark object on a light background white (foreground).
+        AdaptiveThreshold(block_size=11, c=7),
+        Morphology(cv2.MORPH_OPEN, np.ones((3, 3), np.uint8)),  # Opening removes noise.
+        Contours(),
+        FilterByArea(1000),  # Adjust this area threshold as needed.
+    ]
+    if track:
+        stages = [TrackedSearch(stages, CentroidTracker(max_distance=TRACK_MAX_DISTANCE),
+                                margin=TRACK_WINDOW_MARGIN, full_search_frames=TRACK_FULL_SEARCH_FRAMES)]
+    return Detector([
+        Crop(roi=(ROI_X1, ROI_Y1, ROI_X2, ROI_Y2), height=PROCESSING_HEIGHT),
+    ] + ([MotionGate(MOTION_PIXEL_THRESHOLD, MOTION_MIN_FRACTION, refresh_frames=MOTION_REFRESH_FRAMES)]
+         if MOTION_GATE else []) + stages + ([Annotate()] if annotate else []))
+
+# -------------------------------
+# Detection worker processes (see detect_workers.py).
+# -------------------------------
+# 0 detects on the pipeline's detect thread. N > 0 hands the frames to N worker
+# processes through shared memory (one core each) and puts the results back in
+# frame order. The workers are forked here, before the camera and the other
+# threads start. Each worker only sees every Nth frame, so tracking is off there.
+DETECT_WORKERS = 0
+SUBMIT_TIMEOUT = 0.5  # Seconds to wait for a free slot before streaming a frame without detection.
+if DETECT_WORKERS:
+    detector = None
+    annotate = Annotate() if DEBUG_ANNOTATE else None  # Drawing happens here, on the display frame.
+    pool = DetectionPool(lambda: make_detector(annotate=False, track=False), workers=DETECT_WORKERS,
+                         slot_bytes=PROCESSING_HEIGHT * PROCESSING_WIDTH * 4)  # Up to 4 bytes per pixel (XBGR).
+    pool.start()
+else:
+    detector = make_detector()
+    metrics.observe_detector(detector)
+    pool = None
 
 # -------------------------------
 # Initialize the Picamera2 instance and start the camera.
 # -------------------------------
 picam2 = Picamera2()
-# Configure the camera with a preview resolution (adjust as needed)
-config = picam2.create_preview_configuration({"size": (1280, 720)})
+# Configure the camera with a preview resolution
+config = picam2.create_preview_configuration({"size": CAPTURE_SIZE})
 picam2.configure(config)
 picam2.start()
 
@@ -23,120 +103,155 @@ FRAME_RATE = 30  # Target frame rate (Hz)
 # -------------------------------
 SERVER_IP = ''         # Listen on all available interfaces.
 SERVER_PORT = 8485     # Port to listen on.
-server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-server_socket.bind((SERVER_IP, SERVER_PORT))
+# Viewers can connect and disconnect at any time; each gets every encoded frame.
+hub = FrameHub(SERVER_PORT, host=SERVER_IP)
+hub.start()
 
-#server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-#server_socket.bind((SERVER_IP, SERVER_PORT))
-server_socket.listen(0)
-print("Server listening on port", SERVER_PORT)
-
-# Wait for a client to connect.
-conn, addr = server_socket.accept()
-print("Connected by:", addr)
+# -------------------------------
+# Pipeline settings.
+# -------------------------------
+# Each stage below runs on its own thread, connected by small ring buffers, so
+# capture, detection, encoding and sending overlap on the Pi's cores.
+USE_PIPELINE = True          # False runs the stages one after another on one thread.
+PIPELINE_QUEUE_SIZE = 2      # Frames buffered between two stages.
+DROP_POLICY = DROP_OLDEST    # DROP_OLDEST, DROP_NEWEST or BLOCK (see pipeline.py).
+STATS_INTERVAL = 5           # Seconds between per-stage throughput reports.
+METRICS_PORT = 9108          # Prometheus /metrics (per-stage histograms, see metrics.py); None to disable.
 
 # -------------------------------
-# Define the ROI coordinates.
+# Event clips.
 # -------------------------------
-# Set the ROI (region-of-interest) by defining its top-left and bottom-right coordinates.
-# For example, here we choose an ROI from (x=200, y=150) to (x=1000, y=600)
-ROI_X1, ROI_Y1 = 200, 150
-ROI_X2, ROI_Y2 = 1000, 600
+# The last few seconds of encoded frames stay in RAM; when large objects are
+# detected they are written out, with POST_EVENT_SECONDS more, as a clip.
+RECORD_CLIPS = True
+CLIP_DIR = "clips"
+PRE_EVENT_SECONDS = 5
+POST_EVENT_SECONDS = 5
+PRE_EVENT_MAX_BYTES = 32 * 1024 * 1024  # RAM budget for the pre-event frames
+clips = ClipRecorder(CLIP_DIR, pre_seconds=PRE_EVENT_SECONDS, post_seconds=POST_EVENT_SECONDS,
+                     max_bytes=PRE_EVENT_MAX_BYTES) if RECORD_CLIPS else None
+
+if METRICS_PORT is not None:
+    metrics.start_http_server(METRICS_PORT)
+
+seq = 0
+
+def capture():
+    """Capture stage: grab a frame and start a record that flows through the pipeline."""
+    global seq
+    # Nobody watching and nothing to record: don't spend CPU on detection and encoding.
+    if hub.subscriber_count == 0 and clips is None:
+        time.sleep(1/FRAME_RATE)
+        return None
 
-while True:
     # Capture a frame as a NumPy array.
     frame = picam2.capture_array()
+    capture_time = time.time()
     if frame is None:
         print("Failed to capture frame")
         time.sleep(1/FRAME_RATE)
-        continue
-
-    # Optionally, resize the frame for consistent processing (fix height to 480 pixels).
-    desired_height = 480
-    scale = desired_height / frame.shape[0]
+        return None
+    seq += 1
+    return {"seq": seq, "capture_time": capture_time, "frame": frame}
+
+def resize(item):
+    """
+    Resize stage: the frame at PROCESSING_HEIGHT lines, for the stream and the
+    clips (capture() already skips frames nobody consumes). Detection takes
+    its ROI from this frame instead of resizing again.
+    """
+    frame = item["frame"]
+    scale = PROCESSING_HEIGHT / frame.shape[0]
     new_width = int(frame.shape[1] * scale)
-    frame = cv2.resize(frame, (new_width, desired_height))
-
-    # Draw the ROI rectangle on the frame for visualization (blue rectangle).
-    cv2.rectangle(frame, (ROI_X1, ROI_Y1), (ROI_X2, ROI_Y2), (255, 0, 0), 2)
-
-    # Extract the ROI from the frame.
-    roi = frame[ROI_Y1:ROI_Y2, ROI_X1:ROI_X2]
-
-    # Convert the ROI to grayscale.
-    gray_roi = cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY)
-    # Apply Gaussian blur to the grayscale ROI to reduce noise.
-    gray_roi = cv2.GaussianBlur(gray_roi, (5, 5), 0)
-    # Apply adaptive threshold (using MEAN method) with inversion.
-    # THRESH_BINARY_INV will make a dark object become white (foreground)
-    # on a black background if the original object is dark on a light background.
-    thresh_roi = cv2.adaptiveThreshold(
-        gray_roi,
-        maxValue=255,
-        adaptiveMethod=cv2.ADAPTIVE_THRESH_MEAN_C,
-        thresholdType=cv2.THRESH_BINARY_INV,
-        blockSize=11,
-        C=7
-    )
-
-    # Use morphological opening to remove noise.
-    kernel = np.ones((3, 3), np.uint8)
-    thresh_clean = cv2.morphologyEx(thresh_roi, cv2.MORPH_OPEN, kernel, iterations=1)
-
-    # Find contours in the thresholded ROI.
-    contours, _ = cv2.findContours(thresh_clean.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-    # For debugging: create a copy of the ROI to draw contours.
-    roi_debug = roi.copy()
-    cv2.drawContours(roi_debug, contours, -1, (0, 255, 0), 2)
-
-    # List to hold bounding box information (x, y, w, h) for large contours.
-    large_objects = []
-    for cnt in contours:
-        area = cv2.contourArea(cnt)
-        if area > 1000:  # Adjust this area threshold as needed.
-            x, y, w, h = cv2.boundingRect(cnt)
-            cv2.rectangle(roi_debug, (x, y), (x+w, y+h), (0, 0, 255), 2)
-            large_objects.append((x, y, w, h))
-
-    # Replace the ROI in the full frame with the debug ROI (so the drawn contours are visible).
-    frame[ROI_Y1:ROI_Y2, ROI_X1:ROI_X2] = roi_debug
-
-    # Encode the processed frame as JPEG.
-    ret, buffer = cv2.imencode(".jpg", frame)
+    item["display"] = cv2.resize(frame, (new_width, PROCESSING_HEIGHT))
+    return item
+
+def detect(item):
+    """Detection stage: threshold + contours inside the ROI, drawing debug overlays."""
+    if pool is not None:
+        # Workers get the display frame (already at PROCESSING_HEIGHT); collect() picks up the result.
+        item["submitted"] = pool.submit(item["seq"], item["display"], timeout=SUBMIT_TIMEOUT)
+        return item
+    detection = detector.run(item["frame"], display=item["display"])
+    item["large_objects"] = detection.objects  # Bounding boxes (x, y, w, h) relative to the ROI.
+    return item
+
+def collect(item):
+    """Collect stage (detection workers only): this frame's result, in frame order."""
+    result = pool.collect(item["seq"]) if item["submitted"] else None
+    if result is None:
+        item["large_objects"] = []  # No free slot, worker failed or too slow; stream the frame without detections.
+        return item
+    detection = result.apply(Detection(item["frame"], item["display"]))
+    if annotate is not None:
+        annotate(detection)
+    item["large_objects"] = detection.objects  # Bounding boxes (x, y, w, h) relative to the ROI.
+    return item
+
+def encode(item):
+    """Encode stage: JPEG-encode the annotated frame."""
+    ret, buffer = cv2.imencode(".jpg", item["display"])
     if not ret:
-        time.sleep(1/FRAME_RATE)
-        continue
-
-    # Package the data in a dictionary.
-    payload = {
-        "timestamp": time.time(),
-        "large_objects": large_objects,   # List of bounding boxes relative to the ROI.
+        return None
+    item["jpeg"] = buffer
+    item["encode_time"] = time.time()
+    item["frame"] = item["display"] = None  # Drop the frames early; only the JPEG is needed from here on.
+    return item
+
+def send(item):
+    """Send stage: hand the JPEG and detection metadata to every connected viewer."""
+    # Detection metadata travels as a small JSON block next to the JPEG.
+    meta = {
+        "large_objects": item["large_objects"],   # List of bounding boxes relative to the ROI.
         "ROI": (ROI_X1, ROI_Y1, ROI_X2, ROI_Y2),
-        "frame": buffer.tobytes()
     }
-
-    # Serialize the payload using pickle.
-    data = pickle.dumps(payload)
-    # Prepend the length of the serialized data as a 4-byte header.
-    message = struct.pack(">L", len(data)) + data
-
+    latency.stamp(meta, "encode", item["encode_time"])
+    latency.stamp(meta, "publish")
+    hub.publish(item["seq"], item["jpeg"], timestamp=item["capture_time"], meta=meta)
+    if clips is not None:
+        clips.add(item["capture_time"], item["jpeg"], seq=item["seq"], meta=meta)
+        if item["large_objects"]:
+            clips.trigger("large_objects", now=item["capture_time"])
+    return item
+
+if USE_PIPELINE:
+    pipeline = Pipeline(queue_size=PIPELINE_QUEUE_SIZE, drop_policy=DROP_POLICY)
+    pipeline.add_stage("capture", capture)
+    pipeline.add_stage("resize", resize)
+    pipeline.add_stage("detect", detect)
+    if pool is not None:
+        # Room for every frame the workers can have in flight, so none is dropped mid-detection.
+        pipeline.add_stage("collect", collect, queue_size=pool.num_slots)
+    pipeline.add_stage("encode", encode)
+    pipeline.add_stage("send", send)
+    metrics.observe_pipeline(pipeline)
+    pipeline.start()
     try:
-        conn.sendall(message)
-    except BrokenPipeError:
-        print("Connection lost.")
-        break
-
-
-
-
-
-
-
-
-
-
-
-
-
+        while True:
+            time.sleep(STATS_INTERVAL)
+            print(pipeline.report())
+            if detector is not None:
+                print(detector.report())
+    except KeyboardInterrupt:
+        print("Exiting...")
+    finally:
+        pipeline.stop()
+        if clips is not None:
+            clips.close()
+        if pool is not None:
+            pool.close()
+        hub.close()
+        picam2.stop()
+else:
+    while True:
+        item = capture()
+        if item is None:
+            continue
+        item = detect(resize(item))
+        if pool is not None:
+            item = collect(item)
+        item = encode(item)
+        if item is None:
+            time.sleep(1/FRAME_RATE)
+            continue
+        send(item)
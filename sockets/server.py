@@ -1,11 +1,18 @@
 import cv2
-import socket
-import pickle
-import struct
 import time
 import numpy as np
+import os
+import sys
 
-from picamera2 import Picamera2
+# Shared modules (frame_protocol, camera_backend, ...) live one directory up.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from detection import (Detector, Crop, MotionGate, Gray, AdaptiveThreshold, Morphology, Contours,
+                       FilterByArea, Annotate)
+from frame_hub import FrameHub
+import latency
+
+from camera_backend import Picamera2
 
 # -------------------------------
 # Initialize the Picamera2 instance and start the camera.
@@ -23,14 +30,9 @@ FRAME_RATE = 30  # Target frame rate (Hz)
 # -------------------------------
 SERVER_IP = ''         # Listen on all available interfaces.
 SERVER_PORT = 8485     # Port to listen on.
-server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-server_socket.bind((SERVER_IP, SERVER_PORT))
-server_socket.listen(0)
-print("Server listening on port", SERVER_PORT)
-
-# Wait for a client to connect.
-conn, addr = server_socket.accept()
-print("Connected by:", addr)
+# Viewers can connect and disconnect at any time; each gets every encoded frame.
+hub = FrameHub(SERVER_PORT, host=SERVER_IP)
+hub.start()
 
 # -------------------------------
 # Define the ROI coordinates.
@@ -39,86 +41,70 @@ print("Connected by:", addr)
 # For example, here we choose an ROI from (x=200, y=150) to (x=1000, y=600)
 ROI_X1, ROI_Y1 = 200, 150
 ROI_X2, ROI_Y2 = 1000, 600
+PROCESSING_HEIGHT = 480  # ROI and detections are in the frame scaled to this height.
+
+# -------------------------------
+# Detection stages (see detection.py), run on the ROI only.
+# -------------------------------
+DEBUG_ANNOTATE = True  # Draw the ROI, contours and boxes into the streamed frame.
+# Motion gate: while the ROI matches the last fully processed frame, reuse its
+# large_objects instead of thresholding again (most frames of a static scene).
+MOTION_GATE = True
+MOTION_PIXEL_THRESHOLD = 20   # Grey levels a downsampled pixel must change by to count as moved.
+MOTION_MIN_FRACTION = 0.005   # Fraction of moved pixels that triggers a full detection.
+MOTION_REFRESH_FRAMES = 150   # Full detection at least this often anyway.
+detector = Detector([
+    Crop(roi=(ROI_X1, ROI_Y1, ROI_X2, ROI_Y2), height=PROCESSING_HEIGHT),
+] + ([MotionGate(MOTION_PIXEL_THRESHOLD, MOTION_MIN_FRACTION, refresh_frames=MOTION_REFRESH_FRAMES)]
+     if MOTION_GATE else []) + [
+    Gray(),
+    # THRESH_BINARY_INV makes a dark object on a light background white (foreground).
+    AdaptiveThreshold(block_size=11, c=2),
+    Morphology(cv2.MORPH_OPEN, np.ones((3, 3), np.uint8)),  # Opening removes noise.
+    Contours(),
+    FilterByArea(1000),  # Adjust this area threshold as needed.
+] + ([Annotate()] if DEBUG_ANNOTATE else []))
+
+seq = 0
 
 while True:
+    # Nobody watching: don't spend CPU on detection and encoding.
+    if hub.subscriber_count == 0:
+        time.sleep(1/FRAME_RATE)
+        continue
+
     # Capture a frame as a NumPy array.
     frame = picam2.capture_array()
+    capture_time = time.time()
     if frame is None:
         print("Failed to capture frame")
         time.sleep(1/FRAME_RATE)
         continue
 
-    # Optionally, resize the frame for consistent processing (fix height to 480 pixels).
-    desired_height = 480
-    scale = desired_height / frame.shape[0]
+    # The frame at PROCESSING_HEIGHT lines for the stream (only built while someone
+    # is watching, see above); detection reads its ROI from it instead of resizing again.
+    scale = PROCESSING_HEIGHT / frame.shape[0]
     new_width = int(frame.shape[1] * scale)
-    frame = cv2.resize(frame, (new_width, desired_height))
-
-    # Draw the ROI rectangle on the frame for visualization (blue rectangle).
-    cv2.rectangle(frame, (ROI_X1, ROI_Y1), (ROI_X2, ROI_Y2), (255, 0, 0), 2)
-
-    # Extract the ROI from the frame.
-    roi = frame[ROI_Y1:ROI_Y2, ROI_X1:ROI_X2]
-
-    # Convert the ROI to grayscale.
-    gray_roi = cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY)
-
-    # Apply adaptive threshold (using MEAN method) with inversion.
-    # THRESH_BINARY_INV will make a dark object become white (foreground)
-    # on a black background if the original object is dark on a light background.
-    thresh_roi = cv2.adaptiveThreshold(
-        gray_roi,
-        maxValue=255,
-        adaptiveMethod=cv2.ADAPTIVE_THRESH_MEAN_C,
-        thresholdType=cv2.THRESH_BINARY_INV,
-        blockSize=11,
-        C=2
-    )
-
-    # Use morphological opening to remove noise.
-    kernel = np.ones((3, 3), np.uint8)
-    thresh_clean = cv2.morphologyEx(thresh_roi, cv2.MORPH_OPEN, kernel, iterations=1)
-
-    # Find contours in the thresholded ROI.
-    contours, _ = cv2.findContours(thresh_clean.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-    # For debugging: create a copy of the ROI to draw contours.
-    roi_debug = roi.copy()
-    cv2.drawContours(roi_debug, contours, -1, (0, 255, 0), 2)
-
-    # List to hold bounding box information (x, y, w, h) for large contours.
-    large_objects = []
-    for cnt in contours:
-        area = cv2.contourArea(cnt)
-        if area > 1000:  # Adjust this area threshold as needed.
-            x, y, w, h = cv2.boundingRect(cnt)
-            cv2.rectangle(roi_debug, (x, y), (x+w, y+h), (0, 0, 255), 2)
-            large_objects.append((x, y, w, h))
-
-    # Replace the ROI in the full frame with the debug ROI (so the drawn contours are visible).
-    frame[ROI_Y1:ROI_Y2, ROI_X1:ROI_X2] = roi_debug
+    display = cv2.resize(frame, (new_width, PROCESSING_HEIGHT))
+
+    detection = detector.run(frame, display=display)
+    large_objects = detection.objects  # Bounding boxes (x, y, w, h) relative to the ROI.
 
     # Encode the processed frame as JPEG.
-    ret, buffer = cv2.imencode(".jpg", frame)
+    ret, buffer = cv2.imencode(".jpg", display)
     if not ret:
         time.sleep(1/FRAME_RATE)
         continue
 
-    # Package the data in a dictionary.
-    payload = {
-        "timestamp": time.time(),
+    encode_time = time.time()
+
+    # Detection metadata travels as a small JSON block next to the JPEG.
+    meta = {
         "large_objects": large_objects,   # List of bounding boxes relative to the ROI.
         "ROI": (ROI_X1, ROI_Y1, ROI_X2, ROI_Y2),
-        "frame": buffer.tobytes()
     }
+    seq += 1
 
-    # Serialize the payload using pickle.
-    data = pickle.dumps(payload)
-    # Prepend the length of the serialized data as a 4-byte header.
-    message = struct.pack(">L", len(data)) + data
-
-    try:
-        conn.sendall(message)
-    except BrokenPipeError:
-        print("Connection lost.")
-        break
+    latency.stamp(meta, "encode", encode_time)
+    latency.stamp(meta, "publish")
+    hub.publish(seq, buffer, timestamp=capture_time, meta=meta)
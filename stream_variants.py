@@ -0,0 +1,131 @@
+"""
+Per-client stream variants, each encoded once per frame.
+
+Every MJPEG viewer used to get the same full-size quality-80 stream; a phone
+or a thumbnail dashboard paid for 1280x720 it then scaled down. Viewers can
+now ask for /video?width=&quality=&fps=. The request is snapped to a small
+grid of variants (VARIANT_WIDTHS x VARIANT_QUALITIES x VARIANT_RATES) so
+that viewers asking for similar streams share one. The capture thread hands
+each frame to StreamVariants.publish(), which resizes and encodes it once
+for every variant somebody is watching (at that variant's frame rate) and
+publishes the JPEG to the variant's LatestFrame. A variant nobody has
+watched for IDLE_TIMEOUT seconds is dropped.
+
+    variants = StreamVariants(max_fps=30)
+
+    # capture thread, after the full-size encode
+    variants.publish(frame)
+
+    # viewer
+    key = variants.select(width=320, quality=60, fps=10)
+    with variants.subscription(key) as frames:
+        ...frames.wait_newer(version, timeout=1.0)...
+"""
+import contextlib
+import threading
+import time
+
+import cv2
+
+from latest_frame import LatestFrame
+
+VARIANT_WIDTHS = (160, 320, 640, 960, 1280, 1920)
+VARIANT_QUALITIES = (40, 60, 80, 90)
+VARIANT_RATES = (1, 2, 5, 10, 15, 30)
+IDLE_TIMEOUT = 10.0  # seconds a variant without viewers is kept (not encoded) before eviction
+
+
+def _nearest(options, value):
+    return min(options, key=lambda option: abs(option - value))
+
+
+class Variant(object):
+    """One (width, quality, fps) stream and the LatestFrame its viewers read."""
+
+    def __init__(self, key, now):
+        self.key = key
+        self.width, self.quality, self.fps = key
+        self.frames = LatestFrame()
+        self.subscribers = 0
+        self.last_used = now
+        self.next_frame_time = now
+        self.frames_encoded = 0
+
+
+class StreamVariants(object):
+    def __init__(self, max_width=None, max_fps=30, default_quality=80, idle_timeout=IDLE_TIMEOUT):
+        self.max_width = max_width  # None: the width of the frames handed to publish()
+        self.max_fps = max_fps
+        self.default_quality = default_quality
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.variants = {}
+
+    def select(self, width=None, quality=None, fps=None):
+        """Snap requested parameters (any may be None) to a variant key (width, quality, fps)."""
+        widths = [w for w in VARIANT_WIDTHS if self.max_width is None or w <= self.max_width]
+        if width is None or not widths:
+            width = self.max_width or 0  # 0: full size
+        else:
+            # Smallest grid width at least as wide as asked for (or the widest there is).
+            width = min([w for w in widths if w >= width] or [max(widths)])
+        quality = _nearest(VARIANT_QUALITIES, quality if quality is not None else self.default_quality)
+        rates = [r for r in VARIANT_RATES if r <= self.max_fps] or [min(VARIANT_RATES)]
+        fps = _nearest(rates, fps if fps is not None else self.max_fps)
+        return width, quality, fps
+
+    def subscribe(self, key):
+        """Add a viewer of variant `key`, creating the variant if needed. Returns its LatestFrame."""
+        with self.lock:
+            variant = self.variants.get(key)
+            if variant is None:
+                variant = self.variants[key] = Variant(key, time.perf_counter())
+            variant.subscribers += 1
+            return variant.frames
+
+    def unsubscribe(self, key):
+        with self.lock:
+            variant = self.variants.get(key)
+            if variant is not None:
+                variant.subscribers -= 1
+                variant.last_used = time.perf_counter()
+
+    @contextlib.contextmanager
+    def subscription(self, key):
+        frames = self.subscribe(key)
+        try:
+            yield frames
+        finally:
+            self.unsubscribe(key)
+
+    def publish(self, frame, now=None):
+        """
+        Encode `frame` for every variant that is due a frame and publish it.
+        Called by the capture thread; evicts idle variants as it goes.
+        Returns the number of variants encoded.
+        """
+        if now is None:
+            now = time.perf_counter()
+        with self.lock:
+            for key in [k for k, v in self.variants.items()
+                        if v.subscribers == 0 and now - v.last_used > self.idle_timeout]:
+                del self.variants[key]
+            # Half a frame of slack so camera jitter doesn't make a 30 fps variant skip frames.
+            due = [v for v in self.variants.values()
+                   if v.subscribers and now >= v.next_frame_time - 0.5 / v.fps]
+            for variant in due:
+                variant.next_frame_time = max(variant.next_frame_time + 1.0 / variant.fps, now)
+
+        h, w = frame.shape[:2]
+        encoded = 0
+        for variant in due:
+            out = frame
+            if variant.width and variant.width < w:
+                height = max(1, int(round(h * variant.width / float(w))))
+                out = cv2.resize(frame, (variant.width, height), interpolation=cv2.INTER_AREA)
+            ret, buffer = cv2.imencode('.jpg', out, [int(cv2.IMWRITE_JPEG_QUALITY), variant.quality])
+            if ret:
+                variant.frames.publish(buffer.tobytes())
+                variant.frames_encoded += 1
+                encoded += 1
+        return encoded
@@ -0,0 +1,316 @@
+"""
+Tracker-guided search windows: detect near where the objects are going to be.
+
+Once s7.py has found an object, the next frame still thresholds and
+contours the whole ROI, so detection costs the same for one small object
+as for an empty 800x450 region. A TrackedSearch stage keeps a
+CentroidTracker of the objects it found and, on the next frame, runs its
+inner stages only in small windows around each track's predicted box
+(constant velocity, the window widened by the motion). Detection cost then
+follows the number of objects, not the ROI area.
+
+    detector = Detector([
+        Crop(roi=(ROI_X1, ROI_Y1, ROI_X2, ROI_Y2), height=480),
+        TrackedSearch([
+            Gray(),
+            Blur((5, 5)),
+            AdaptiveThreshold(block_size=11, c=7),
+            Morphology(cv2.MORPH_OPEN, np.ones((3, 3), np.uint8)),
+            Contours(),
+            FilterByArea(1000),
+        ], CentroidTracker(max_distance=80), full_search_frames=15),
+        Annotate(),                 # also draws the search windows and track ids
+    ])
+    detection = detector.run(frame, display)
+    detection.objects               # as without tracking
+    detection.tracks                # [Track, ...] with ids that persist across frames
+
+The whole ROI is searched instead (a "full search"):
+  - when there are no tracks,
+  - every `full_search_frames` frames, to pick up objects entering the ROI,
+  - on the frame after a track was missed in its window or an object
+    touched its window's edge (it moved further than predicted),
+  - when the windows would cover more than `max_window_fraction` of the
+    ROI, where one pass over the ROI is cheaper.
+
+Window sizes are rounded up to multiples of `window_step` pixels, and
+every window slot (first window, second, ...) runs its own copies of the
+stages. Each copy's dst= buffers keep one shape from frame to frame, as
+in a full-ROI Detector, instead of being reallocated for every window.
+
+`python tracking.py` compares full-ROI and tracked detection on synthetic
+moving objects.
+"""
+import copy
+import itertools
+import math
+
+import numpy as np
+
+from detection import Detection, Stage
+
+
+class Track(object):
+    """One tracked object; the box is relative to the ROI, like Detection.objects."""
+
+    __slots__ = ("id", "box", "vx", "vy", "hits", "misses")
+
+    def __init__(self, track_id, box):
+        self.id = track_id
+        self.box = box          # (x, y, w, h)
+        self.vx = 0.0           # pixels per update
+        self.vy = 0.0
+        self.hits = 1
+        self.misses = 0         # consecutive updates without a match
+
+    @property
+    def center(self):
+        x, y, w, h = self.box
+        return x + w / 2.0, y + h / 2.0
+
+    def predict(self):
+        """The box where the object should be on the next update."""
+        x, y, w, h = self.box
+        return (int(round(x + self.vx)), int(round(y + self.vy)), w, h)
+
+
+class CentroidTracker(object):
+    """
+    Associate boxes with tracks by nearest predicted centroid (greedy,
+    closest pairs first, up to `max_distance` pixels) and keep a smoothed
+    constant-velocity estimate per track. A track that goes unmatched for
+    more than `max_misses` updates is dropped.
+    """
+
+    def __init__(self, max_distance=80, max_misses=5, smoothing=0.5):
+        self.max_distance = max_distance
+        self.max_misses = max_misses
+        self.smoothing = smoothing  # weight of the newest displacement in the velocity
+        self.tracks = []
+        self._ids = itertools.count(1)
+
+    def update(self, objects):
+        """Match this frame's boxes to the tracks. Returns the number of tracks left unmatched."""
+        predicted = [track.predict() for track in self.tracks]
+        pairs = []
+        for i, (px, py, pw, ph) in enumerate(predicted):
+            pcx, pcy = px + pw / 2.0, py + ph / 2.0
+            for j, (x, y, w, h) in enumerate(objects):
+                distance = math.hypot(x + w / 2.0 - pcx, y + h / 2.0 - pcy)
+                if distance <= self.max_distance:
+                    pairs.append((distance, i, j))
+        pairs.sort()
+        matched_tracks, matched_objects = set(), set()
+        for _, i, j in pairs:
+            if i in matched_tracks or j in matched_objects:
+                continue
+            matched_tracks.add(i)
+            matched_objects.add(j)
+            track = self.tracks[i]
+            (cx, cy), box = track.center, objects[j]
+            a = self.smoothing
+            track.vx = a * (box[0] + box[2] / 2.0 - cx) + (1 - a) * track.vx
+            track.vy = a * (box[1] + box[3] / 2.0 - cy) + (1 - a) * track.vy
+            track.box = tuple(box)
+            track.hits += 1
+            track.misses = 0
+        missed = 0
+        for i, track in enumerate(self.tracks):
+            if i not in matched_tracks:
+                missed += 1
+                track.misses += 1
+                track.box = predicted[i]  # coast along the last velocity
+        self.tracks = [track for track in self.tracks if track.misses <= self.max_misses]
+        for j, box in enumerate(objects):
+            if j not in matched_objects:
+                self.tracks.append(Track(next(self._ids), tuple(box)))
+        return missed
+
+
+def _merge_windows(windows):
+    """Union overlapping (x1, y1, x2, y2) windows so no object is searched, and found, twice."""
+    windows = list(windows)
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(windows)):
+            for j in range(i + 1, len(windows)):
+                a, b = windows[i], windows[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    windows[i] = (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+                    del windows[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return windows
+
+
+def _own_buffers(stage):
+    """A copy of `stage` with buffers of its own (plain callables are shared)."""
+    if not isinstance(stage, Stage):
+        return stage
+    clone = copy.copy(stage)
+    clone._buffers = {}
+    return clone
+
+
+class TrackedSearch(Stage):
+    """
+    Run `stages` (Gray ... FilterByArea) in windows around the tracker's
+    predicted boxes, or over the whole ROI when a full search is due (see
+    the module docstring). Sets objects, contours and circles as the
+    stages would over the whole ROI, plus detection.tracks and
+    detection.windows (None after a full search).
+    """
+
+    name = "tracked_search"
+
+    def __init__(self, stages, tracker=None, margin=24, full_search_frames=15, max_window_fraction=0.5,
+                 window_step=32):
+        super(TrackedSearch, self).__init__()
+        self.stages = list(stages)              # full-ROI searches
+        self._window_stages = []                # per window slot: copies of the stages
+        self.window_step = window_step
+        self.tracker = tracker if tracker is not None else CentroidTracker()
+        self.margin = margin                        # pixels around the predicted box, plus the motion
+        self.full_search_frames = full_search_frames
+        self.max_window_fraction = max_window_fraction
+        self._since_full = 0
+        self._force_full = True
+        self.full_searches = 0
+        self.window_searches = 0
+
+    def _windows(self, width, height):
+        windows = []
+        for track in self.tracker.tracks:
+            x, y, w, h = track.predict()
+            mx = self.margin + int(abs(track.vx))
+            my = self.margin + int(abs(track.vy))
+            x1, y1 = max(x - mx, 0), max(y - my, 0)
+            x2, y2 = min(x + w + mx, width), min(y + h + my, height)
+            if x1 < x2 and y1 < y2:
+                windows.append((x1, y1, x2, y2))
+        windows = _merge_windows(windows)
+        while True:
+            # Rounding up can make windows overlap again: merge and round until it doesn't.
+            fitted = [self._fit(window, width, height) for window in windows]
+            windows = _merge_windows(fitted)
+            if len(windows) == len(fitted):
+                return fitted
+
+    def _fit(self, window, width, height):
+        """Round a window up to multiples of window_step, shifted to stay inside the ROI."""
+        x1, y1, x2, y2 = window
+        step = self.window_step
+        w = min(-(-(x2 - x1) // step) * step, width)
+        h = min(-(-(y2 - y1) // step) * step, height)
+        x1 = max(0, min(x1 - (w - (x2 - x1)) // 2, width - w))
+        y1 = max(0, min(y1 - (h - (y2 - y1)) // 2, height - h))
+        return (x1, y1, x1 + w, y1 + h)
+
+    def _stages_for(self, slot):
+        while len(self._window_stages) <= slot:
+            self._window_stages.append([_own_buffers(stage) for stage in self.stages])
+        return self._window_stages[slot]
+
+    def _search(self, detection, stages, image, x1, y1):
+        """Run `stages` on `image`, the part of the ROI at (x1, y1). Results are relative to the ROI."""
+        ox, oy = detection.origin
+        part = Detection(detection.frame)
+        part.image = image
+        part.scale = detection.scale
+        part.origin = (ox + x1, oy + y1)
+        part.roi = detection.roi
+        for stage in stages:
+            stage(part)
+        if x1 or y1:
+            part.objects = [(x + x1, y + y1, w, h) for (x, y, w, h) in part.objects]
+            part.contours = [cnt + (x1, y1) for cnt in part.contours]
+        return part
+
+    def __call__(self, detection):
+        image = detection.image
+        height, width = image.shape[:2]
+        windows = None
+        if (self.tracker.tracks and not self._force_full
+                and self._since_full < self.full_search_frames):
+            windows = self._windows(width, height)
+            area = sum((x2 - x1) * (y2 - y1) for (x1, y1, x2, y2) in windows)
+            if area > self.max_window_fraction * width * height:
+                windows = None
+        self._force_full = False
+        if windows is None:
+            part = self._search(detection, self.stages, image, 0, 0)
+            objects, contours, circles = part.objects, part.contours, part.circles
+            self._since_full = 0
+            self.full_searches += 1
+        else:
+            objects, contours, circles = [], [], []
+            for slot, (x1, y1, x2, y2) in enumerate(windows):
+                part = self._search(detection, self._stages_for(slot), image[y1:y2, x1:x2], x1, y1)
+                objects.extend(part.objects)
+                contours.extend(part.contours)
+                if part.circles is not None:
+                    circles.append(part.circles)
+                # An object cut by the window edge (not the ROI edge) moved further than predicted.
+                for (x, y, w, h) in part.objects:
+                    if ((x <= x1 and x1 > 0) or (y <= y1 and y1 > 0)
+                            or (x + w >= x2 and x2 < width) or (y + h >= y2 and y2 < height)):
+                        self._force_full = True
+            circles = np.vstack(circles) if circles else None
+            self._since_full += 1
+            self.window_searches += 1
+        if self.tracker.update(objects):
+            self._force_full = True  # a track was lost: look for it everywhere
+        detection.objects = objects
+        detection.contours = contours
+        detection.circles = circles
+        detection.tracks = list(self.tracker.tracks)
+        detection.windows = windows
+
+
+if __name__ == "__main__":
+    import time
+
+    import cv2
+
+    from detection import Detector, Crop, Gray, Blur, AdaptiveThreshold, Morphology, Contours, FilterByArea
+
+    FRAME_SIZE = (853, 480)
+    ROI = (50, 20, 800, 460)
+    NUM_FRAMES = 300
+
+    def stages():
+        return [Gray(), Blur((5, 5)), AdaptiveThreshold(block_size=11, c=7),
+                Morphology(cv2.MORPH_OPEN, np.ones((3, 3), np.uint8)), Contours(), FilterByArea(1000)]
+
+    def make_frames(count):
+        rng = np.random.default_rng(0)
+        width, height = FRAME_SIZE
+        noise = [rng.integers(0, 40, (height, width, 3), dtype=np.uint8) for _ in range(8)]
+        frames = []
+        for i in range(NUM_FRAMES):
+            frame = np.full((height, width, 3), 180, np.uint8)
+            for k in range(count):
+                x = 120 + (140 * k + 3 * i) % 600
+                y = 80 + 90 * (k % 4) + int(20 * math.sin(i / 10.0 + k))
+                cv2.circle(frame, (x, y), 25, (30, 30, 30), -1)
+            frames.append(cv2.add(frame, noise[i % len(noise)]))
+        return frames
+
+    print("%d frames of %dx%d, ROI %s" % (NUM_FRAMES, FRAME_SIZE[0], FRAME_SIZE[1], ROI))
+    print("%-8s %10s %10s %8s %8s" % ("objects", "full fps", "tracked", "speedup", "full %"))
+    for count in (1, 2, 4):
+        frames = make_frames(count)
+        results = []
+        for tracked in (False, True):
+            inner = stages()
+            search = TrackedSearch(inner) if tracked else None
+            detector = Detector([Crop(roi=ROI, height=FRAME_SIZE[1])] + ([search] if tracked else inner))
+            start = time.perf_counter()
+            for frame in frames:
+                detector.run(frame)
+            results.append(NUM_FRAMES / (time.perf_counter() - start))
+        print("%-8d %10.1f %10.1f %8.2f %8.1f" % (count, results[0], results[1], results[1] / results[0],
+                                                  100.0 * search.full_searches / NUM_FRAMES))
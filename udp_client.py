@@ -1,15 +1,24 @@
 import socket
-import pickle
 import cv2
+import numpy as np
 import time
+from udp_fragments import Reassembler
 
 # Set up UDP socket
 LISTEN_IP = ''  # Bind to all available interfaces
 SERVER_PORT = 8485
+RECV_BUFFER_SIZE = 4 * 1024 * 1024  # kernel receive buffer: room for a few frames' worth of fragments
 sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER_SIZE)
 sock.bind((LISTEN_IP, SERVER_PORT))
 sock.settimeout(0.5)  # Optional timeout to allow graceful exit
 
+# Frames arrive as MTU-sized fragments (see udp_fragments.py) and are put back together here;
+# a lost fragment is rebuilt from the FEC parity when the server sends it
+reassembler = Reassembler()
+datagram = bytearray(65536)  # reused for every recv_into
+datagram_view = memoryview(datagram)
+
 # Create a full screen window for display
 window_name = "UDP Stream"
 cv2.namedWindow(window_name, cv2.WINDOW_NORMAL)
@@ -23,20 +32,19 @@ fps = 0
 try:
     while True:
         try:
-            # Receive data (assuming each packet is a complete frame)
-            data, addr = sock.recvfrom(65536)  # 64KB buffer size, adjust as needed
+            nbytes, addr = sock.recvfrom_into(datagram)
         except socket.timeout:
+            reassembler.expire()
             continue  # If no data is received within the timeout, continue
 
-        # Unpickle the received JPEG buffer
-        try:
-            buffer = pickle.loads(data)
-        except Exception as e:
-            print("Pickle error:", e)
-            continue
+        result = reassembler.feed(datagram_view[:nbytes])
+        if result is None:
+            reassembler.expire()
+            continue  # frame not complete yet
+        frame_id, codec, capture_time, payload = result
 
         # Decode the JPEG buffer to an image (frame)
-        frame = cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+        frame = cv2.imdecode(np.frombuffer(payload, dtype=np.uint8), cv2.IMREAD_COLOR)
         if frame is None:
             continue
 
@@ -47,6 +55,10 @@ try:
             fps = frame_count / elapsed_time
             frame_count = 0
             start_time = time.time()
+            stats = reassembler.stats
+            print("FPS: %.2f  frame loss: %.1f%%  incomplete: %d  missing: %d  late fragments: %d  FEC recovered: %d"
+                  % (fps, 100.0 * reassembler.loss_rate(), stats["frames_incomplete"],
+                     stats["frames_missing"], stats["fragments_late"], stats["fragments_recovered"]))
 
         # Overlay FPS on the frame
         cv2.putText(frame, f"FPS: {fps:.2f}", (10, 30),
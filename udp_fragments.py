@@ -0,0 +1,364 @@
+"""
+Application-level fragmentation and reassembly for the UDP video path.
+
+A JPEG frame at 640x480 and above often doesn't fit in one 64 KB datagram,
+and anything over the MTU gets fragmented by IP (one lost IP fragment loses
+the whole datagram, silently). FragmentSender splits each frame into
+datagrams that fit the MTU, each with a small header:
+
+    magic b"RU", version, codec, FEC group size, frame id, fragment index,
+    fragment count, frame length, capture timestamp
+
+With fec_overhead > 0 the sender also adds XOR parity fragments. The data
+fragments of a frame are split into interleaved groups of about
+1 / fec_overhead fragments (fragment i is in group i % num_groups, so a burst
+of consecutive losses hits different groups) and one parity fragment per
+group is sent after the data, with indices count, count + 1, ... Any single
+missing fragment of a group is rebuilt from the parity and the rest of the
+group, without a retransmission. fec_overhead=0.25 costs 25% more bandwidth.
+
+Sending a frame's datagrams back to back bursts them into the access point
+and receiver buffers faster than the link drains them, which is where much
+of the loss comes from. With frame_interval and/or max_bitrate set the
+sender paces them through a TokenBucket instead: a frame's datagrams are
+spread over PACING_SHARE of the frame interval, and never faster than
+max_bitrate. A paced send_frame() sleeps for most of a frame interval, so
+call it from a sender thread of its own rather than the capture loop (see
+udp_serve.py).
+
+Reassembler puts them back together into a preallocated buffer per frame.
+A frame is delivered as soon as its last fragment arrives. Incomplete frames
+are discarded after a timeout, or as soon as a newer frame completes (for
+live video a late old frame is useless). Fragments for frames that were
+already delivered or discarded are counted as late.
+"""
+import struct
+import time
+
+import numpy as np
+
+MAGIC = b"RU"
+VERSION = 2
+
+# magic, version, codec, fec_k (data fragments per parity group, 0 = no FEC),
+# frame_id, index, count, frame_len, timestamp
+FRAG_HEADER = struct.Struct("!2sBBBIHHId")
+FRAG_HEADER_SIZE = FRAG_HEADER.size
+
+# 1500-byte Ethernet/Wi-Fi MTU minus IPv4 (20) and UDP (8) headers.
+MAX_DATAGRAM = 1472
+DEFAULT_FRAGMENT_SIZE = MAX_DATAGRAM - FRAG_HEADER_SIZE
+DEFAULT_TIMEOUT = 0.5  # seconds before an incomplete frame is given up on
+PACING_SHARE = 0.8     # spread a frame over this much of the frame interval, leaving headroom
+PACING_BURST = 4       # datagrams that may go out back to back
+
+CODEC_JPEG = 1
+
+
+def _newer(a, b):
+    """True if 32-bit frame id a comes after b (handles wrap-around)."""
+    return a != b and ((a - b) & 0xFFFFFFFF) < 0x80000000
+
+
+def fec_group_size(overhead):
+    """Data fragments per parity fragment for a target overhead ratio (0 = FEC off)."""
+    if not overhead or overhead <= 0:
+        return 0
+    return max(1, min(255, int(round(1.0 / overhead))))
+
+
+def num_parity_groups(count, fec_k):
+    return -(-count // fec_k) if fec_k else 0
+
+
+class TokenBucket(object):
+    """
+    Byte-rate limiter. consume(n) takes n bytes worth of tokens, sleeping
+    until the bucket has refilled enough; up to `burst` bytes can go out
+    without waiting.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)  # bytes per second
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.perf_counter()
+        self.waited = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def consume(self, n):
+        self._refill(time.perf_counter())
+        self.tokens -= n
+        if self.tokens < 0:
+            # Pay the debt by sleeping; the next refill counts the time slept.
+            wait = -self.tokens / self.rate
+            time.sleep(wait)
+            self.waited += wait
+
+
+class FragmentSender(object):
+    def __init__(self, sock, address, fragment_size=DEFAULT_FRAGMENT_SIZE, fec_overhead=0.0,
+                 frame_interval=None, max_bitrate=None):
+        self.sock = sock
+        self.address = address
+        self.fragment_size = fragment_size
+        self.fec_k = fec_group_size(fec_overhead)
+        self.frame_interval = frame_interval
+        self.max_bitrate = max_bitrate  # bits per second
+        self.pacer = None
+        if frame_interval or max_bitrate:
+            self.pacer = TokenBucket(max_bitrate / 8.0 if max_bitrate else 1.0,
+                                     PACING_BURST * (fragment_size + FRAG_HEADER_SIZE))
+        self.frame_id = 0
+        self.frames_sent = 0
+        self.datagrams_sent = 0
+        self.parity_sent = 0
+        self.bytes_sent = 0
+
+    def fragments(self, payload, codec=CODEC_JPEG, timestamp=None, frame_id=None):
+        """
+        Yield (header, chunk) for every fragment of one frame: the data
+        fragments (memoryviews, not copies) followed by the parity fragments
+        if FEC is on.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        if frame_id is None:
+            self.frame_id = (self.frame_id + 1) & 0xFFFFFFFF
+            frame_id = self.frame_id
+        payload = memoryview(payload).cast("B")
+        count = max(1, -(-len(payload) // self.fragment_size))
+        if count > 0xFFFF:
+            raise ValueError("Frame too large: %d bytes" % len(payload))
+        groups = num_parity_groups(count, self.fec_k)
+        if count + groups > 0xFFFF:
+            raise ValueError("Frame too large for FEC: %d bytes" % len(payload))
+        for index in range(count):
+            chunk = payload[index * self.fragment_size:(index + 1) * self.fragment_size]
+            header = FRAG_HEADER.pack(MAGIC, VERSION, codec, self.fec_k, frame_id, index, count,
+                                      len(payload), timestamp)
+            yield header, chunk
+        for group in range(groups):
+            parity = self._parity(payload, count, groups, group)
+            header = FRAG_HEADER.pack(MAGIC, VERSION, codec, self.fec_k, frame_id, count + group, count,
+                                      len(payload), timestamp)
+            self.parity_sent += 1
+            yield header, memoryview(parity)
+
+    def _parity(self, payload, count, groups, group):
+        """XOR of the data fragments group, group + groups, ... (shorter ones zero-padded)."""
+        parity = np.zeros(min(self.fragment_size, len(payload)), dtype=np.uint8)
+        for index in range(group, count, groups):
+            chunk = np.frombuffer(payload[index * self.fragment_size:(index + 1) * self.fragment_size], dtype=np.uint8)
+            np.bitwise_xor(parity[:len(chunk)], chunk, out=parity[:len(chunk)])
+        if count == groups and group == count - 1:
+            # One fragment per group (fec_k=1): the last group holds just the short last fragment.
+            parity = parity[:len(payload) - (count - 1) * self.fragment_size]
+        return parity
+
+    def send_datagram(self, header, chunk):
+        if hasattr(self.sock, "sendmsg"):
+            self.sock.sendmsg((header, chunk), (), 0, self.address)
+        else:
+            self.sock.sendto(header + bytes(chunk), self.address)
+        self.datagrams_sent += 1
+        self.bytes_sent += len(header) + len(chunk)
+
+    def pacing_rate(self, frame_bytes):
+        """Bytes per second to send a frame of frame_bytes at."""
+        rate = None
+        if self.frame_interval:
+            rate = frame_bytes / (self.frame_interval * PACING_SHARE)
+        if self.max_bitrate:
+            cap = self.max_bitrate / 8.0
+            rate = cap if rate is None else min(rate, cap)
+        return rate
+
+    def send_frame(self, payload, codec=CODEC_JPEG, timestamp=None):
+        """Fragment and send one frame (paced if configured). Returns the number of datagrams sent."""
+        if self.pacer is None:
+            count = 0
+            for header, chunk in self.fragments(payload, codec=codec, timestamp=timestamp):
+                self.send_datagram(header, chunk)
+                count += 1
+        else:
+            datagrams = list(self.fragments(payload, codec=codec, timestamp=timestamp))
+            frame_bytes = sum(len(header) + len(chunk) for header, chunk in datagrams)
+            self.pacer.rate = self.pacing_rate(frame_bytes)
+            for header, chunk in datagrams:
+                self.pacer.consume(len(header) + len(chunk))
+                self.send_datagram(header, chunk)
+            count = len(datagrams)
+        self.frames_sent += 1
+        return count
+
+
+class _PartialFrame(object):
+    __slots__ = ("frame_id", "codec", "count", "groups", "timestamp", "buffer", "received", "num_received",
+                 "parity", "first_seen")
+
+    def __init__(self, frame_id, codec, count, groups, frame_len, timestamp, now):
+        self.frame_id = frame_id
+        self.codec = codec
+        self.count = count
+        self.groups = groups
+        self.timestamp = timestamp
+        self.buffer = bytearray(frame_len)
+        self.received = bytearray(count)  # 1 per fragment that has arrived
+        self.num_received = 0
+        self.parity = {}  # group -> parity fragment (bytes)
+        self.first_seen = now
+
+
+class Reassembler(object):
+    def __init__(self, timeout=DEFAULT_TIMEOUT):
+        self.timeout = timeout
+        self._partial = {}
+        self._last_done = None  # newest frame id delivered or discarded
+        self.stats = {
+            "frames_completed": 0,
+            "frames_incomplete": 0,    # discarded with fragments missing
+            "frames_missing": 0,       # ids never seen at all
+            "fragments_received": 0,
+            "fragments_late": 0,       # arrived after their frame was delivered/discarded
+            "fragments_duplicate": 0,
+            "fragments_recovered": 0,  # rebuilt from FEC parity
+            "parity_unused": 0,        # parity for frames that were already complete
+            "datagrams_invalid": 0,
+        }
+
+    def feed(self, datagram, now=None):
+        """
+        Process one datagram. Returns (frame_id, codec, timestamp, payload)
+        when it completes a frame, else None. payload is a bytearray owned by
+        the caller.
+        """
+        if now is None:
+            now = time.monotonic()
+        if len(datagram) < FRAG_HEADER_SIZE:
+            self.stats["datagrams_invalid"] += 1
+            return None
+        magic, version, codec, fec_k, frame_id, index, count, frame_len, timestamp = \
+            FRAG_HEADER.unpack_from(datagram)
+        groups = num_parity_groups(count, fec_k)
+        if magic != MAGIC or version != VERSION or index >= count + groups:
+            self.stats["datagrams_invalid"] += 1
+            return None
+        self.stats["fragments_received"] += 1
+
+        if self._last_done is not None and not _newer(frame_id, self._last_done):
+            self.stats["parity_unused" if index >= count else "fragments_late"] += 1
+            return None
+
+        frame = self._partial.get(frame_id)
+        if frame is None:
+            frame = _PartialFrame(frame_id, codec, count, groups, frame_len, timestamp, now)
+            self._partial[frame_id] = frame
+
+        chunk = memoryview(datagram)[FRAG_HEADER_SIZE:]
+        if index >= count:
+            group = index - count
+            if group in frame.parity:
+                self.stats["fragments_duplicate"] += 1
+                return None
+            frame.parity[group] = bytes(chunk)
+        else:
+            if frame.received[index]:
+                self.stats["fragments_duplicate"] += 1
+                return None
+            # Every fragment but the last is full size, so the offset follows from the
+            # chunk length alone and the sender's fragment size needn't be configured here.
+            if index == count - 1:
+                offset = frame_len - len(chunk)
+            else:
+                offset = index * len(chunk)
+            if offset < 0 or offset + len(chunk) > len(frame.buffer):
+                self.stats["datagrams_invalid"] += 1
+                return None
+            frame.buffer[offset:offset + len(chunk)] = chunk
+            frame.received[index] = 1
+            frame.num_received += 1
+            group = index % groups if groups else None
+        if group is not None and frame.num_received < frame.count:
+            self._recover(frame, group)
+        if frame.num_received < frame.count:
+            return None
+
+        del self._partial[frame_id]
+        self._advance(frame_id)
+        self.stats["frames_completed"] += 1
+        return frame.frame_id, frame.codec, frame.timestamp, frame.buffer
+
+    def _recover(self, frame, group):
+        """Rebuild the data fragment of `group` that is missing, if exactly one is and its parity is here."""
+        parity = frame.parity.get(group)
+        if parity is None:
+            return
+        members = range(group, frame.count, frame.groups)
+        missing = [index for index in members if not frame.received[index]]
+        if len(missing) != 1:
+            return
+        # A parity fragment is as long as the longest fragment in its group: the full
+        # fragment size, unless the group is just the (short) last fragment.
+        fragment_size = len(parity)
+        frame_len = len(frame.buffer)
+        last_len = frame_len - (frame.count - 1) * fragment_size if len(members) > 1 else fragment_size
+
+        def span(index):
+            if index == frame.count - 1:
+                return frame_len - last_len, last_len
+            return index * fragment_size, fragment_size
+
+        data = np.frombuffer(parity, dtype=np.uint8).copy()
+        for index in members:
+            if index != missing[0]:
+                offset, length = span(index)
+                other = np.frombuffer(frame.buffer, dtype=np.uint8, count=length, offset=offset)
+                np.bitwise_xor(data[:length], other, out=data[:length])
+        offset, length = span(missing[0])
+        if offset < 0 or length < 0 or offset + length > frame_len:
+            self.stats["datagrams_invalid"] += 1
+            return
+        frame.buffer[offset:offset + length] = data[:length].tobytes()
+        frame.received[missing[0]] = 1
+        frame.num_received += 1
+        self.stats["fragments_recovered"] += 1
+
+    def _advance(self, frame_id):
+        """
+        frame_id is done (delivered or given up on): discard every older
+        incomplete frame and count the ids in between that never showed up.
+        """
+        discarded = 0
+        for other in list(self._partial):
+            if _newer(frame_id, other):
+                del self._partial[other]
+                discarded += 1
+        self.stats["frames_incomplete"] += discarded
+        if self._last_done is not None:
+            gap = (frame_id - self._last_done - 1) & 0xFFFFFFFF
+            self.stats["frames_missing"] += gap - discarded
+        self._last_done = frame_id
+
+    def expire(self, now=None):
+        """Discard frames that have been incomplete for longer than the timeout."""
+        if now is None:
+            now = time.monotonic()
+        newest_expired = None
+        for frame_id, frame in self._partial.items():
+            if now - frame.first_seen > self.timeout:
+                if newest_expired is None or _newer(frame_id, newest_expired):
+                    newest_expired = frame_id
+        if newest_expired is not None:
+            del self._partial[newest_expired]
+            self.stats["frames_incomplete"] += 1
+            self._advance(newest_expired)
+
+    def loss_rate(self):
+        """Fraction of frames that didn't make it (incomplete or never seen)."""
+        lost = self.stats["frames_incomplete"] + self.stats["frames_missing"]
+        total = lost + self.stats["frames_completed"]
+        return lost / total if total else 0.0
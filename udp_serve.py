@@ -1,45 +1,91 @@
 import threading
 import socket
+import time
 import cv2
-import pickle
-import struct
-from picamera2 import Picamera2
+from latest_frame import LatestFrame
+from udp_fragments import FragmentSender
+from camera_backend import Picamera2
+
+FRAME_RATE = 30
 
 # Initialize camera and configure for lower resolution / high performance if needed
 picam2 = Picamera2()
-config = picam2.create_video_configuration({"size": (640, 480)})
+config = picam2.create_video_configuration({"size": (640, 480)}, controls={"FrameRate": FRAME_RATE})
 picam2.configure(config)
 picam2.start()
 
 SERVER_IP = '192.168.1.184'
 SERVER_PORT = 8485
+FEC_OVERHEAD = 0.2  # XOR parity: one repair fragment per 5 data fragments (0 = off)
+MAX_BITRATE = 15000000  # bits/s cap on the paced sender (None = only pace over the frame interval)
+STATS_INTERVAL = 5  # seconds between sender stats lines
 
 sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # UDP for lower latency
+# Splits every frame into MTU-sized datagrams with a fragment header (see udp_fragments.py)
+# and adds FEC_OVERHEAD worth of parity fragments the client can repair losses from.
+# Datagrams are paced over the frame interval instead of sent in one burst.
+sender = FragmentSender(sock, (SERVER_IP, SERVER_PORT), fec_overhead=FEC_OVERHEAD,
+                        frame_interval=1.0 / FRAME_RATE, max_bitrate=MAX_BITRATE)
+# Pacing sleeps for most of a frame interval, so send_frame() runs on its own thread.
+# The capture thread only publishes the newest JPEG here: a frame that is replaced
+# before the sender gets to it is skipped rather than queued behind the others.
+latest_frame = LatestFrame()
+frames_skipped = 0  # captured frames replaced before the sender got to them
+stop = threading.Event()
 
-def send_frames():
-    while True:
+def capture_frames():
+    while not stop.is_set():
         frame = picam2.capture_array()  # capture frame as numpy array
+        capture_time = time.time()
 
         # Encode frame with JPEG
         ret, buffer = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), 80])
         if not ret:
             continue
+        latest_frame.publish((buffer, capture_time))
+
+def send_frames():
+    global frames_skipped
+    version = 0
+    while not stop.is_set():
+        result = latest_frame.wait_newer(version, timeout=0.5)
+        if result is None:
+            continue  # timed out or closed
+        newest, (buffer, capture_time) = result
+        frames_skipped += (newest - version - 1) if version else 0
+        version = newest
 
-        # Pack frame size (if needed, or send as discrete UDP datagrams)
-        data = pickle.dumps(buffer)
+        # Send the JPEG as MTU-sized fragments so frames of any size get through
+        sender.send_frame(buffer, timestamp=capture_time)
 
-        # For UDP, you may need to chunk data if it exceeds the MTU; here we assume small enough frames
-        sock.sendto(data, (SERVER_IP, SERVER_PORT))
+def run(target):
+    try:
+        target()
+    finally:
+        stop.set()  # wake the main thread if either thread dies
+        latest_frame.close()
 
-# Run the frame sending in a separate thread
-sender_thread = threading.Thread(target=send_frames, daemon=True)
-sender_thread.start()
+# Capture and send in separate threads
+threads = [threading.Thread(target=run, args=(target,), daemon=True) for target in (capture_frames, send_frames)]
+for thread in threads:
+    thread.start()
 
 try:
-    while True:
-        pass  # main thread could handle monitoring or other tasks
+    # Sleep until it's time for a stats line (or the sender stops) instead of spinning
+    last_frames, last_bytes, last_wait, last_skipped = 0, 0, 0.0, 0
+    while not stop.wait(STATS_INTERVAL):
+        frames, sent, waited, skipped = sender.frames_sent, sender.bytes_sent, sender.pacer.waited, frames_skipped
+        print("%.1f fps  %.2f Mbit/s  paced %.0f%% of the time  %d skipped"
+              % ((frames - last_frames) / float(STATS_INTERVAL),
+                 (sent - last_bytes) * 8 / 1e6 / STATS_INTERVAL,
+                 100.0 * (waited - last_wait) / STATS_INTERVAL, skipped - last_skipped))
+        last_frames, last_bytes, last_wait, last_skipped = frames, sent, waited, skipped
 except KeyboardInterrupt:
     print("Exiting...")
 finally:
+    stop.set()
+    latest_frame.close()
+    for thread in threads:
+        thread.join(timeout=1.0)
     picam2.close()
     sock.close()